@@ -1,7 +1,29 @@
-import matlab.engine
+import functools
 import numpy as np
 
+_MATLAB_ENGINE = None
+
+
+def get_matlab_engine():
+    """
+    The shared MATLAB engine, started on first use only. The pure python solvers never need it,
+    so machines without a MATLAB installation can run everything except the MATLAB code paths.
+    """
+    global _MATLAB_ENGINE
+    if _MATLAB_ENGINE is None:
+        try:
+            import matlab.engine
+        except ImportError as e:
+            raise RuntimeError("MATLAB engine for python is not installed, use solver_backend: python.") from e
+        print("Lauching matlab...")
+        _MATLAB_ENGINE = matlab.engine.start_matlab()
+        _MATLAB_ENGINE.addpath("./libs/matlab_codes")
+        print("Lauching finished!")
+    return _MATLAB_ENGINE
+
+
 def to_m(numpy_a):
+    import matlab
     if type(numpy_a) == float:
         return matlab.double(numpy_a)
     elif type(numpy_a) == int:
@@ -39,3 +61,22 @@ def apply_periodic_boundary(arr, mod_length=3, axis=0):
     A new array with periodic boundary condition applied along the first axis.
     """
     return np.take(arr, np.arange(arr.shape[0]) % mod_length, axis=axis)
+
+
+def cached_on_state(method):
+    """
+    Memoize a no-argument env method until env.state_version changes.
+    Environments bump state_version whenever their flow state is replaced.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self):
+        cache = self.__dict__.setdefault('_state_cache', {})
+        hit = cache.get(name)
+        if hit is not None and hit[0] == self.state_version:
+            return hit[1]
+        value = method(self)
+        cache[name] = (self.state_version, value)
+        return value
+    return wrapper
@@ -0,0 +1,133 @@
+import numpy as np
+import torch
+from libs.envs.control_env import NSControlEnvMatlab
+from libs.envs.channel_ops import time_advance_rk3
+from libs.envs.channel_poisson import WALL_LEVELS
+
+
+class BatchedNSControlEnv:
+    """
+    N channel flows on the same grid stepped in one vectorized call.
+    U/V/W carry a leading batch dimension, nu, dPdx and meanU0 are per-member tensors [B]
+    and the wall controls are [B, Nx, Nz]. Observations and info values are stacked along B.
+    The grid, the Poisson factorization and the initial condition come from one
+    NSControlEnvMatlab, so only a single environment is initialized.
+    """
+    def __init__(self, args, num_envs=None, re_list=None, noise_scale=0.0, seed=0, base_env=None):
+        if base_env is None:
+            base_env = NSControlEnvMatlab(args)
+        if re_list is None:
+            re_list = [base_env.Re] * (num_envs if num_envs is not None else 1)
+        self.base_env = base_env
+        self.num_envs = len(re_list)
+        self.grid, self.dt = base_env.grid, base_env.dt
+        self.device, self.dtype = base_env.device, base_env.dtype
+        self.Nx, self.Ny, self.Nz = base_env.Nx, base_env.Ny, base_env.Nz
+        self.detect_plane = base_env.detect_plane
+        self.y = base_env.y
+        self.Re = np.array(re_list, dtype=np.float64)
+        nu = [base_env.default_nu * (base_env.default_re / re) if re > 0 else base_env.default_nu for re in re_list]
+        self.nu = self.to_tensor(nu)
+
+        # every member starts from the base state, optionally perturbed with its own seed
+        U = base_env._U.expand(self.num_envs, *base_env._U.shape).clone()
+        V = base_env._V.expand(self.num_envs, *base_env._V.shape).clone()
+        W = base_env._W.expand(self.num_envs, *base_env._W.shape).clone()
+        if noise_scale > 0:
+            for b in range(self.num_envs):
+                rng = np.random.default_rng(seed + b)
+                U[b] += self.to_tensor(rng.normal(scale=noise_scale, size=U.shape[1:]))
+                V[b] += self.to_tensor(rng.normal(scale=noise_scale, size=V.shape[1:]))
+                W[b] += self.to_tensor(rng.normal(scale=noise_scale, size=W.shape[1:]))
+        self._U, self._V, self._W = U, V, W
+        self.dPdx = self.to_tensor([base_env.dPdx] * self.num_envs)
+        self.meanU0 = self.grid.bulk_velocity(self._U)
+        self.info_init = None
+        self.info_init = self.cal_info(*self.get_boundary_pressures())
+
+    def to_tensor(self, a):
+        return torch.as_tensor(np.asarray(a), dtype=self.dtype, device=self.device)
+
+    @property
+    def U(self):
+        return self._U.cpu().numpy()
+
+    @property
+    def V(self):
+        return self._V.cpu().numpy()
+
+    @property
+    def W(self):
+        return self._W.cpu().numpy()
+
+    ################################################################
+    # observations and scores, all [B]
+    ################################################################
+
+    def compute_pressure(self, levels=None):
+        Fu, Fv, Fw = self.grid.rhs(self._U, self._V, self._W, self.nu[:, None, None, None], self.dPdx[:, None, None, None])
+        return self.grid.poisson.solve(self.grid.div(Fu, Fv, Fw), levels=levels)
+
+    def get_boundary_pressures(self):
+        pressure = self.compute_pressure(levels=WALL_LEVELS)
+        p1 = -0.5 * (pressure[:, :, 0, :] + pressure[:, :, 1, :])
+        p2 = -0.5 * (pressure[:, :, -1, :] + pressure[:, :, -2, :])
+        return p1.cpu().numpy(), p2.cpu().numpy()
+
+    def gt_control(self):
+        opV1 = - self.V[:, :, self.detect_plane, :]
+        opV2 = - self.V[:, :, -self.detect_plane, :]
+        return opV1, opV2
+
+    def reward_div(self, bound=-100):
+        div = self.grid.div(self._U, self._V, self._W).sum(dim=(1, 2, 3))
+        return np.maximum(- abs(div.cpu().numpy()), bound)
+
+    def cal_shear_stress(self):
+        # -u*v + nu * (dU/dy) on the top wall
+        wall_u, wall_v = self._U[:, :, -1, :], self._V[:, :, -1, :]
+        dudy = (self._U[:, :, -2, :] - self._U[:, :, -3, :]) / float(self.y[-1, 0] - self.y[-2, 0])
+        shear_stress = - wall_u * wall_v + self.nu[:, None, None] * dudy
+        return abs(shear_stress.mean(dim=(1, 2)).cpu().numpy())
+
+    def cal_info(self, p1, p2, div=None):
+        if div is None:
+            div = self.reward_div()
+        speed_norm = sum(f.flatten(1).norm(dim=1) for f in (self._U, self._V, self._W))
+        info = {
+                'drag_reduction/1_shear_stress': self.cal_shear_stress(),
+                'drag_reduction/2_1_mass_flow': self.grid.bulk_velocity(self._U).cpu().numpy(),
+                'drag_reduction/2_2_v_velocity': self._V.abs().mean(dim=(1, 2, 3)).cpu().numpy(),
+                'drag_reduction/2_3_w_velocity': self._W.abs().mean(dim=(1, 2, 3)).cpu().numpy(),
+                'drag_reduction/3_1_pressure_mean': p2.mean(axis=(1, 2)),
+                'drag_reduction/3_2_dPdx_finite_difference': abs(np.diff(p2, axis=1)).mean(axis=(1, 2)) / self.grid.dx,
+                'drag_reduction/3_3_dPdx_reverse_cal': self.dPdx.cpu().numpy(),
+                'drag_reduction/4_1_-|divergence|': div,
+                'drag_reduction/4_4_speed_norm': speed_norm.cpu().numpy(),
+        }
+        if self.info_init is not None:
+            for one_k in list(info):
+                if 'divergence' in one_k:
+                    continue
+                new_k = one_k.replace("drag_reduction", "drag_reduction_relative")
+                info[new_k] = info[one_k] / self.info_init[one_k]
+        return info
+
+    def split_info(self, info):
+        # one info dict per member, e.g. for logging
+        return [{k: v[b] for k, v in info.items()} for b in range(self.num_envs)]
+
+    ################################################################
+    # the step function
+    ################################################################
+
+    def step(self, opV1, opV2):
+        opV1 = self.to_tensor(opV1).expand(self.num_envs, self.Nx, self.Nz)
+        opV2 = self.to_tensor(opV2).expand(self.num_envs, self.Nx, self.Nz)
+        self._U, self._V, self._W, self.dPdx = time_advance_rk3(self.grid, self._U, self._V, self._W, opV1, opV2,
+                                                                self.nu, self.dPdx, self.meanU0, self.dt)
+        p1, p2 = self.get_boundary_pressures()
+        div = self.reward_div()
+        done = np.zeros(self.num_envs, dtype=bool)
+        info = self.cal_info(p1, p2, div)
+        return p2, div, done, info
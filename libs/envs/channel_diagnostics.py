@@ -0,0 +1,89 @@
+import numpy as np
+import torch
+
+# short metric name -> info key logged to wandb
+METRIC_KEYS = {
+    'shear_stress': 'drag_reduction/1_shear_stress',
+    'mass_flow': 'drag_reduction/2_1_mass_flow',
+    'v_velocity': 'drag_reduction/2_2_v_velocity',
+    'w_velocity': 'drag_reduction/2_3_w_velocity',
+    'pressure_mean': 'drag_reduction/3_1_pressure_mean',
+    'dpdx_finite_difference': 'drag_reduction/3_2_dPdx_finite_difference',
+    'dpdx_reverse_cal': 'drag_reduction/3_3_dPdx_reverse_cal',
+    'divergence': 'drag_reduction/4_1_-|divergence|',
+    'speed_norm': 'drag_reduction/4_4_speed_norm',
+}
+# free to compute and read by the progress bar, always reported
+ALWAYS_ON = ('dpdx_reverse_cal',)
+
+
+class ChannelDiagnostics:
+    """
+    The drag reduction metrics of the channel env computed in one pass over the tensor state.
+    Only the enabled metrics are evaluated, and only every log_interval steps (see due).
+    The field metrics are sums over the local state combined with grid.all_reduce, so a DistributedChannelGrid
+    gives the metrics of the whole channel from the x slabs of every rank.
+    """
+    def __init__(self, grid, y, metrics=None, log_interval=1):
+        if metrics is None:
+            metrics = list(METRIC_KEYS)
+        unknown = set(metrics) - set(METRIC_KEYS)
+        if unknown:
+            raise RuntimeError(f"Not supported diagnostics: {sorted(unknown)}")
+        self.grid = grid
+        self.metrics = [k for k in METRIC_KEYS if k in metrics or k in ALWAYS_ON]
+        self.log_interval = max(int(log_interval), 1)
+        self.wall_dy = float(y[-1, 0] - y[-2, 0])
+
+    def due(self, step_index):
+        return step_index % self.log_interval == 0
+
+    def compute(self, U, V, W, p2, dPdx, nu, div=None, metrics=None):
+        """
+        U/V/W: state tensors, p2: top wall pressure [Nx, Nz] (numpy), div: the divergence reward if already known.
+        """
+        metrics = self.metrics if metrics is None else metrics
+        values = {}
+        with torch.no_grad():
+            # local sums and the local number of x planes, combined over the ranks in one all_reduce
+            sums = {'num_x': torch.tensor(U.shape[0], dtype=U.dtype, device=U.device)}
+            if 'shear_stress' in metrics:
+                # -u*v + nu * (dU/dy) on the top wall
+                dudy = (U[:, -2, :] - U[:, -3, :]) / self.wall_dy
+                sums['shear_stress'] = (- U[:, -1, :] * V[:, -1, :] + nu * dudy).sum()
+            if 'v_velocity' in metrics:
+                sums['v_velocity'] = V.abs().sum()
+            if 'w_velocity' in metrics:
+                sums['w_velocity'] = W.abs().sum()
+            if 'speed_norm' in metrics:
+                sums.update(U_sq=U.square().sum(), V_sq=V.square().sum(), W_sq=W.square().sum())
+            if 'divergence' in metrics and div is None:
+                sums['divergence'] = self.grid.div(U, V, W).sum()
+            sums = dict(zip(sums, self.grid.all_reduce(torch.stack(list(sums.values())))))
+            # number of points of a [x, ...] field over all the slabs
+            count = lambda f: sums['num_x'] * f[0].numel()
+            if 'shear_stress' in metrics:
+                values['shear_stress'] = abs(sums['shear_stress'] / count(U[:, -1, :]))
+            if 'mass_flow' in metrics:
+                values['mass_flow'] = self.grid.bulk_velocity(U)
+            if 'v_velocity' in metrics:
+                values['v_velocity'] = sums['v_velocity'] / count(V)
+            if 'w_velocity' in metrics:
+                values['w_velocity'] = sums['w_velocity'] / count(W)
+            if 'speed_norm' in metrics:
+                values['speed_norm'] = sums['V_sq'].sqrt() + sums['U_sq'].sqrt() + sums['W_sq'].sqrt()
+            if 'divergence' in metrics and div is None:
+                div = max(- abs(sums['divergence'].item()), -100)
+        # one transfer for all the tensor metrics
+        if values:
+            host = torch.stack(list(values.values())).cpu().numpy()
+            values = {k: v.item() for k, v in zip(values, host)}
+        if 'pressure_mean' in metrics:
+            values['pressure_mean'] = p2.mean()
+        if 'dpdx_finite_difference' in metrics:
+            values['dpdx_finite_difference'] = abs(np.diff(p2, axis=0)).mean() / self.grid.dx
+        if 'dpdx_reverse_cal' in metrics:
+            values['dpdx_reverse_cal'] = dPdx
+        if 'divergence' in metrics:
+            values['divergence'] = div
+        return {METRIC_KEYS[k]: values[k] for k in METRIC_KEYS if k in values}
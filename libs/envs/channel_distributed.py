@@ -0,0 +1,160 @@
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+from neuralop.mpu.helpers import _split, _gather, _transpose
+from libs.envs.channel_ops import compute_rhs, compute_div, diff_y, pad_y, prev_z, X_DIM, Z_DIM
+
+# Slab decomposition of the channel solver: every rank holds Nx / world_size x-planes of U/V/W
+# ([..., nx_local, y, z]), the stencils read one plane of each neighbour slab (exchange_halo) and the
+# Poisson solve transposes x against the y eigenmodes so that every FFT is local.
+# Launch with torchrun (one process per socket or core group), e.g.
+#   OMP_NUM_THREADS=8 torchrun --nproc_per_node=4 run_control.py ... with solver_backend: distributed
+# The env keeps U/V/W as x slabs between the steps, the observations only gather the wall planes they read
+# and the scalars (divergence, cfl dt, diagnostics) are reduced with all_reduce. The full fields are gathered
+# on request only (data collection, dumps, visualization), so every rank runs the whole control loop and takes
+# part in these gathers, while run_control leaves wandb and all file output to rank 0 (is_main_process).
+
+
+def init_distributed(backend='gloo'):
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def exchange_halo(f, group=None):
+    """
+    [..., nx_local, y, z] -> [..., nx_local + 2, y, z] with the last plane of the previous rank in front and
+    the first plane of the next rank behind, the ranks form a periodic ring in x.
+    """
+    size = dist.get_world_size(group=group)
+    if size == 1:
+        return torch.cat([f[..., -1:, :, :], f, f[..., :1, :, :]], dim=X_DIM)
+    rank = dist.get_rank(group=group)
+    peer = lambda r: r if group is None else dist.get_global_rank(group, r)
+    prev_rank, next_rank = peer((rank - 1) % size), peer((rank + 1) % size)
+    low = torch.empty_like(f[..., :1, :, :])
+    high = torch.empty_like(f[..., -1:, :, :])
+    # tags tell the two planes apart when prev_rank == next_rank
+    ops = [dist.P2POp(dist.isend, f[..., :1, :, :].contiguous(), prev_rank, group, tag=0),
+           dist.P2POp(dist.isend, f[..., -1:, :, :].contiguous(), next_rank, group, tag=1),
+           dist.P2POp(dist.irecv, low, prev_rank, group, tag=1),
+           dist.P2POp(dist.irecv, high, next_rank, group, tag=0)]
+    for req in dist.batch_isend_irecv(ops):
+        req.wait()
+    return torch.cat([low, f, high], dim=X_DIM)
+
+
+def crop_halo(f):
+    return f[..., 1:-1, :, :]
+
+
+def pad_x(f):
+    # fields which are not shifted in x, padded to the halo shape without communication
+    return F.pad(f, (0, 0, 0, 0, 1, 1))
+
+
+class DistributedChannelGrid:
+    """
+    The ChannelGrid interface (rhs, div, project, bulk_velocity, lap_y, diffusion, all_reduce) on x slabs, so
+    time_advance_rk3 / time_advance_imex_rk3 run unchanged on the local fields of every rank.
+    Nx has to be divisible by the world size.
+    """
+    def __init__(self, grid, group=None):
+        self.grid, self.group = grid, group
+        self.size = dist.get_world_size(group=group)
+        self.rank = dist.get_rank(group=group)
+        self.dx, self.dz, self.dtype, self.device = grid.dx, grid.dz, grid.dtype, grid.device
+        self.inv_dy, self.inv_dyg, self.inv_dym = grid.inv_dy, grid.inv_dyg, grid.inv_dym
+        self.diffusion, self.bulk_weights = grid.diffusion, grid.bulk_weights
+        poisson = grid.poisson
+        self.Nx, self.Nz, self.n = poisson.Nx, poisson.Nz, poisson.n
+        if self.Nx % self.size != 0:
+            raise RuntimeError(f"Nx = {self.Nx} is not divisible by the {self.size} processes.")
+        # the y eigenmodes are split across the ranks during the x transforms (zero padded to a multiple)
+        self.n_pad = -(-self.n // self.size) * self.size
+        self.n_local = self.n_pad // self.size
+        modes = slice(self.rank * self.n_local, (self.rank + 1) * self.n_local)
+        inv_denom = poisson.inv_denom.clone()
+        inv_denom[0, :, 0] = 0  # the mean mode is solved directly, see solve_pressure
+        inv_denom = F.pad(inv_denom, (0, 0, 0, self.n_pad - self.n))
+        self.inv_denom = inv_denom[:, modes, :]
+
+    def split(self, f, dim=X_DIM):
+        # the local slab of a global field, controls [Nx, Nz] use dim=-2
+        return _split(f, dim, group=self.group)
+
+    def gather(self, f, dim=X_DIM):
+        return _gather(f, dim, group=self.group)
+
+    def broadcast(self, t, src=0):
+        # the replicated state must stay identical on every rank, e.g. randomly drawn controls
+        if self.size > 1:
+            dist.broadcast(t, src=dist.get_global_rank(self.group, src) if self.group is not None else src,
+                           group=self.group)
+        return t
+
+    def all_reduce(self, t, op='sum'):
+        # op: sum or max over the ranks, in place
+        if self.size > 1:
+            dist.all_reduce(t, op={'sum': dist.ReduceOp.SUM, 'max': dist.ReduceOp.MAX}[op], group=self.group)
+        return t
+
+    def rhs(self, U, V, W, nu, dPdx):
+        U, V, W = exchange_halo(U, self.group), exchange_halo(V, self.group), exchange_halo(W, self.group)
+        Fu, Fv, Fw = compute_rhs(U, V, W, nu, dPdx, self.dx, self.dz, self.inv_dy, self.inv_dyg, self.inv_dym)
+        return crop_halo(Fu), crop_halo(Fv), crop_halo(Fw)
+
+    def lap_y(self, U, V, W):
+        return self.grid.lap_y(U, V, W)
+
+    def div(self, U, V, W):
+        # only U is shifted in x
+        div = compute_div(exchange_halo(U, self.group), pad_x(V), pad_x(W), self.dx, self.dz, self.inv_dy)
+        return crop_halo(div)
+
+    def transpose(self, f, split_dim, cat_dim):
+        if self.size == 1:
+            return f
+        chunks, _ = _transpose(f, split_dim, cat_dim, group=self.group)
+        return torch.cat(chunks, dim=cat_dim)
+
+    def solve_pressure(self, rhs, levels=None):
+        """
+        ChannelPoissonSolver.solve on slabs: rfft in z and the y eigenbasis are local, then the eigenmodes
+        are distributed and x is gathered (all-to-all) for the x FFT, and back.
+        levels: optional list of y indices, only these levels are transformed back (e.g. the wall sensors).
+        """
+        poisson = self.grid.poisson
+        left, mean_mode_inv = poisson.left, poisson.mean_mode_inv
+        if levels is not None:
+            left, mean_mode_inv = left[levels], mean_mode_inv[levels]
+        rhs_hat = torch.view_as_real(torch.fft.rfft(rhs, dim=Z_DIM))  # [..., nx_l, n, Nzr, 2]
+        p_hat = torch.einsum('ij,...xjzc->...xizc', poisson.right, rhs_hat)
+        p_hat = F.pad(p_hat, (0, 0, 0, 0, 0, self.n_pad - self.n))
+        p_hat = self.transpose(p_hat, -3, -4)  # [..., Nx, n_l, Nzr, 2]
+        p_hat = torch.fft.fft(torch.view_as_complex(p_hat.contiguous()), dim=-3)
+        p_hat = torch.fft.ifft(p_hat * self.inv_denom, dim=-3)
+        p_hat = self.transpose(torch.view_as_real(p_hat), -4, -3)[..., :self.n, :, :]  # [..., nx_l, n, Nzr, 2]
+        p_hat = torch.einsum('ij,...xjzc->...xizc', left, p_hat)
+        p = torch.fft.irfft(torch.view_as_complex(p_hat.contiguous()), n=self.Nz, dim=Z_DIM)
+        # mean mode: the (0, 0) coefficient of every y level is the sum over the whole x-z plane
+        plane_sum = self.all_reduce(rhs.sum(dim=(X_DIM, Z_DIM)))
+        p_mean = torch.einsum('ij,...j->...i', mean_mode_inv, plane_sum) / (self.Nx * self.Nz)
+        return p + p_mean[..., None, :, None]
+
+    def project(self, U, V, W):
+        p = self.solve_pressure(self.div(U, V, W))
+        # apply_pressure_gradient with the previous x plane of p taken from the halo
+        p_px = exchange_halo(p, self.group)[..., :-2, :, :]
+        Uout = U - pad_y((p - p_px) / self.dx)
+        Vout = V - pad_y(diff_y(p) * self.inv_dym)
+        Wout = W - pad_y((p - prev_z(p)) / self.dz)
+        return Uout, Vout, Wout
+
+    def bulk_velocity(self, U):
+        profile = self.all_reduce(U[..., 1:-1, :].sum(dim=(X_DIM, Z_DIM))) / (self.Nx * self.Nz)
+        return (profile * self.bulk_weights).sum(-1) / 2
@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+
+
+def symmetrizable_eig(L, h):
+    """
+    Eigendecomposition of L = H^-1 S with H = diag(h) and S symmetric (the y operators of the channel).
+    Returns eig_val, left = H^-1/2 V and right = V^T H^1/2, so that L = left diag(eig_val) right.
+    """
+    h_sqrt = h.sqrt()
+    sym = h_sqrt[:, None] * L / h_sqrt[None, :]
+    sym = 0.5 * (sym + sym.T)  # remove round-off asymmetry
+    eig_val, eig_vec = torch.linalg.eigh(sym)
+    return eig_val, eig_vec / h_sqrt[:, None], eig_vec.T * h_sqrt[None, :]
+
+
+class WallNormalDiffusion:
+    """
+    Implicit solves (I - c * d2/dy2) x = r of the wall-normal viscous term on the stretched grid,
+    with c = beta * dt * nu of an IMEX stage.
+    U and W (cell centers, Ny-1 unknowns): the ghost cells mirror the no-slip walls.
+    V (y faces, Ny-2 unknowns): the wall values are the blowing/suction controls (Dirichlet).
+    The operators are the same tridiagonal stencils as compute_rhs and are diagonalized once like DD
+    in the Poisson solver, hence every column of every field is solved by two small matmuls and
+    a change of c (adaptive dt, per-member nu) needs no refactorization.
+    """
+    def __init__(self, y, ym, yg, dtype=torch.float64, device=None):
+        y, ym, yg = np.reshape(y, -1), np.reshape(ym, -1), np.reshape(yg, -1)
+        inv_dy, inv_dyg, inv_dym = 1 / np.diff(y), 1 / np.diff(yg), 1 / np.diff(ym)
+
+        # U/W rows 1..Ny-1
+        n = len(y) - 1
+        Lu = np.zeros((n, n))
+        for i in range(n):
+            Lu[i, i] = - inv_dy[i] * (inv_dyg[i + 1] + inv_dyg[i])
+        for i in range(n - 1):
+            Lu[i, i + 1] = inv_dy[i] * inv_dyg[i + 1]
+            Lu[i + 1, i] = inv_dy[i + 1] * inv_dyg[i + 1]
+        Lu[0, 0] -= inv_dy[0] * inv_dyg[0]  # ghost = - first cell
+        Lu[-1, -1] -= inv_dy[-1] * inv_dyg[-1]
+
+        # V rows 1..Ny-2
+        n = len(y) - 2
+        Lv = np.zeros((n, n))
+        for i in range(n):
+            Lv[i, i] = - inv_dym[i] * (inv_dy[i + 1] + inv_dy[i])
+        for i in range(n - 1):
+            Lv[i, i + 1] = inv_dym[i] * inv_dy[i + 1]
+            Lv[i + 1, i] = inv_dym[i + 1] * inv_dy[i + 1]
+        # coupling of the first/last unknown to the wall values
+        self.wall_coef = (float(inv_dym[0] * inv_dy[0]), float(inv_dym[-1] * inv_dy[-1]))
+
+        as_tensor = lambda a: torch.tensor(a, dtype=dtype, device=device)
+        self.eig_u, self.left_u, self.right_u = symmetrizable_eig(as_tensor(Lu), as_tensor(np.diff(y)))
+        self.eig_v, self.left_v, self.right_v = symmetrizable_eig(as_tensor(Lv), as_tensor(np.diff(ym)))
+
+    def to(self, device=None, dtype=None):
+        for name in ['eig_u', 'left_u', 'right_u', 'eig_v', 'left_v', 'right_v']:
+            setattr(self, name, getattr(self, name).to(device=device, dtype=dtype))
+        return self
+
+    @staticmethod
+    def _solve(rhs, c, eig_val, left, right):
+        # rhs: [..., x, n, z], c: float or broadcastable against the fields (e.g. [B, 1, 1, 1])
+        x_hat = torch.einsum('ij,...xjz->...xiz', right, rhs)
+        x_hat = x_hat / (1 - c * eig_val[:, None])
+        return torch.einsum('ij,...xjz->...xiz', left, x_hat)
+
+    def solve_u(self, U, c):
+        # interior rows are replaced, the ghost rows are left for apply_boundary_condition
+        interior = self._solve(U[..., 1:-1, :], c, self.eig_u, self.left_u, self.right_u)
+        return torch.cat([U[..., :1, :], interior, U[..., -1:, :]], dim=-2)
+
+    def solve_v(self, V, c, Vw1, Vw2):
+        # the new wall values are known and moved to the right hand side
+        wall = torch.zeros_like(V[..., 1:-1, :])
+        wall[..., 0, :] = self.wall_coef[0] * Vw1
+        wall[..., -1, :] = self.wall_coef[1] * Vw2
+        interior = self._solve(V[..., 1:-1, :] + c * wall, c, self.eig_v, self.left_v, self.right_v)
+        return torch.cat([V[..., :1, :], interior, V[..., -1:, :]], dim=-2)
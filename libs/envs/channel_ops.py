@@ -0,0 +1,341 @@
+import copy
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from libs.envs.channel_poisson import ChannelPoissonSolver
+from libs.envs.channel_implicit import WallNormalDiffusion
+
+# Staggered-grid operators of the channel solver. Fields are [..., x, y, z]:
+# U, W: [..., Nx, Ny+1, Nz] (cell centers in y with one ghost cell on each wall)
+# V:    [..., Nx, Ny, Nz]   (y faces, the first and last ones are the walls)
+# p:    [..., Nx, Ny-1, Nz] (cell centers)
+# Every x/z shift is periodic and done with roll, every y derivative uses the
+# precomputed 1D metrics below (shape [n, 1]) broadcast over the whole field:
+# inv_dy  = 1 / (y[1:] - y[:-1]),   [Ny-1, 1]
+# inv_dyg = 1 / (yg[1:] - yg[:-1]), [Ny, 1]
+# inv_dym = 1 / (ym[1:] - ym[:-1]), [Ny-2, 1]
+X_DIM, Y_DIM, Z_DIM = -3, -2, -1
+
+
+def next_x(f):
+    return torch.roll(f, -1, dims=X_DIM)
+
+
+def prev_x(f):
+    return torch.roll(f, 1, dims=X_DIM)
+
+
+def next_z(f):
+    return torch.roll(f, -1, dims=Z_DIM)
+
+
+def prev_z(f):
+    return torch.roll(f, 1, dims=Z_DIM)
+
+
+def diff_y(f):
+    return f[..., 1:, :] - f[..., :-1, :]
+
+
+def pad_y(f):
+    # zero rows for the two wall/ghost layers which are not updated
+    return F.pad(f, (0, 0, 1, 1))
+
+
+def compute_rhs(U, V, W, nu, dPdx, dx, dz, inv_dy, inv_dyg, inv_dym):
+    """
+    Fu = - d(uu)/dx - d(uv)/dy - d(uw)/dz + nu * lap(u) + dPdx / 2, same for Fv and Fw (without forcing).
+    """
+    U_px, U_pz = prev_x(U), prev_z(U)
+    V_px, V_pz = prev_x(V), prev_z(V)
+    W_px, W_nz = prev_x(W), next_z(W)
+    U_nx = next_x(U)
+
+    # products shared by the momentum equations
+    UV = (0.5 * (V + V_px)) * (0.5 * (U[..., :-1, :] + U[..., 1:, :]))
+    UW = (0.5 * (W + W_px)) * (0.5 * (U + U_pz))
+    VW = (0.5 * (V + V_pz)) * (0.5 * (W[..., :-1, :] + W[..., 1:, :]))
+
+    # compute Fu
+    UU = (0.5 * (U + U_nx))**2
+    Fu = - (UU - prev_x(UU)) / dx
+    Fu = Fu - (next_z(UW) - UW) / dz
+    Fu = Fu + nu * (U_nx - 2 * U + U_px) / dx**2
+    Fu = Fu + nu * (next_z(U) - 2 * U + U_pz) / dz**2
+    Fu = Fu + pad_y((nu * diff_y(diff_y(U) * inv_dyg) - diff_y(UV)) * inv_dy)
+    Fu = Fu + dPdx / 2
+
+    # compute Fv
+    VV = (0.5 * (V[..., :-1, :] + V[..., 1:, :]))**2
+    Fv = - (next_x(UV) - UV) / dx
+    Fv = Fv - (next_z(VW) - VW) / dz
+    Fv = Fv + nu * (next_x(V) - 2 * V + V_px) / dx**2
+    Fv = Fv + nu * (next_z(V) - 2 * V + V_pz) / dz**2
+    Fv = Fv + pad_y((nu * diff_y(diff_y(V) * inv_dy) - diff_y(VV)) * inv_dym)
+
+    # compute Fw
+    WW = (0.5 * (W + W_nz))**2
+    Fw = - (next_x(UW) - UW) / dx
+    Fw = Fw - (WW - prev_z(WW)) / dz
+    Fw = Fw + nu * (next_x(W) - 2 * W + W_px) / dx**2
+    Fw = Fw + nu * (W_nz - 2 * W + prev_z(W)) / dz**2
+    Fw = Fw + pad_y((nu * diff_y(diff_y(W) * inv_dyg) - diff_y(VW)) * inv_dy)
+    return Fu, Fv, Fw
+
+
+def compute_lap_y(U, V, W, inv_dy, inv_dyg, inv_dym):
+    # the wall-normal part of lap(u), the implicit term of the IMEX scheme
+    Lu = pad_y(diff_y(diff_y(U) * inv_dyg) * inv_dy)
+    Lv = pad_y(diff_y(diff_y(V) * inv_dy) * inv_dym)
+    Lw = pad_y(diff_y(diff_y(W) * inv_dyg) * inv_dy)
+    return Lu, Lv, Lw
+
+
+def compute_div(U, V, W, dx, dz, inv_dy):
+    # divergence at the cell centers, [..., Nx, Ny-1, Nz]
+    U, W = U[..., 1:-1, :], W[..., 1:-1, :]
+    return (next_x(U) - U) / dx + diff_y(V) * inv_dy + (next_z(W) - W) / dz
+
+
+def apply_pressure_gradient(U, V, W, p, dx, dz, inv_dym):
+    # fractional step, the wall/ghost layers are left untouched
+    Uout = U - pad_y((p - prev_x(p)) / dx)
+    Vout = V - pad_y(diff_y(p) * inv_dym)
+    Wout = W - pad_y((p - prev_z(p)) / dz)
+    return Uout, Vout, Wout
+
+
+def apply_boundary_condition(U, V, W, Vw1, Vw2):
+    # ghost cells mirror the no-slip walls, V on the walls is the blowing/suction control
+    U[..., 0, :] = -U[..., 1, :]
+    U[..., -1, :] = -U[..., -2, :]
+    V[..., 0, :] = Vw1
+    V[..., -1, :] = Vw2
+    W[..., 0, :] = -W[..., 1, :]
+    W[..., -1, :] = -W[..., -2, :]
+    return U, V, W
+
+
+def as_field_param(a):
+    # per-member parameters [B] broadcast against fields [B, x, y, z]
+    if torch.is_tensor(a) and a.ndim > 0:
+        return a[..., None, None, None]
+    return a
+
+
+def time_advance_rk3(grid, U0, V0, W0, opV1, opV2, nu, dPdx, meanU0, dt, rhs0=None):
+    """
+    One RK3 step with a projection after every stage and the constant mass flow correction.
+    nu, dPdx and meanU0 are floats or tensors with the batch shape of the fields.
+    rhs0: the RHS of (U0, V0, W0) if it is already known, reused as the first stage.
+    """
+    nu_f, dPdx_f = as_field_param(nu), as_field_param(dPdx)
+
+    # 1st RK step
+    if rhs0 is None:
+        rhs0 = grid.rhs(U0, V0, W0, nu_f, dPdx_f)
+    Fu1, Fv1, Fw1 = rhs0
+    U = U0 + dt * 8 / 15 * Fu1
+    V = V0 + dt * 8 / 15 * Fv1
+    W = W0 + dt * 8 / 15 * Fw1
+    U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
+    U, V, W = grid.project(U, V, W)
+    U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
+
+    # 2nd RK step
+    Fu2, Fv2, Fw2 = grid.rhs(U, V, W, nu_f, dPdx_f)
+    U = U0 + dt * (1 / 4 * Fu1 + 5 / 12 * Fu2)
+    V = V0 + dt * (1 / 4 * Fv1 + 5 / 12 * Fv2)
+    W = W0 + dt * (1 / 4 * Fw1 + 5 / 12 * Fw2)
+    U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
+    U, V, W = grid.project(U, V, W)
+    U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
+
+    # 3rd RK step
+    Fu3, Fv3, Fw3 = grid.rhs(U, V, W, nu_f, dPdx_f)
+    U = U0 + dt * (1 / 4 * Fu1 + 3 / 4 * Fu3)
+    V = V0 + dt * (1 / 4 * Fv1 + 3 / 4 * Fv3)
+    W = W0 + dt * (1 / 4 * Fw1 + 3 / 4 * Fw3)
+    U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
+    U, V, W = grid.project(U, V, W)
+    U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
+
+    # keep the mass flow constant
+    dPdx_pre = dPdx
+    dPdx = 2 * (meanU0 - grid.bulk_velocity(U))
+    U[..., 1:-1, :] = U[..., 1:-1, :] + as_field_param(dPdx) / 2
+    dPdx = 0.5 * (dPdx_pre + dPdx / dt)
+    return U, V, W, dPdx
+
+
+# low storage IMEX RK3 of Spalart, Moser & Rogers (1991)
+IMEX_GAMMA = (8 / 15, 5 / 12, 3 / 4)
+IMEX_ZETA = (0, -17 / 60, -5 / 12)
+IMEX_ALPHA = (4 / 15, 1 / 15, 1 / 6)
+IMEX_BETA = (4 / 15, 1 / 15, 1 / 6)
+
+
+def time_advance_imex_rk3(grid, U0, V0, W0, opV1, opV2, nu, dPdx, meanU0, dt, rhs0=None):
+    """
+    One IMEX RK3 step: nu * d2/dy2 is treated with Crank-Nicolson in every stage, everything else
+    (convection, x/z diffusion and the forcing) explicitly. Same arguments and outputs as time_advance_rk3.
+    """
+    nu_f, dPdx_f = as_field_param(nu), as_field_param(dPdx)
+    fields = (U0, V0, W0)
+    rhs = rhs0 if rhs0 is not None else grid.rhs(U0, V0, W0, nu_f, dPdx_f)
+    N_prev = None
+    for k in range(3):
+        if k > 0:
+            rhs = grid.rhs(*fields, nu_f, dPdx_f)
+        lap = [nu_f * f for f in grid.lap_y(*fields)]
+        N = [F - L for F, L in zip(rhs, lap)]
+        new = []
+        for i, (f, n, L) in enumerate(zip(fields, N, lap)):
+            r = f + dt * (IMEX_GAMMA[k] * n + IMEX_ALPHA[k] * L)
+            if N_prev is not None:
+                r = r + dt * IMEX_ZETA[k] * N_prev[i]
+            new.append(r)
+        c = IMEX_BETA[k] * dt * nu_f
+        U = grid.diffusion.solve_u(new[0], c)
+        V = grid.diffusion.solve_v(new[1], c, opV1, opV2)
+        W = grid.diffusion.solve_u(new[2], c)
+        U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
+        U, V, W = grid.project(U, V, W)
+        fields = apply_boundary_condition(U, V, W, opV1, opV2)
+        N_prev = N
+    U, V, W = fields
+
+    # keep the mass flow constant
+    dPdx_pre = dPdx
+    dPdx = 2 * (meanU0 - grid.bulk_velocity(U))
+    U[..., 1:-1, :] = U[..., 1:-1, :] + as_field_param(dPdx) / 2
+    dPdx = 0.5 * (dPdx_pre + dPdx / dt)
+    return U, V, W, dPdx
+
+
+TIME_INTEGRATORS = {'rk3': time_advance_rk3, 'imex_rk3': time_advance_imex_rk3}
+
+
+def cfl_time_step(grid, U, V, W, nu, cfl=0.5, implicit_y=False):
+    """
+    The largest stable dt of the RK3 schemes scaled by the cfl number, shared by all batch members (and x slabs).
+    Convection uses the RK3 limit sqrt(3), the explicit diffusion 2.5 (wall-normal only if not implicit).
+    """
+    with torch.no_grad():
+        # V sits on the y faces, its control volume spans two ghost-grid points
+        amax = grid.all_reduce(torch.stack([U.abs().amax(), (V.abs() * grid.inv_dyg).amax(), W.abs().amax()]), op='max')
+        conv = amax[0] / grid.dx + amax[1] + amax[2] / grid.dz
+        conv = max(conv.item(), 1e-12)
+        nu_max = nu.max().item() if torch.is_tensor(nu) else nu
+        visc = 4 / grid.dx**2 + 4 / grid.dz**2
+        if not implicit_y:
+            visc = visc + grid.diffusion.eig_u.abs().max().item()
+        visc = max(nu_max * visc, 1e-12)
+    return cfl * min(np.sqrt(3) / conv, 2.5 / visc)
+
+
+def wall_shear_stress(grid, U, V, nu):
+    # |-u*v + nu * dU/dy| on the top wall averaged over x and z, differentiable version of cal_shear_stress
+    if torch.is_tensor(nu) and nu.ndim > 0:
+        nu = nu[..., None, None]
+    dudy = (U[..., -2, :] - U[..., -3, :]) * grid.inv_dy[-1]
+    return (- U[..., -1, :] * V[..., -1, :] + nu * dudy).mean(dim=(-2, -1)).abs()
+
+
+def rollout(grid, U, V, W, opV1, opV2, nu, dPdx, meanU0, dt, integrator=time_advance_rk3, cost=None,
+            checkpoint_steps=1):
+    """
+    len(opV2) steps of `integrator` with the controls opV1[t], opV2[t] ([k, ..., Nx, Nz]), differentiable
+    with respect to the controls and the initial state.
+    checkpoint_steps > 0: only the states at the segment boundaries are stored for the backward pass and
+    the RK stages of a segment are recomputed, so the memory grows with k / checkpoint_steps states instead
+    of every stage of every step. 0 keeps the whole graph.
+    cost(U, V, W, dPdx): optional per-step scalar summed over the horizon.
+    Returns U, V, W, dPdx and the summed cost.
+    """
+    k = len(opV2)
+    dPdx = torch.as_tensor(dPdx, dtype=U.dtype, device=U.device)
+
+    def segment(start, stop, U, V, W, dPdx):
+        total = torch.zeros((), dtype=U.dtype, device=U.device)
+        for t in range(start, stop):
+            U, V, W, dPdx = integrator(grid, U, V, W, opV1[t], opV2[t], nu, dPdx, meanU0, dt)
+            if cost is not None:
+                total = total + cost(U, V, W, dPdx)
+        return U, V, W, dPdx, total
+
+    total = 0
+    size = checkpoint_steps if checkpoint_steps > 0 else k
+    for start in range(0, k, size):
+        stop = min(start + size, k)
+        if checkpoint_steps > 0 and torch.is_grad_enabled():
+            U, V, W, dPdx, seg_cost = checkpoint(segment, start, stop, U, V, W, dPdx, use_reentrant=False)
+        else:
+            U, V, W, dPdx, seg_cost = segment(start, stop, U, V, W, dPdx)
+        total = total + seg_cost
+    return U, V, W, dPdx, total
+
+
+class ChannelGrid:
+    """
+    Grid metrics, wavenumbers and the factorized Poisson operator of the channel,
+    built once per grid and kept as tensors in one dtype/device.
+    """
+    def __init__(self, dx, dz, y, ym, yg, kxx, kzz, DD, dtype=torch.float64, device='cpu'):
+        y, ym, yg = np.reshape(y, -1), np.reshape(ym, -1), np.reshape(yg, -1)
+        self.dtype, self.device = dtype, torch.device(device)
+        self.dx = float(np.reshape(dx, -1)[0])
+        self.dz = float(np.reshape(dz, -1)[0])
+        as_column = lambda a: torch.tensor(a, dtype=dtype, device=self.device)[:, None]
+        self.inv_dy = as_column(1 / np.diff(y))
+        self.inv_dyg = as_column(1 / np.diff(yg))
+        self.inv_dym = as_column(1 / np.diff(ym))
+        self.kxx = torch.tensor(kxx, dtype=dtype, device=self.device)
+        self.kzz = torch.tensor(kzz, dtype=dtype, device=self.device)
+        self.DD = torch.tensor(DD, dtype=dtype, device=self.device)
+        # trapezoidal weights of the bulk velocity, the profile is zero at y = 0 and y = 2
+        y_values = np.concatenate(([0], ym, [2]))
+        self.bulk_weights = torch.tensor(0.5 * (y_values[2:] - y_values[:-2]), dtype=dtype, device=self.device)
+        self.poisson = ChannelPoissonSolver(DD, np.diff(y), kxx, kzz, dtype=dtype, device=self.device)
+        self.diffusion = WallNormalDiffusion(y, ym, yg, dtype=dtype, device=self.device)
+        self._copies = {}
+
+    def on(self, device):
+        """
+        The grid on another device (e.g. cuda tensors fed to pde_loss), cached after the first call.
+        """
+        device = torch.device(device)
+        if device == self.device:
+            return self
+        if device not in self._copies:
+            grid = ChannelGrid.__new__(ChannelGrid)
+            grid.__dict__.update(self.__dict__)
+            for name in ['inv_dy', 'inv_dyg', 'inv_dym', 'kxx', 'kzz', 'DD', 'bulk_weights']:
+                setattr(grid, name, getattr(self, name).to(device))
+            grid.poisson = copy.copy(self.poisson).to(device)
+            grid.diffusion = copy.copy(self.diffusion).to(device)
+            grid.device, grid._copies = device, {}
+            self._copies[device] = grid
+        return self._copies[device]
+
+    def rhs(self, U, V, W, nu, dPdx):
+        return compute_rhs(U, V, W, nu, dPdx, self.dx, self.dz, self.inv_dy, self.inv_dyg, self.inv_dym)
+
+    def lap_y(self, U, V, W):
+        return compute_lap_y(U, V, W, self.inv_dy, self.inv_dyg, self.inv_dym)
+
+    def div(self, U, V, W):
+        return compute_div(U, V, W, self.dx, self.dz, self.inv_dy)
+
+    def project(self, U, V, W):
+        p = self.poisson.solve(self.div(U, V, W))
+        return apply_pressure_gradient(U, V, W, p, self.dx, self.dz, self.inv_dym)
+
+    def bulk_velocity(self, U):
+        profile = U[..., 1:-1, :].mean(dim=(X_DIM, Z_DIM))
+        return (profile * self.bulk_weights).sum(-1) / 2
+
+    def all_reduce(self, t, op='sum'):
+        # the whole field is local, see DistributedChannelGrid.all_reduce
+        return t
@@ -0,0 +1,73 @@
+import torch
+
+# pressure levels read by the wall sensors: the two cells next to the bottom and the top wall
+WALL_LEVELS = [0, 1, -2, -1]
+
+
+class ChannelPoissonSolver:
+    """
+    Direct solver for the pressure Poisson equation of the channel.
+    x and z are periodic and handled with FFTs, y uses the tridiagonal operator DD.
+    For every wavenumber pair the y-system is D = DD + (kxx[i] + kzz[j]) * I, so one
+    eigendecomposition of DD diagonalizes all Nx * Nz systems at once.
+    DD = H^-1 S with H = diag(y[j+1] - y[j]) and S symmetric, hence the similarity
+    transform H^1/2 DD H^-1/2 is symmetric and eigh can be used.
+    The (0, 0) mode is singular and pinned by scaling D[0, 0] with 1.5 as in the matlab code;
+    it is solved separately with a precomputed inverse.
+    """
+    def __init__(self, DD, dy, kxx, kzz, dtype=torch.float64, device=None):
+        DD = torch.as_tensor(DD, dtype=dtype, device=device)
+        dy = torch.as_tensor(dy, dtype=dtype, device=device).reshape(-1)
+        kxx = torch.as_tensor(kxx, dtype=dtype, device=device).reshape(-1)
+        kzz = torch.as_tensor(kzz, dtype=dtype, device=device).reshape(-1)
+        self.Nx, self.Nz, self.n = len(kxx), len(kzz), DD.shape[0]
+        self.dtype, self.device = dtype, DD.device
+
+        h_sqrt = dy.sqrt()
+        sym = h_sqrt[:, None] * DD / h_sqrt[None, :]
+        sym = 0.5 * (sym + sym.T)  # remove round-off asymmetry
+        eig_val, eig_vec = torch.linalg.eigh(sym)
+        self.eig_val = eig_val
+        self.left = eig_vec / h_sqrt[:, None]     # H^-1/2 V
+        self.right = eig_vec.T * h_sqrt[None, :]  # V^T H^1/2
+
+        # only the non-negative z wavenumbers are kept since the pressure is real (rfft)
+        kk = kxx[:, None] + kzz[None, :self.Nz // 2 + 1]
+        denom = eig_val[None, :, None] + kk[:, None, :]
+        denom[0, :, 0] = 1.0  # overwritten by the direct solve of the mean mode
+        self.inv_denom = 1.0 / denom
+
+        D00 = DD.clone()
+        D00[0, 0] = 1.5 * D00[0, 0]
+        self.mean_mode_inv = torch.linalg.inv(D00)
+
+    def to(self, device=None, dtype=None):
+        dtype = self.dtype if dtype is None else dtype
+        for name in ['eig_val', 'left', 'right', 'inv_denom', 'mean_mode_inv']:
+            setattr(self, name, getattr(self, name).to(device=device, dtype=dtype))
+        self.dtype, self.device = dtype, self.left.device
+        return self
+
+    def solve_hat(self, rhs_hat, levels=None):
+        """
+        Solve in Fourier space. rhs_hat: [..., Nx, Ny-1, Nz//2+1] complex (rfft along z).
+        levels: optional list of y indices, only these rows of p_hat are formed.
+        """
+        left, mean_mode_inv = self.left, self.mean_mode_inv
+        if levels is not None:
+            left, mean_mode_inv = left[levels], mean_mode_inv[levels]
+        rhs = torch.view_as_real(rhs_hat)  # [..., Nx, n, Nzr, 2]
+        p_hat = torch.einsum('ij,...xjzc->...xizc', self.right, rhs)
+        p_hat = p_hat * self.inv_denom[..., None]
+        p_hat = torch.einsum('ij,...xjzc->...xizc', left, p_hat)
+        p_hat[..., 0, :, 0, :] = torch.einsum('ij,...jc->...ic', mean_mode_inv, rhs[..., 0, :, 0, :])
+        return torch.view_as_complex(p_hat.contiguous())
+
+    def solve(self, rhs, levels=None):
+        """
+        rhs: [..., Nx, Ny-1, Nz] real field at the cell centers, returns p of the same shape,
+        or [..., Nx, len(levels), Nz] when only some y levels are needed (e.g. the wall sensors).
+        """
+        rhs_hat = torch.fft.rfft2(rhs, dim=(-3, -1))
+        p_hat = self.solve_hat(rhs_hat, levels=levels)
+        return torch.fft.irfft2(p_hat, s=(self.Nx, self.Nz), dim=(-3, -1))
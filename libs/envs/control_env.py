@@ -1,30 +1,24 @@
+import collections
 import wandb
-import matlab.engine
 from libs.utilities3 import *
 from libs.visualization import *
 from sklearn.metrics import mean_squared_error
-from libs.env_util import to_m, relative_loss, apply_periodic_boundary
+from libs.env_util import to_m, relative_loss, apply_periodic_boundary, cached_on_state, get_matlab_engine
+from libs.envs.channel_ops import ChannelGrid, TIME_INTEGRATORS, cfl_time_step, rollout, wall_shear_stress
+from libs.envs.channel_diagnostics import ChannelDiagnostics, METRIC_KEYS
+from libs.envs.channel_poisson import WALL_LEVELS
+from libs.envs.init_cache import InitStateCache, file_hash
+from libs.envs.snapshot import write_snapshot, read_snapshot, is_snapshot
 from pympler import muppy, summary
 
 
-def apply_boundary_condition(U, V, W, Vw1, Vw2):
-    U[:, 0, :] = -U[:, 1, :]
-    U[:, -1, :] = -U[:, -2, :]
-    
-    V[:, 0, :] = Vw1
-    V[:, -1, :] = Vw2
-    
-    W[:, 0, :] = -W[:, 1, :]
-    W[:, -1, :] = -W[:, -2, :]
-    return U, V, W
-   
-
 class NSControlEnvMatlab:
     def __init__(self, args):
         self.args = args
         self.Re = args.Re
-        self.nu = 3.076923076923077e-04
+        self.default_nu = 3.076923076923077e-04
         self.default_re = 178.1899
+        self.nu = self.default_nu
         if self.Re > 0:
             self.nu = self.nu * (self.default_re / self.Re)
         self.control_timestep = args.control_timestep
@@ -32,18 +26,49 @@ class NSControlEnvMatlab:
         self.test_plane = args.test_plane
         self.w_weight = args.w_weight
         self.bc_type = args.bc_type
-        print("Lauching matlab...")
-        self.eng = matlab.engine.start_matlab()
-        self.eng.addpath("./libs/matlab_codes")
-        print("Lauching finished!")
-        self.load_state(load_path=args.init_cond_path)
-        # dummy code of dump and load functions
-        save_path = './outputs/stable_flow.npy'
-        self.dump_state(save_path=save_path)
-        self.load_state(load_path=save_path)
+        # the grid constants and U/V/W live as tensors on this device, numpy views are made on demand
+        self.device = torch.device(getattr(args, 'env_device', 'cpu'))
+        self.dtype = torch.float64
+        # bumped whenever U/V/W change, invalidates the memoized pressure/divergence/bulk/shear
+        self.state_version = 0
+        # python: torch RK3 (default), matlab: libs/matlab_codes/time_advance_RK3.m, distributed: see channel_distributed
+        self.solver_backend = getattr(args, 'solver_backend', 'python')
+        # distributed: U/V/W are x slabs of the torchrun processes once the env is initialized (distribute_state)
+        self.distributed_grid = None
+        self.rank = 0
+        if self.solver_backend == 'distributed':
+            from libs.envs.channel_distributed import init_distributed
+            self.rank = init_distributed()[0]
+        # wall: the observations only inverse transform the wall layers, full: the whole pressure volume
+        self.pressure_observation = getattr(args, 'pressure_observation', 'wall')
+        # rk3: fully explicit, imex_rk3: implicit wall-normal diffusion; adaptive_dt picks dt from the cfl number
+        self.time_integrator = getattr(args, 'time_integrator', 'rk3')
+        self.adaptive_dt = getattr(args, 'adaptive_dt', False)
+        self.cfl = getattr(args, 'cfl', 0.5)
+        self.dt_max = getattr(args, 'dt_max', None)
+        # steps per recomputed segment of differentiable_rollout, 0 stores the whole graph
+        self.rollout_checkpoint_steps = getattr(args, 'rollout_checkpoint_steps', 1)
+        # in-memory ring of the states before the last snapshot_ring steps, used by rollback
+        ring_size = getattr(args, 'snapshot_ring', 0)
+        self.snapshot_ring = collections.deque(maxlen=ring_size) if ring_size > 0 else None
+        # converged initial states and their info_init are reused across runs when init_cache_dir is set
+        init_cache_dir = getattr(args, 'init_cache_dir', None)
+        self.init_cache = InitStateCache(init_cache_dir) if init_cache_dir else None
+        cached = None
+        if self.init_cache is not None:
+            self.init_cache_key = self.init_cache.key(env='NSControlEnvMatlab', init_cond=file_hash(args.init_cond_path),
+                                                      nu=self.nu, dtype=str(self.dtype))
+            cached = self.init_cache.load(self.init_cache_key)
+        if cached is None:
+            self.load_state(load_path=args.init_cond_path)
+            # dummy code of dump and load functions, one file per torchrun process
+            save_path = './outputs/stable_flow.npy' if self.rank == 0 else f'./outputs/stable_flow_rank{self.rank}.npy'
+            scalars = {'dPdx': self.dPdx, 'dt': self.dt}
+            self.dump_state(save_path=save_path)
+            self.load_state(load_path=save_path, meta=scalars)
+        else:
+            self.set_state_data(cached[0], meta=cached[1])
         self.v_scale, self.w_scale = 10, 10
-        self.V = self.V
-        self.W = self.W
         self.U_gt = self.U.copy()
         self.V_gt = self.V.copy()
         self.W_gt = self.W.copy()
@@ -75,45 +100,110 @@ class NSControlEnvMatlab:
 
         self.DD[0, 0] += 1 / (self.y[1] - self.y[0]) / (self.yg[1] - self.yg[0])
         self.DD[-1, -1] += 1 / (self.y[self.Ny-1] - self.y[self.Ny-2]) / (self.yg[self.Ny] - self.yg[self.Ny-1])
+        # metrics, wavenumbers and the factorized Poisson operator, built once
+        self.grid = ChannelGrid(self.dx, self.dz, self.y, self.ym, self.yg, self.kxx, self.kzz, self.DD,
+                                dtype=self.dtype, device=self.device)
+        # info metrics of step(), evaluated every diagnostics_interval steps only
+        self.diagnostics = ChannelDiagnostics(self.grid, self.y, metrics=getattr(args, 'diagnostics_metrics', None),
+                                              log_interval=getattr(args, 'diagnostics_interval', 1))
+        self.num_steps = 0
         
         '''
         Calculate initialized variables
         '''
         
-        self.meanU0 = self.cal_bulk_v()
-        print(f"Initially, the divergence is {self.reward_div()}.")
-        init_p = self.cal_pressure()
         # Used in normalization
         self.speed_min = min(self.U.min(), self.V.min(), self.W.min())
         self.speed_max = max(self.U.max(), self.V.max(), self.W.max())
-        self.p_min = max(-2.0, init_p.min())
-        self.p_max = min(init_p.max(), 1.5)
-        self.info_init = self.fill_info_init()
+        if cached is not None:
+            init_values = cached[1]
+            self.meanU0, self.p_min, self.p_max = init_values['meanU0'], init_values['p_min'], init_values['p_max']
+            self.info_init = init_values['info_init']
+            print(f"Initial state loaded from {self.init_cache.path(self.init_cache_key)}.")
+        else:
+            self.meanU0 = self.cal_bulk_v()
+            print(f"Initially, the divergence is {self.reward_div()}.")
+            init_p = self.cal_pressure()
+            self.p_min = max(-2.0, init_p.min())
+            self.p_max = min(init_p.max(), 1.5)
+            self.info_init = self.fill_info_init()
+            if self.init_cache is not None and self.rank == 0:
+                init_values = {'meanU0': self.meanU0, 'p_min': self.p_min, 'p_max': self.p_max, 'info_init': self.info_init,
+                               'dPdx': self.dPdx, 'dt': self.dt}
+                self.init_cache.save(self.init_cache_key, self.state_data(), init_values)
+        if self.solver_backend == 'distributed':
+            self.distribute_state()
     
+    ################################################################
+    # velocity state, kept as tensors on self.device
+    # assign to U/V/W (or call bump_state) after editing the numpy views in place
+    # distributed: _U/_V/_W are the local x slabs, U/V/W gather the whole fields (a copy, assign to change
+    # the state) and every rank has to make the same calls
+    ################################################################
+
+    def bump_state(self):
+        self.state_version += 1
+
+    @property
+    def solver_grid(self):
+        return self.grid if self.distributed_grid is None else self.distributed_grid
+
+    def full_field(self, f):
+        # the whole [Nx, ...] field of a state tensor
+        return f if self.distributed_grid is None else self.distributed_grid.gather(f)
+
+    def local_field(self, value):
+        # the state tensor of a whole field, the slab of this rank when distributed
+        f = torch.as_tensor(value, dtype=self.dtype, device=self.device)
+        if self.distributed_grid is not None:
+            f = self.distributed_grid.split(f)
+        return f.clone()
+
+    def distribute_state(self):
+        # from here on only the x slabs are kept, the gt fields of reward_gt included
+        from libs.envs.channel_distributed import DistributedChannelGrid
+        self.distributed_grid = DistributedChannelGrid(self.grid)
+        self._U, self._V, self._W = [self.local_field(f) for f in (self._U, self._V, self._W)]
+        self.U_gt, self.V_gt, self.W_gt = [self.local_field(f).cpu().numpy() for f in (self.U_gt, self.V_gt, self.W_gt)]
+        self.diagnostics.grid = self.distributed_grid
+        self.bump_state()
+
+    def gather_planes(self, f, index):
+        # y planes [Nx, len(index), Nz] of a state tensor, only these planes are gathered from the slabs
+        return self.full_field(f[:, index, :]).detach().cpu().numpy()
+
+    @property
+    def U(self):
+        return self.full_field(self._U).detach().cpu().numpy()
+
+    @U.setter
+    def U(self, value):
+        self._U = self.local_field(value)
+        self.bump_state()
+
+    @property
+    def V(self):
+        return self.full_field(self._V).detach().cpu().numpy()
+
+    @V.setter
+    def V(self, value):
+        self._V = self.local_field(value)
+        self.bump_state()
+
+    @property
+    def W(self):
+        return self.full_field(self._W).detach().cpu().numpy()
+
+    @W.setter
+    def W(self, value):
+        self._W = self.local_field(value)
+        self.bump_state()
+
     def fill_info_init(self):
+        # every metric is kept so that any enabled subset has its relative value
         p1, p2 = self.get_boundary_pressures()
-        div = self.reward_div()
-        dpdx_finite_difference = self.cal_dpdx_finite_difference(p2)
-        u_velocity = self.cal_bulk_v()
-        v_velocity = self.cal_velocity_mean('V', sample_index=None)
-        w_velocity = self.cal_velocity_mean('W', sample_index=None)
-        pressure_mean = p2.mean()
-        gt_diff = self.reward_gt()
-        speed_norm = self.cal_speed_norm()
-        shear_stress = self.cal_shear_stress()
-        done = False
-        info = {
-                'drag_reduction/1_shear_stress': shear_stress,
-                'drag_reduction/2_1_mass_flow': u_velocity,
-                'drag_reduction/2_2_v_velocity': v_velocity,
-                'drag_reduction/2_3_w_velocity': w_velocity,
-                'drag_reduction/3_1_pressure_mean': pressure_mean,
-                'drag_reduction/3_2_dPdx_finite_difference': dpdx_finite_difference,
-                'drag_reduction/3_3_dPdx_reverse_cal': self.dPdx,
-                'drag_reduction/4_1_-|divergence|': div, 
-                'drag_reduction/4_2_-|now - unnoised| ÷ ｜now|': gt_diff, 
-                'drag_reduction/4_4_speed_norm': speed_norm,
-                }
+        info = self.cal_info(p2, self.reward_div(), metrics=list(METRIC_KEYS))
+        info['drag_reduction/4_2_-|now - unnoised| ÷ ｜now|'] = self.reward_gt()
         return info
         
     def add_random_noise(self, noise_scale, overwrite=False):
@@ -131,8 +221,8 @@ class NSControlEnvMatlab:
     # save and load state
     ################################################################
 
-    def dump_state(self, save_path):
-        mat_data = {
+    def state_data(self):
+        return {
             'x': np.array(self.x),
             'y': np.array(self.y),
             'z': np.array(self.z),
@@ -143,12 +233,25 @@ class NSControlEnvMatlab:
             'V': np.array(self.V),
             'W': np.array(self.W),
         }
-        scipy.io.savemat(save_path, mat_data)
+
+    def dump_state(self, save_path):
+        mat_data = self.state_data()
+        # distributed: every rank gathers the state, rank 0 writes it
+        if self.distributed_grid is None or self.rank == 0:
+            scipy.io.savemat(save_path, mat_data)
         return
     
-    def load_state(self, load_path='./data/channel180_minchan.mat'):
-        # Load the .mat file
-        mat_data = scipy.io.loadmat(load_path, mat_dtype=True)
+    def load_state(self, load_path='./data/channel180_minchan.mat', meta=None):
+        # meta: dPdx / dt of the state, a raw snapshot brings its own (save_snapshot)
+        if is_snapshot(load_path):
+            mat_data, saved_meta = read_snapshot(load_path, mmap_mode=None)
+            meta = saved_meta if meta is None else meta
+        else:
+            # Load the .mat file
+            mat_data = scipy.io.loadmat(load_path, mat_dtype=True)
+        self.set_state_data(mat_data, meta=meta)
+
+    def set_state_data(self, mat_data, meta=None):
         # Access the fields
         self.x = mat_data['x']
         self.y = mat_data['y']
@@ -158,8 +261,9 @@ class NSControlEnvMatlab:
         self.zm = mat_data['zm']
         
         # Global variables
-        self.dPdx = 0.57231059E-01**2  # pressure gradient (utau^2)
-        self.dt = 0.001  # time step
+        meta = meta or {}
+        self.dPdx = float(meta.get('dPdx', 0.57231059E-01**2))  # pressure gradient (utau^2)
+        self.dt = float(meta.get('dt', 0.001))  # time step
         self.dx = self.x[1] - self.x[0]
         self.dz = self.z[1] - self.z[0]
         self.yg = np.concatenate(([-self.ym[0]], self.ym, [2 + self.ym[0]]))
@@ -179,64 +283,92 @@ class NSControlEnvMatlab:
             self.V = mat_data['V']
             self.W = mat_data['W']
 
+    ################################################################
+    # snapshots and rollback
+    ################################################################
+
+    def snapshot(self):
+        return {'U': self._U.clone(), 'V': self._V.clone(), 'W': self._W.clone(),
+                'dPdx': self.dPdx, 'dt': self.dt, 'num_steps': self.num_steps}
+
+    def restore(self, snap):
+        self._U, self._V, self._W = [torch.as_tensor(snap[k], dtype=self.dtype, device=self.device).clone()
+                                     for k in ['U', 'V', 'W']]
+        self.dPdx, self.dt, self.num_steps = float(snap['dPdx']), float(snap['dt']), int(snap['num_steps'])
+        self.bump_state()
+
+    def push_snapshot(self):
+        if self.snapshot_ring is not None:
+            self.snapshot_ring.append(self.snapshot())
+
+    def rollback(self, steps=1):
+        """
+        Go back to the state before the last `steps` steps, the newer ring entries are dropped.
+        Returns False if the ring does not reach that far back.
+        """
+        if self.snapshot_ring is None or len(self.snapshot_ring) < steps:
+            return False
+        for _ in range(steps - 1):
+            self.snapshot_ring.pop()
+        self.restore(self.snapshot_ring.pop())
+        return True
+
+    def reduce_time_step(self, dt, factor=0.5):
+        # retry after a rollback with factor times the dt used before it (the cfl number when dt is adaptive)
+        if self.adaptive_dt:
+            self.cfl *= factor
+        else:
+            self.dt = dt * factor
+
+    def save_snapshot(self, save_path):
+        # raw float64 dump, <save_path>.bin/.json, loadable with load_snapshot or as init_cond_path
+        meta = {'dPdx': self.dPdx, 'dt': self.dt, 'num_steps': self.num_steps, 'Re': self.Re}
+        arrays = self.state_data()
+        if self.distributed_grid is None or self.rank == 0:
+            write_snapshot(save_path, arrays, meta)
+
+    def load_snapshot(self, load_path):
+        arrays, meta = read_snapshot(load_path, mmap_mode=None)
+        self.restore({**{k: self.local_field(arrays[k]) for k in ['U', 'V', 'W']}, **meta})
+
     ################################################################
     # calculating scores
     ################################################################
 
+    @cached_on_state
     def cal_div(self):
-        div = np.zeros((self.Nx, self.Ny - 1, self.Nz))
-        for j in range(self.Ny - 1):
-            ux = (np.concatenate([self.U[1:, j + 1, :], self.U[0, j + 1, :][np.newaxis, :]], axis=0) - self.U[:, j + 1, :]) / self.dx
-            uy = (self.V[:, j + 1, :] - self.V[:, j, :]) / (getattr(self, 'y')[j + 1] - getattr(self, 'y')[j])
-            uz = (np.concatenate([self.W[:, j + 1, 1:], self.W[:, j + 1, 0][:, np.newaxis]], axis=-1) - self.W[:, j + 1, :]) / self.dz
-            div[:, j, :] = ux + uy + uz
-        div = np.array(div)
+        U, W = self.U[:, 1:-1, :], self.W[:, 1:-1, :]
+        ux = (np.roll(U, -1, axis=0) - U) / self.dx
+        uy = (self.V[:, 1:, :] - self.V[:, :-1, :]) / (self.y[1:] - self.y[:-1])
+        uz = (np.roll(W, -1, axis=-1) - W) / self.dz
+        div = ux + uy + uz
         return div
 
-    def compute_pressure_py(self,):
-        U, V, W, dt = torch.tensor(self.U), torch.tensor(self.V), torch.tensor(self.W), self.dt
-        RHS_u, RHS_v, RHS_w = self.compute_rhs_py(U, V, W, dPdx=None)
-        dx = torch.tensor(self.dx)
-        dz = torch.tensor(self.dz)
-        ym = torch.tensor(self.ym)
-        y = torch.tensor(self.y)
-        kxx = torch.tensor(self.kxx)
-        kzz = torch.tensor(self.kzz)
-        DD = torch.tensor(self.DD)
-        Nx, Ny, Nz, dPdx, meanU0 = self.Nx, self.Ny, self.Nz, self.dPdx, self.meanU0
-        
-        # Compute divergence
-        RHS_p = torch.zeros((Nx, Ny - 1, Nz), dtype=U.dtype, device=U.device)
-        for j in range(Ny - 1):
-            ux = (torch.cat([RHS_u[1:, j + 1, :], RHS_u[0, j + 1, :][None, :]], dim=0) - RHS_u[:, j + 1, :]) / dx
-            uy = (RHS_v[:, j + 1, :] - RHS_v[:, j, :]) / (y[j + 1] - y[j])
-            uz = (torch.cat([RHS_w[:, j + 1, 1:], RHS_w[:, j + 1, 0][:, None]], dim=-1) - RHS_w[:, j + 1, :]) / dz
-            RHS_p[:, j, :] = ux + uy + uz
-        
-        # Fourier transform and solve Poisson equasions
-        rhs_p_hat = torch.fft.fft(torch.fft.fft(RHS_p, dim=2), dim=0)
-        for i in range(Nx):
-            for j in range(Nz):
-                kk = kxx[i] + kzz[j]
-                D = DD + torch.eye(Ny-1) * kk
-
-                if i == 0 and j == 0:
-                    D[0, 0] = 1.5 * D[0, 0]
-                target = torch.complex(D, torch.zeros_like(D))
-                original_p = rhs_p_hat[i, :, j]
-                rhs_p_hat[i,:,j] = torch.linalg.solve(target, original_p)
-        P = torch.real(torch.fft.ifft(torch.fft.ifft(rhs_p_hat, dim=0), dim=2))
+    def compute_pressure_py(self, levels=None):
+        RHS_u, RHS_v, RHS_w = self.compute_rhs_py(self._U, self._V, self._W, dPdx=None)
+        # Compute divergence, Fourier transform and solve Poisson equasions
+        if self.distributed_grid is not None:
+            # solved on the slabs, only the requested levels are gathered
+            grid = self.distributed_grid
+            return grid.gather(grid.solve_pressure(grid.div(RHS_u, RHS_v, RHS_w), levels=levels))
+        P = self.grid.poisson.solve(self.grid.div(RHS_u, RHS_v, RHS_w), levels=levels)
         return P
 
+    @cached_on_state
     def cal_pressure(self,):
         # # this is the observation function
         # self.P  = self.eng.compute_pressure(to_m(self.U), to_m(self.V), to_m(self.W), to_m(self.nu), to_m(self.dPdx), to_m(self.y), to_m(self.ym), \
         #     to_m(self.yg), to_m(self.dx), to_m(self.dz), to_m(self.kxx), to_m(self.kzz), to_m(self.Nx), to_m(self.Ny), to_m(self.Nz), to_m(self.DD))
         # self.P = np.array(self.P)
         P_py = self.compute_pressure_py()
-        self.P = P_py.numpy()
+        self.P = P_py.cpu().numpy()
         return self.P
 
+    @cached_on_state
+    def cal_wall_pressure(self):
+        # only the two cell layers next to each wall, [Nx, 4, Nz]
+        return self.compute_pressure_py(levels=WALL_LEVELS).cpu().numpy()
+
     def cal_dpdx_finite_difference(self, pressure_top):
         grad_total, num = 0, 0
         for select_index in range(pressure_top.shape[0] - 1):
@@ -258,6 +390,7 @@ class NSControlEnvMatlab:
 
         return meanU
     
+    @cached_on_state
     def cal_bulk_v(self):
         meanU = self.calculate_meanU(self.ym, self.U)
         meanU = np.array(meanU).item()
@@ -283,12 +416,14 @@ class NSControlEnvMatlab:
     
     def cal_dudy(self, ):
         dudy_all = []
-        for select_index in range(self.U.shape[1] - 2):
-            dudy = (self.U[:, select_index + 1, :] - self.U[:, select_index, :]) / \
+        U = self.U
+        for select_index in range(U.shape[1] - 2):
+            dudy = (U[:, select_index + 1, :] - U[:, select_index, :]) / \
             (self.y[select_index + 1][0] - self.y[select_index][0])
             dudy_all.append(dudy)
         return dudy_all
     
+    @cached_on_state
     def cal_shear_stress(self, ):
         # -u*v + nu * (dU/dy)
         wall_u = self.U[:, -1, :]
@@ -302,18 +437,32 @@ class NSControlEnvMatlab:
         shear_stress_res = abs(shear_stress_mean)
         return shear_stress_res
     
+    @cached_on_state
+    def cal_div_sum(self):
+        if self.distributed_grid is not None:
+            grid = self.distributed_grid
+            return grid.all_reduce(grid.div(self._U, self._V, self._W).sum()).item()
+        return np.sum(self.cal_div())
+
     def reward_div(self, bound=-100):
-        div = self.cal_div()
-        reward = - abs(np.sum(div))
+        reward = - abs(self.cal_div_sum())
         if reward < bound:
             reward = bound
         return reward
 
     def reward_gt(self, bound=-100):
         reward = 0
-        reward -= relative_loss(self.U_gt.flatten(), self.U.flatten())
-        reward -= relative_loss(self.V_gt.flatten(), self.V.flatten())
-        reward -= relative_loss(self.W_gt.flatten(), self.W.flatten())
+        if self.distributed_grid is not None:
+            # relative_loss of the whole fields from the squared norms of the slabs
+            fields = [f.detach().cpu().numpy() for f in (self._U, self._V, self._W)]
+            sq = torch.tensor([[np.sum((gt - f)**2), np.sum(gt**2)]
+                               for gt, f in zip([self.U_gt, self.V_gt, self.W_gt], fields)], dtype=self.dtype)
+            sq = self.distributed_grid.all_reduce(sq.to(self.device)).sqrt()
+            reward -= (sq[:, 0] / sq[:, 1]).sum().item()
+        else:
+            reward -= relative_loss(self.U_gt.flatten(), self.U.flatten())
+            reward -= relative_loss(self.V_gt.flatten(), self.V.flatten())
+            reward -= relative_loss(self.W_gt.flatten(), self.W.flatten())
         if reward < bound:
             reward = bound
         return reward
@@ -327,6 +476,9 @@ class NSControlEnvMatlab:
             reward = bound
         return reward
 
+    def cal_info(self, p2, div, metrics=None):
+        return self.diagnostics.compute(self._U, self._V, self._W, p2, self.dPdx, self.nu, div=div, metrics=metrics)
+
     def cal_relative_info(self, info):
         if self.info_init is None:
             assert "self.info_init must be initialized when env is created!"
@@ -345,12 +497,14 @@ class NSControlEnvMatlab:
     
     def vis_state(self, vis_img=False, sample_slice_top=15, sample_slice_others=10):
         pressure = self.cal_pressure()
-        cut_dim = self.U.shape[0]
+        # gathered once, every self.U is a gather in distributed mode
+        U, V, W = self.U, self.V, self.W
+        cut_dim = U.shape[0]
         # get front view
         mid_index = pressure.shape[2] // sample_slice_others
         front_pressure = pressure[:, -cut_dim:, mid_index].transpose()
-        u_in_xy = self.U[:, -cut_dim:, mid_index].transpose() / 10000
-        v_in_xy = self.V[:, -cut_dim:, mid_index].transpose()
+        u_in_xy = U[:, -cut_dim:, mid_index].transpose() / 10000
+        v_in_xy = V[:, -cut_dim:, mid_index].transpose()
         front_view = visualize_pressure_speed(front_pressure, pressure_min=-0.01, pressure_max=0.01, \
             speed_horizontal=u_in_xy, speed_vertical=v_in_xy, vis_img=vis_img, vis_name='front', quiver_scale=0.03, \
             x_sample_interval=2, y_sample_interval=2, v_flip=False)
@@ -359,16 +513,16 @@ class NSControlEnvMatlab:
         # get top view
         mid_index = pressure.shape[1] // sample_slice_top
         top_pressure = np.squeeze(-0.5 * (pressure[:, -1, :] + pressure[:, -2, :]))
-        u_in_xz = self.U[:, -mid_index, :] - self.U[:, -mid_index, :].mean()
-        w_in_xz = self.W[:, -mid_index, :]
+        u_in_xz = U[:, -mid_index, :] - U[:, -mid_index, :].mean()
+        w_in_xz = W[:, -mid_index, :]
         top_view = visualize_pressure_speed(top_pressure, pressure_min=-0.03, pressure_max=0.03, \
             speed_horizontal=u_in_xz, speed_vertical=w_in_xz, vis_img=vis_img, quiver_scale=0.05, vis_name='top',)
 
         # get side view
         sample_index = pressure.shape[0] // sample_slice_others
         side_pressure = pressure[sample_index, :cut_dim, :]
-        v_in_yz = self.V[sample_index, :cut_dim, :]
-        w_in_yz = self.W[sample_index, :cut_dim, :]
+        v_in_yz = V[sample_index, :cut_dim, :]
+        w_in_yz = W[sample_index, :cut_dim, :]
         side_view = visualize_pressure_speed(side_pressure, pressure_min=-0.005, pressure_max=0.005, \
             speed_horizontal=w_in_yz, speed_vertical=v_in_yz, vis_img=vis_img, vis_name='side', \
                 quiver_scale=0.03, x_sample_interval=2, y_sample_interval=2)
@@ -377,34 +531,45 @@ class NSControlEnvMatlab:
         return top_view, front_view, side_view
     
     def plot_spatial_distribution(self, step_index):
+        # distributed: called on every rank (the fields are gathered), rank 0 logs
         info = {}
         dudy_all = self.cal_dudy()
+        velocities = {'U': self.U, 'V': self.V, 'W': self.W}
         for chart_key in ['U', 'V', 'W', 'dudy']:
             cur_data = []
             for sample_index in range(30):
                 if chart_key in ['U', 'V', 'W']:
                     value_name = chart_key + "_velocity"
-                    value = self.cal_velocity_mean(chart_key, sample_index=-sample_index)
+                    # cal_velocity_mean(chart_key, sample_index=-sample_index) on the gathered fields
+                    value = abs(velocities[chart_key])[:, sample_index:, :].mean()
                 elif chart_key == 'dudy':
                     value_name = 'dudy'
                     value = np.mean(abs(dudy_all[-sample_index]))
                 else:
                     raise RuntimeError()
                 cur_data.append([sample_index, value])
-                
+            if self.rank != 0:
+                continue
+
             # Create a table with the columns to plot
             table = wandb.Table(data=cur_data, columns=["layer index", value_name])
 
             # Use the table to populate various custom charts
             line_plot = wandb.plot.line(table, x="layer index", y=value_name, title="y-aixs distribution of " + value_name)
             info['spatial_dist/' + str(step_index) + "/" + value_name] = line_plot
-        wandb.log(info)
+        if self.rank == 0:
+            wandb.log(info)
         return
     
     ################################################################
     # control policies
     ################################################################
     
+    @property
+    def eng(self):
+        # only rand_control and solver_backend: matlab start the engine
+        return get_matlab_engine()
+
     def reset_init(self):
         self.info_init = None
     
@@ -414,211 +579,113 @@ class NSControlEnvMatlab:
         return opV2
     
     def gt_control(self):
-        opV1 = - self.V[:, self.detect_plane, :]
-        opV1 = np.array(opV1)
-        opV2 = - self.V[:, -self.detect_plane, :]
-        opV2 = np.array(opV2)
+        planes = self.gather_planes(self._V, [self.detect_plane, -self.detect_plane])
+        opV1 = - planes[:, 0, :]
+        opV2 = - planes[:, 1, :]
         return opV1, opV2
 
     def get_boundary_pressures(self):
-        pressure = self.cal_pressure()                    # Next state after taking the action
+        if self.pressure_observation == 'wall':
+            pressure = self.cal_wall_pressure()
+        else:
+            pressure = self.cal_pressure()                    # Next state after taking the action
         p1 = np.squeeze(-0.5 * (pressure[:, 0, :] + pressure[:, 1, :]))
         p2 = np.squeeze(-0.5 * (pressure[:, -1, :] + pressure[:, -2, :]))
         return p1, p2
     
     def compute_rhs_py(self, U, V, W, dPdx=None):
-        ################################################################
-        # prepare variables
-        ################################################################
         if dPdx is None:
             dPdx = self.dPdx
-        dx = torch.tensor(self.dx).to(U.device)
-        dz = torch.tensor(self.dz).to(U.device)
-        yg = torch.tensor(self.yg).to(U.device)
-        y = torch.tensor(self.y).to(U.device)
-        ym = torch.tensor(self.ym).to(U.device)
-
-        ################################################################
-        # compute Fu
-        ################################################################
-    
-        # compute -d(uu)/dx
-        UU = (0.5 * (U + torch.cat([U[1:, :, :], U[0, :, :][None, :]], dim=0)))**2
-        Fu = - (UU - torch.cat([UU[-1, :, :][None, :], UU[:-1, :, :]], dim=0)) / dx
-        # compute -d(uv)/dy
-        UV = (0.5 * (V + torch.cat([V[-1, :, :][None, :], V[:-1, :, :]], dim=0))) * (0.5 * (U[:, :-1, :] + U[:, 1:, :]))
-        for i in range(1, self.Ny):
-            Fu[:, i, :] -= (UV[:, i, :] - UV[:, i-1, :]) / (y[i] - y[i-1])
-        
-        # compute -d(uw) / dz
-        UW = (0.5 * (W + torch.cat([W[-1, :, :][None, :, :], W[:-1, :, :]], dim=0))) * (0.5 * (U + torch.cat([U[:, :, -1][:, :, None], U[:, :, :-1]], dim=2)))
-        Fu -= (torch.cat([UW[:, :, 1:], UW[:, :, 0][:, :, None]], dim=2) - UW)  / dz
-        
-        # compute 1/Re*d^2u/dx^2
-        Fu += self.nu * (torch.cat([U[1:, :, :], U[0, :, :][None, :, :]], dim=0) - 2 * U + torch.cat([U[-1, :, :][None, :, :], U[:-1, :, :]], dim=0)) / dx**2
-        # compute 1/Re*d^2u/dy^2
-        for i in range(1, self.Ny):
-            Fu[:, i, :] += self.nu * (
-                (U[:, i + 1, :] - U[:, i, :]) / (yg[i + 1] - yg[i]) -
-                (U[:, i, :] - U[:, i - 1, :]) / (yg[i] - yg[i - 1])
-            ) / (y[i] - y[i - 1])
-
-        # compute 1/Re*d^2u/dz^2
-        Fu += self.nu * (torch.cat([U[:, :, 1:], U[:, :, 0][:, :, None]], dim=2) - 2 * U + torch.cat([U[:, :, -1][:, :, None], U[:, :, :-1]], dim=2)) / dz**2
-
-        # Add pressure gradient
-        Fu += dPdx / 2
-
-        ################################################################
-        # compute Fv
-        ################################################################
-        
-        # compute -d(uv)/dx
-        UV = (0.5 * (V + torch.cat([V[-1, :, :][None, :, :], V[:-1, :, :]], dim=0))) * (0.5 * (U[:, :-1, :] + U[:, 1:, :]))
-        Fv = - (torch.cat([UV[1:, :, :], UV[0, :, :][None, :, :]], dim=0) - UV) / dx
-
-        # compute -d(vv)/dy
-        VV = (0.5 * (V[:, :-1, :] + V[:, 1:, :]))**2
-        for i in range(1, self.Ny - 1):
-            Fv[:, i, :] -= (VV[:, i, :] - VV[:, i-1, :]) / (ym[i] - ym[i-1])
-
-        # compute -d(vw)/dz
-        VW = (0.5 * (V + torch.cat([V[:, :, -1][:, :, None], V[:, :, :-1]], dim=2))) * (0.5 * (W[:, :-1, :] + W[:, 1:, :]))
-        Fv -= (torch.cat([VW[:, :, 1:], VW[:, :, 0][:, :, None]], dim=2) - VW) / dz
-        
-        # compute nu*d^2v/dx^2
-        Fv += self.nu * (torch.cat([V[1:, :, :], V[0, :, :][None, :, :]], dim=0) - 2 * V + torch.cat([V[-1, :, :][None, :, :], V[:-1, :, :]], dim=0)) / dx**2
-
-        # compute nu*d^2v/dy^2
-        for i in range(1, self.Ny - 1):
-            Fv[:, i, :] += self.nu * (
-                (V[:, i + 1, :] - V[:, i, :]) / (y[i + 1] - y[i]) -
-                (V[:, i, :] - V[:, i - 1, :]) / (y[i] - y[i - 1])
-            ) / (ym[i] - ym[i - 1])
-
-        # compute nu*d^2w/dz^2
-        Fv += self.nu * (torch.cat([V[:, :, 1:], V[:, :, 0][:, :, None]], dim=2) - 2 * V + torch.cat([V[:, :, -1][:, :, None], V[:, :, :-1]], dim=2)) / dz**2
-        
-        ################################################################
-        # compute Fw
-        ################################################################
-        
-        # compute -d(uw)/dx
-        UW = (0.5 * (W + torch.cat([W[-1, :, :][None, :, :], W[:-1, :, :]], dim=0))) * (0.5 * (U + torch.cat([U[:, :, -1][:, :, None], U[:, :, :-1]], dim=-1)))
-        Fw = - (torch.cat([UW[1:, :, :], UW[0, :, :][None, :, :]], dim=0) - UW) / dx
-        # compute -d(vw)/dy
-        VW = (0.5 * (V + torch.cat([V[:, :, -1][:, :, None], V[:, :, :-1]], dim=-1))) * (0.5 * (W[:, :-1, :] + W[:, 1:, :]))
-        for i in range(1, self.Ny):
-            Fw[:, i, :] -= (VW[:, i, :]- VW[:, i-1, :]) / (y[i] - y[i - 1])
-
-        # compute -d(ww)/dz
-        WW = (0.5 * (W + torch.cat([W[:, :, 1:], W[:, :, 0][:, :, None]], dim=2)))**2
-        Fw -= (WW - torch.cat([WW[:, :, -1][:, :, None], WW[:, :, :-1]], dim=2)) / dz
-
-        # compute nu*d^2w/dx^2
-        Fw += self.nu * (torch.cat([W[1:, :, :], W[0, :, :][None, :, :]], dim=0) - 2 * W + torch.cat([W[-1, :, :][None, :, :], W[:-1, :, :]], dim=0)) / dx**2
-
-        # compute nu*d^2w/dy^2
-        for i in range(1, self.Ny):
-            Fw[:, i, :] += self.nu * (
-                (W[:, i + 1, :] - W[:, i, :]) / (yg[i + 1] - yg[i]) -
-                (W[:, i, :] - W[:, i - 1, :]) / (yg[i] - yg[i - 1])
-            ) / (y[i] - y[i - 1])
-
-        # compute nu*d^2w/dz^2
-        Fw += self.nu * (torch.cat([W[:, :, 1:], W[:, :, 0][:, :, None]], dim=-1) - 2 * W + torch.cat([W[:, :, -1][:, :, None], W[:, :, :-1]], dim=-1)) / dz**2
-        return Fu, Fv, Fw
+        if self.distributed_grid is not None:
+            return self.distributed_grid.rhs(U, V, W, self.nu, dPdx)
+        return self.grid.on(U.device).rhs(U, V, W, self.nu, dPdx)
     
 
+    @cached_on_state
+    def cal_rhs(self):
+        # du/dt of the current state, shared between data collection and the first RK3 stage
+        return self.compute_rhs_py(self._U, self._V, self._W)
+
     def time_advance_RK3_py(self, opV1, opV2):
         # tranfer data types
-        U0, V0, W0, dt = torch.tensor(self.U), torch.tensor(self.V), torch.tensor(self.W), self.dt
-        opV1, opV2 = torch.tensor(opV1), torch.tensor(opV2)
-        dx = torch.tensor(self.dx)
-        dz = torch.tensor(self.dz)
-        ym = torch.tensor(self.ym)
-        y = torch.tensor(self.y)
-        kxx = torch.tensor(self.kxx)
-        kzz = torch.tensor(self.kzz)
-        DD = torch.tensor(self.DD)
-        Nx, Ny, Nz, dPdx, meanU0 = self.Nx, self.Ny, self.Nz, self.dPdx, self.meanU0
-        
-        # 1st RK step
-        U, V, W = U0, V0, W0
-        Fu1, Fv1, Fw1 = self.compute_rhs_py(U, V, W, dPdx) 
-        U = U0 + dt * 8 / 15 * Fu1
-        V = V0 + dt * 8 / 15 * Fv1
-        W = W0 + dt * 8 / 15 * Fw1
-        U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
-        U, V, W = self.compute_projection_step(U, V, W, dx, dz, ym, y, kxx, kzz, Nx, Ny, Nz, DD)
-        U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
-        
-        # 2nd RK step
-        Fu2, Fv2, Fw2 = self.compute_rhs_py(U, V, W, dPdx)
-        U = U0 + dt * (1 / 4 * Fu1 + 5 / 12 * Fu2)
-        V = V0 + dt * (1 / 4 * Fv1 + 5 / 12 * Fv2)
-        W = W0 + dt * (1 / 4 * Fw1 + 5 / 12 * Fw2)
-        U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
-        U, V, W = self.compute_projection_step(U, V, W, dx, dz, ym, y, kxx, kzz, Nx, Ny, Nz, DD)
-        U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
-
-        # 3rd RK step
-        Fu3, Fv3, Fw3 = self.compute_rhs_py(U, V, W, dPdx)
-        U = U0 + dt * (1 / 4 * Fu1 + 3 / 4 * Fu3)
-        V = V0 + dt * (1 / 4 * Fv1 + 3 / 4 * Fv3)
-        W = W0 + dt * (1 / 4 * Fw1 + 3 / 4 * Fw3)
-        U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
-        U, V, W = self.compute_projection_step(U, V, W, dx, dz, ym, y, kxx, kzz, Nx, Ny, Nz, DD)
-        U, V, W = apply_boundary_condition(U, V, W, opV1, opV2)
-
-        # trapz equivalent in PyTorch
-        dPdx_pre = dPdx
-        meanU_now = self.calculate_meanU(self.ym, U.numpy())
-        dPdx = 2 * (meanU0 - meanU_now)
-        U[:, 1:-1, :] = U[:, 1:-1, :] + dPdx / 2
-        dPdx = 0.5 * (dPdx_pre + dPdx / dt)
-        return U, V, W, dPdx
+        opV1 = torch.as_tensor(opV1, dtype=self.dtype, device=self.device)
+        opV2 = torch.as_tensor(opV2, dtype=self.dtype, device=self.device)
+        time_advance = TIME_INTEGRATORS[self.time_integrator]
+        return time_advance(self.grid, self._U, self._V, self._W, opV1, opV2,
+                            self.nu, self.dPdx, self.meanU0, self.dt, rhs0=self.cal_rhs())
+
+    def cal_cfl_dt(self):
+        dt = cfl_time_step(self.solver_grid, self._U, self._V, self._W, self.nu, cfl=self.cfl,
+                           implicit_y=self.time_integrator == 'imex_rk3')
+        if self.dt_max is not None:
+            dt = min(dt, self.dt_max)
+        return dt
     
-    def compute_projection_step(self, U, V, W, dx, dz, ym, y, kxx, kzz, Nx, Ny, Nz, DD):
-        # Compute divergence of velocity field
-        p_matrix = torch.zeros((Nx, Ny - 1, Nz), dtype=U.dtype, device=U.device)
-        for j in range(Ny - 1):
-            ux = (torch.cat([U[1:, j + 1, :], U[0, j + 1, :][None, :]], dim=0) - U[:, j + 1, :]) / dx
-            uy = (V[:, j + 1, :] - V[:, j, :]) / (y[j + 1] - y[j])
-            uz = (torch.cat([W[:, j + 1, 1:], W[:, j + 1, 0][:, None]], dim=-1) - W[:, j + 1, :]) / dz
-            p_matrix[:, j, :] = ux + uy + uz
-
-        # Solve Poisson equation for p, Fourier transform first, then transform back
-        rhs_p_hat = torch.fft.fft(torch.fft.fft(p_matrix, dim=2), dim=0)
-        for i in range(Nx):
-            for j in range(Nz):
-                kk = kxx[i] + kzz[j]
-                D = DD + torch.eye(Ny-1) * kk
-
-                if i == 0 and j == 0:
-                    D[0, 0] = 1.5 * D[0, 0]
-                target = torch.complex(D, torch.zeros_like(D))
-                original_p = rhs_p_hat[i, :, j]
-                rhs_p_hat[i,:,j] = torch.linalg.solve(target, original_p)
-        p = torch.real(torch.fft.ifft(torch.fft.ifft(rhs_p_hat, dim=0), dim=2))
-        
-        # Apply fractional step
-        Uout = U.clone()
-        Vout = V.clone()
-        Wout = W.clone()
-        Uout[:, 1:-1, :] = Uout[:, 1:-1, :] - (p - torch.cat([p[-1, :, :][None, :, :], p[:-1, :, :]], dim=0)) / dx
-        for i in range(1, Ny-1):
-            Vout[:, i, :] = Vout[:, i, :] - (p[:, i, :] - p[:, i-1, :]) / (ym[i] - ym[i-1])
-        Wout[:, 1:-1, :] = Wout[:, 1:-1, :] - (p - torch.cat([p[:, :, -1][:, :, None], p[:, :, :-1]], dim=2)) / dz
+    def compute_projection_step(self, U, V, W):
+        # Compute divergence of velocity field, solve Poisson equation for p and apply fractional step
+        Uout, Vout, Wout = self.grid.project(U, V, W)
         return Uout, Vout, Wout
         
+    def time_advance_RK3_matlab(self, opV1, opV2):
+        U, V, W, dPdx = self.eng.time_advance_RK3(to_m(opV1), to_m(opV2), to_m(self.U), to_m(self.V), to_m(self.W), to_m(self.meanU0), to_m(self.nu), to_m(self.dPdx), \
+        to_m(self.y), to_m(self.ym), to_m(self.yg), to_m(self.dx), to_m(self.dz), to_m(self.dt), to_m(self.kxx), to_m(self.kzz), \
+            to_m(self.Nx), to_m(self.Ny), to_m(self.Nz), to_m(self.DD), nargout=4)
+        U, V, W = [torch.as_tensor(np.array(f), dtype=self.dtype, device=self.device) for f in (U, V, W)]
+        return U, V, W, torch.tensor(dPdx)
+
+    def time_advance_RK3_distributed(self, opV1, opV2):
+        # U/V/W stay the x slabs of every rank, only the controls are split
+        grid = self.distributed_grid
+        # the controls of rank 0, random policies draw different values on every rank
+        opV1, opV2 = [grid.split(grid.broadcast(torch.as_tensor(a, dtype=self.dtype, device=self.device)
+                                                .expand(self.Nx, self.Nz).clone()), dim=-2) for a in (opV1, opV2)]
+        time_advance = TIME_INTEGRATORS[self.time_integrator]
+        return time_advance(grid, self._U, self._V, self._W, opV1, opV2,
+                            self.nu, self.dPdx, self.meanU0, self.dt, rhs0=self.cal_rhs())
+
     def step_rk3(self, opV1, opV2):
-        Upy, Vpy, Wpy, dPdxpy = self.time_advance_RK3_py(opV1, opV2)
-        U, V, W, dPdx = Upy, Vpy, Wpy, dPdxpy
-        # U, V, W, dPdx = self.eng.time_advance_RK3(to_m(opV1), to_m(opV2), to_m(self.U), to_m(self.V), to_m(self.W), to_m(self.meanU0), to_m(self.nu), to_m(self.dPdx), \
-        # to_m(self.y), to_m(self.ym), to_m(self.yg), to_m(self.dx), to_m(self.dz), to_m(self.dt), to_m(self.kxx), to_m(self.kzz), \
-        #     to_m(self.Nx), to_m(self.Ny), to_m(self.Nz), to_m(self.DD), nargout=4)
-        self.U, self.V, self.W, self.dPdx = np.array(U), np.array(V), np.array(W), np.array(dPdx).item()
+        if self.adaptive_dt:
+            self.dt = self.cal_cfl_dt()
+        if self.solver_backend == 'matlab':
+            U, V, W, dPdx = self.time_advance_RK3_matlab(opV1, opV2)
+        elif self.solver_backend == 'python':
+            U, V, W, dPdx = self.time_advance_RK3_py(opV1, opV2)
+        elif self.solver_backend == 'distributed':
+            U, V, W, dPdx = self.time_advance_RK3_distributed(opV1, opV2)
+        else:
+            raise RuntimeError("Not supported solver backend!")
+        self._U, self._V, self._W, self.dPdx = U, V, W, dPdx.item()
+        self.bump_state()
+
+    def differentiable_rollout(self, opV2_seq, opV1_seq=None, checkpoint_steps=None):
+        """
+        len(opV2_seq) steps of the python solver from the current state, which is left unchanged.
+        opV1_seq/opV2_seq: [k, Nx, Nz] controls (tensors keep their graph), opV1 is zero by default.
+        Returns U, V, W, dPdx and the top wall shear stress averaged over the horizon, all differentiable
+        with respect to the controls. The RK stages are recomputed in the backward pass (see rollout).
+        """
+        if self.distributed_grid is not None:
+            raise RuntimeError("differentiable_rollout is not supported with solver_backend: distributed")
+        if checkpoint_steps is None:
+            checkpoint_steps = self.rollout_checkpoint_steps
+        opV2_seq = torch.as_tensor(opV2_seq, dtype=self.dtype, device=self.device)
+        if opV1_seq is None:
+            opV1_seq = torch.zeros_like(opV2_seq)
+        opV1_seq = torch.as_tensor(opV1_seq, dtype=self.dtype, device=self.device)
+        cost = lambda U, V, W, dPdx: wall_shear_stress(self.grid, U, V, self.nu)
+        U, V, W, dPdx, drag = rollout(self.grid, self._U, self._V, self._W, opV1_seq, opV2_seq, self.nu, self.dPdx,
+                                      self.meanU0, self.dt, integrator=TIME_INTEGRATORS[self.time_integrator],
+                                      cost=cost, checkpoint_steps=checkpoint_steps)
+        return U, V, W, dPdx, drag / len(opV2_seq)
+
+    def drag_gradient(self, opV2_seq, opV1_seq=None):
+        """
+        The horizon averaged shear stress of differentiable_rollout and its gradient w.r.t. opV2_seq (numpy).
+        """
+        opV2_seq = torch.tensor(np.asarray(opV2_seq), dtype=self.dtype, device=self.device, requires_grad=True)
+        drag = self.differentiable_rollout(opV2_seq, opV1_seq)[-1]
+        drag.backward()
+        return drag.item(), opV2_seq.grad.cpu().numpy()
 
     ################################################################
     # for physics informed learning
@@ -637,28 +704,17 @@ class NSControlEnvMatlab:
     ################################################################
     
     def step(self, opV1, opV2):
+        self.push_snapshot()
         self.step_rk3(opV1, opV2)
         p1, p2 = self.get_boundary_pressures()
-        u_velocity = self.cal_bulk_v()
         div = self.reward_div()
-        dpdx_finite_difference = self.cal_dpdx_finite_difference(p2)
-        v_velocity = self.cal_velocity_mean('V', sample_index=None)
-        w_velocity = self.cal_velocity_mean('W', sample_index=None)
-        pressure_mean = p2.mean()
-        speed_norm = self.cal_speed_norm()
-        shear_stress = self.cal_shear_stress()
         done = False
-        info = {
-                'drag_reduction/1_shear_stress': shear_stress,
-                'drag_reduction/2_1_mass_flow': u_velocity,
-                'drag_reduction/2_2_v_velocity': v_velocity,
-                'drag_reduction/2_3_w_velocity': w_velocity,
-                'drag_reduction/3_1_pressure_mean': pressure_mean,
-                'drag_reduction/3_2_dPdx_finite_difference': dpdx_finite_difference,
-                'drag_reduction/3_3_dPdx_reverse_cal': self.dPdx,
-                'drag_reduction/4_1_-|divergence|': div,
-                'drag_reduction/4_4_speed_norm': speed_norm,
-        }
+        # between two logging steps only the always-on metrics are reported
+        if self.diagnostics.due(self.num_steps):
+            info = self.cal_info(p2, div)
+        else:
+            info = {'drag_reduction/3_3_dPdx_reverse_cal': self.dPdx}
+        self.num_steps += 1
         norm_info = self.cal_relative_info(info)
         info.update(norm_info)
         return p2, div, done, info
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# part of every key, bump it when the meaning of the cached entries or of the key parts changes
+CACHE_FORMAT = 3
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def array_hash(a):
+    return hashlib.sha1(np.ascontiguousarray(a).tobytes()).hexdigest()
+
+
+class InitStateCache:
+    """
+    On-disk cache of converged initial states, one uncompressed .npz per key.
+    The key hashes everything the initial state depends on (grid, Re, forcing, initial condition file, solver
+    and stopping settings) and CACHE_FORMAT, the entry holds the state arrays and a json dict of scalars (e.g. info_init, dPdx and dt).
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(**parts):
+        parts = dict(parts, cache_format=CACHE_FORMAT)
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in data.files if k != '__info__'}
+            info = json.loads(str(data['__info__']))
+        return arrays, info
+
+    def save(self, key, arrays, info):
+        # write then rename, several workers may build the same entry
+        tmp_path = self.path(key) + f'.{os.getpid()}.tmp.npz'
+        info = json.dumps(info, default=float)
+        np.savez(tmp_path, __info__=np.array(info), **arrays)
+        os.replace(tmp_path, self.path(key))
@@ -0,0 +1,173 @@
+import numpy as np
+
+BC_TYPES = ('dirichlet', 'neumann', 'periodic')
+
+
+class _Level:
+    """
+    One grid of the hierarchy: the 5-point Laplacian on the interior unknowns [ny, nx] with ghost values
+    given by the walls (dirichlet: 0, neumann: copy of the first unknown, periodic: wrap).
+    """
+    def __init__(self, shape, hy, hx, bc):
+        self.shape, self.hy, self.hx, self.bc = shape, hy, hx, bc
+        ny, nx = shape
+        self.pad = np.zeros((ny + 2, nx + 2))
+        self.diag = np.full(shape, -2 / hx**2 - 2 / hy**2)
+        if bc[0] == 'neumann':
+            self.diag[0, :] += 1 / hy**2
+        if bc[1] == 'neumann':
+            self.diag[-1, :] += 1 / hy**2
+        if bc[2] == 'neumann':
+            self.diag[:, 0] += 1 / hx**2
+        if bc[3] == 'neumann':
+            self.diag[:, -1] += 1 / hx**2
+        iy, ix = np.indices(shape)
+        self.colors = [(iy + ix) % 2 == 0, (iy + ix) % 2 == 1]
+
+    def fill_ghosts(self, a):
+        buf = self.pad
+        buf[1:-1, 1:-1] = a
+        ghosts = [(buf[0, 1:-1], a[-1, :], a[0, :]), (buf[-1, 1:-1], a[0, :], a[-1, :]),
+                  (buf[1:-1, 0], a[:, -1], a[:, 0]), (buf[1:-1, -1], a[:, 0], a[:, -1])]
+        for kind, (ghost, wrapped, first) in zip(self.bc, ghosts):
+            if kind == 'periodic':
+                ghost[...] = wrapped
+            elif kind == 'neumann':
+                ghost[...] = first
+            else:
+                ghost[...] = 0.0
+        return buf
+
+    def apply(self, a):
+        buf = self.fill_ghosts(a)
+        return ((buf[1:-1, :-2] + buf[1:-1, 2:] - 2 * a) / self.hx**2 +
+                (buf[:-2, 1:-1] + buf[2:, 1:-1] - 2 * a) / self.hy**2)
+
+    def smooth(self, x, b, sweeps):
+        # red-black Gauss-Seidel, each color is one vectorized Jacobi update
+        for _ in range(sweeps):
+            for color in self.colors:
+                r = b - self.apply(x)
+                x[color] += r[color] / self.diag[color]
+        return x
+
+
+def _coarsen_kind(n, low, high):
+    # periodic axes halve an even count, wall axes keep every other unknown of an odd count
+    if low == 'periodic':
+        return 'periodic' if n % 2 == 0 and n >= 4 else None
+    return 'wall' if n % 2 == 1 and n >= 3 else None
+
+
+def _restrict(r, kind):
+    # full weighting along axis 0
+    if kind == 'periodic':
+        return 0.5 * r[::2] + 0.25 * (r[1::2] + np.roll(r[1::2], 1, axis=0))
+    if kind == 'wall':
+        return 0.5 * r[1::2] + 0.25 * (r[0:-1:2] + r[2::2])
+    return r
+
+
+def _prolong(c, kind, low, high):
+    # linear interpolation along axis 0, the coarse ghosts follow the walls
+    if kind == 'periodic':
+        f = np.empty((2 * c.shape[0],) + c.shape[1:])
+        f[::2] = c
+        f[1::2] = 0.5 * (c + np.roll(c, -1, axis=0))
+        return f
+    if kind == 'wall':
+        ghost_low = c[:1] if low == 'neumann' else np.zeros_like(c[:1])
+        ghost_high = c[-1:] if high == 'neumann' else np.zeros_like(c[-1:])
+        cp = np.concatenate([ghost_low, c, ghost_high], axis=0)
+        f = np.empty((2 * c.shape[0] + 1,) + c.shape[1:])
+        f[1::2] = c
+        f[0::2] = 0.5 * (cp[:-1] + cp[1:])
+        return f
+    return c
+
+
+class MultigridPoisson:
+    """
+    Geometric multigrid solver of lap(p) = b on a uniform 2D grid, for the pressure steps of
+    NSControlEnv2D (periodic x, neumann walls) and the lid-driven cavity (neumann walls, dirichlet lid).
+    shape: interior unknowns [ny, nx], bc: (y_low, y_high, x_low, x_high) in BC_TYPES, the ghost
+    values are the first-order wall conditions of the Jacobi loops (dirichlet 0, neumann copy).
+    V-cycles with red-black Gauss-Seidel smoothing, full weighting and linear interpolation.
+    The finer axis is coarsened while it can be halved (both on square grids), the coarsest grid is solved
+    with a dense pseudo inverse, so the work per cycle and the number of cycles stay linear in the grid size.
+    Without a dirichlet wall the problem is singular: b is projected on zero mean and the mean of x0 is kept.
+    """
+    def __init__(self, shape, dx, dy, bc=('neumann', 'neumann', 'periodic', 'periodic'),
+                 pre_sweeps=2, post_sweeps=2, max_direct=1024):
+        if any(kind not in BC_TYPES for kind in bc):
+            raise RuntimeError(f"Not supported boundary conditions: {bc}")
+        if (bc[0] == 'periodic') != (bc[1] == 'periodic') or (bc[2] == 'periodic') != (bc[3] == 'periodic'):
+            raise RuntimeError("Periodic boundary conditions come in pairs.")
+        self.bc = tuple(bc)
+        self.singular = 'dirichlet' not in bc
+        self.pre_sweeps, self.post_sweeps = pre_sweeps, post_sweeps
+
+        # hierarchy
+        self.levels, self.kinds = [_Level(tuple(shape), dy, dx, self.bc)], []
+        while True:
+            (ny, nx), hy, hx = self.levels[-1].shape, self.levels[-1].hy, self.levels[-1].hx
+            kind_y, kind_x = _coarsen_kind(ny, *bc[:2]), _coarsen_kind(nx, *bc[2:])
+            # only the finer axis is coarsened, point smoothing fails on strongly anisotropic grids
+            kind_y, kind_x = (kind_y if hy <= hx else None), (kind_x if hx <= hy else None)
+            if ny * nx <= 16 or (kind_y is None and kind_x is None):
+                break
+            if kind_y is not None:
+                ny, hy = ny // 2, 2 * hy
+            if kind_x is not None:
+                nx, hx = nx // 2, 2 * hx
+            self.kinds.append((kind_y, kind_x))
+            self.levels.append(_Level((ny, nx), hy, hx, self.bc))
+
+        # coarsest grid
+        coarse = self.levels[-1]
+        n = coarse.shape[0] * coarse.shape[1]
+        if n > max_direct:
+            raise RuntimeError(f"The coarsest grid {coarse.shape} is too large for a direct solve, "
+                               f"use grid sizes that can be halved (2^k + 1 points on walls, 2^k periodic).")
+        A = np.stack([coarse.apply(e.reshape(coarse.shape)).ravel() for e in np.eye(n)], axis=1)
+        self.coarse_inv = np.linalg.pinv(A)
+        self.cycles, self.residual = 0, None
+
+    def restrict(self, r, kinds):
+        return _restrict(_restrict(r, kinds[0]).T, kinds[1]).T
+
+    def prolong(self, c, kinds):
+        return _prolong(_prolong(c, kinds[0], *self.bc[:2]).T, kinds[1], *self.bc[2:]).T
+
+    def v_cycle(self, k, x, b):
+        level = self.levels[k]
+        if k == len(self.levels) - 1:
+            return (self.coarse_inv @ b.ravel()).reshape(level.shape)
+        level.smooth(x, b, self.pre_sweeps)
+        rc = self.restrict(b - level.apply(x), self.kinds[k])
+        if self.singular:
+            rc -= rc.mean()
+        x += self.prolong(self.v_cycle(k + 1, np.zeros_like(rc), rc), self.kinds[k])
+        return level.smooth(x, b, self.post_sweeps)
+
+    def solve(self, b, x0=None, tol=1e-8, max_cycles=50):
+        """
+        b, x0: interior arrays [ny, nx]. Stops when |b - lap(x)| <= tol |b|, the cycle count and
+        the relative residual are kept in self.cycles / self.residual.
+        """
+        b = np.array(b, dtype=np.float64)
+        x = np.zeros_like(b) if x0 is None else np.array(x0, dtype=np.float64)
+        if self.singular:
+            b -= b.mean()
+        level = self.levels[0]
+        norm_b = np.linalg.norm(b)
+        self.cycles, self.residual = 0, 0.0
+        while norm_b > 0 and self.cycles < max_cycles:
+            x = self.v_cycle(0, x, b)
+            self.cycles += 1
+            self.residual = np.linalg.norm(b - level.apply(x)) / norm_b
+            if self.residual <= tol:
+                break
+        if self.singular:
+            x += (0.0 if x0 is None else np.mean(x0)) - x.mean()
+        return x
@@ -1,5 +1,4 @@
 import wandb
-import matlab.engine
 from libs.utilities3 import *
 from libs.visualization import *
 import pdb
@@ -7,7 +6,10 @@ import copy
 import time
 import numpy as np
 from sklearn.metrics import mean_squared_error
-from libs.env_util import to_m, relative_loss, apply_periodic_boundary
+from libs.env_util import to_m, relative_loss, apply_periodic_boundary, cached_on_state, get_matlab_engine
+from libs.envs.init_cache import InitStateCache, array_hash
+from libs.envs.multigrid_poisson import MultigridPoisson
+from libs.envs import ns_control_2d_torch as torch_ops
 
 
 def build_up_b(rho, dt, dx, dy, u, v):
@@ -67,12 +69,310 @@ def pressure_poisson_periodic(p, dx, dy, b, nit=50):
     return p
 
 
+class PeriodicChannelPoisson:
+    """
+    Direct solver of lap(p) = b, periodic in x with dp/dy = 0 on the walls, i.e. the fixed point
+    of pressure_poisson_periodic. x is diagonalized by an FFT and y by the eigenvectors of the
+    Neumann second difference, so every wavenumber is a diagonal solve in that basis.
+    The singular mean mode is left free and set to the mean of the previous pressure.
+    """
+    def __init__(self, nx, ny, dx, dy):
+        n = ny - 2  # rows 1..ny-2, rows 0 and ny-1 copy their neighbours
+        T = np.diag(-2 * np.ones(n)) + np.diag(np.ones(n - 1), 1) + np.diag(np.ones(n - 1), -1)
+        T[0, 0] = T[-1, -1] = -1
+        self.eig_val, self.eig_vec = np.linalg.eigh(T / dy**2)
+        kxx = 2 * (np.cos(2 * np.pi * np.arange(nx // 2 + 1) / nx) - 1) / dx**2
+        denom = self.eig_val[:, None] + kxx[None, :]
+        mean_mode = np.argmin(abs(self.eig_val))
+        denom[mean_mode, 0] = 1.0
+        self.inv_denom = 1 / denom
+        self.inv_denom[mean_mode, 0] = 0.0
+        self.nx = nx
+
+    def solve(self, p, b):
+        b_hat = np.fft.rfft(b[1:-1, :], axis=1)
+        p_hat = self.eig_vec @ ((self.eig_vec.T @ b_hat) * self.inv_denom)
+        p_new = np.empty_like(p)
+        p_new[1:-1, :] = np.fft.irfft(p_hat, n=self.nx, axis=1) + p[1:-1, :].mean()
+        # Wall boundary conditions, pressure
+        p_new[-1, :] = p_new[-2, :]
+        p_new[0, :] = p_new[1, :]
+        return p_new
+
+
+class ChannelStencil2D:
+    """
+    Preallocated buffers and the fused update of NSControlEnv2D.solve.
+    u and v are stored with one halo column on each side (column 0 mirrors the last column and
+    column nx + 1 the first one), so the periodic x-wrap is a plain slice and every row 1..ny-2
+    goes through the same stencil. The update writes the increment into a scratch buffer and the
+    new field into the second buffer, which is swapped with the current one instead of copied.
+    """
+    def __init__(self, ny, nx):
+        self.ny, self.nx = ny, nx
+        self.u = np.zeros((ny, nx + 2))
+        self.v = np.zeros((ny, nx + 2))
+        self.un = np.zeros((ny, nx + 2))
+        self.vn = np.zeros((ny, nx + 2))
+        self.p = np.zeros((ny, nx))
+        self.p_halo = np.zeros((ny, nx + 2))
+        self.b = np.zeros((ny, nx))
+        self.tmp = np.zeros((ny - 2, nx))
+        self.tmp2 = np.zeros((ny - 2, nx))
+        self.du = np.zeros((ny - 2, nx))
+        self.dv = np.zeros((ny - 2, nx))
+        self.u_sum = 0.0
+
+    @staticmethod
+    def fill_halo(a):
+        a[:, 0] = a[:, -2]
+        a[:, -1] = a[:, 1]
+
+    @staticmethod
+    def neighbours(a):
+        # center, west, east, south, north views of rows 1..ny-2
+        return a[1:-1, 1:-1], a[1:-1, :-2], a[1:-1, 2:], a[:-2, 1:-1], a[2:, 1:-1]
+
+    def load(self, p, u, v, bc):
+        self.p[...] = p
+        self.u[:, 1:-1] = u
+        self.v[:, 1:-1] = v
+        # Wall BC: u,v = 0 @ y = 0,2, the controls do not change during a solve
+        self.u[0, :] = 0
+        self.u[-1, :] = 0
+        self.v[0, 1:-1] = bc[0] if bc is not None else 0
+        self.v[-1, 1:-1] = bc[1] if bc is not None else 0
+        self.fill_halo(self.u)
+        self.fill_halo(self.v)
+        self.u_sum = self.u[:, 1:-1].sum()
+
+    def build_up_b(self, rho, dt, dx, dy):
+        # same as build_up_b on rows 1..ny-2, periodic in x
+        uC, uW, uE, uS, uN = self.neighbours(self.u)
+        vC, vW, vE, vS, vN = self.neighbours(self.v)
+        dudx, dvdy, t = self.tmp, self.tmp2, self.b[1:-1, :]
+        np.subtract(uE, uW, out=dudx)
+        dudx /= 2 * dx
+        np.subtract(vN, vS, out=dvdy)
+        dvdy /= 2 * dy
+        np.add(dudx, dvdy, out=t)
+        t /= dt
+        dudx *= dudx
+        t -= dudx
+        dvdy *= dvdy
+        t -= dvdy
+        np.subtract(uN, uS, out=dudx)
+        np.subtract(vE, vW, out=dvdy)
+        dudx *= dvdy
+        dudx *= 2 / (4 * dx * dy)
+        t -= dudx
+        t *= rho
+        return self.b
+
+    def set_pressure(self, p):
+        if p is not self.p:
+            self.p[...] = p
+        self.p_halo[:, 1:-1] = self.p
+        self.fill_halo(self.p_halo)
+
+    def _increment(self, out, fC, fW, fE, fS, fN, pd, uC, vC, dx, dy, dt, nu, dp_coef):
+        t = self.tmp
+        # advection (backward differences)
+        np.subtract(fC, fW, out=t)
+        t *= uC
+        np.multiply(t, -dt / dx, out=out)
+        np.subtract(fC, fS, out=t)
+        t *= vC
+        t *= dt / dy
+        out -= t
+        # pressure gradient
+        np.multiply(pd, dp_coef, out=t)
+        out -= t
+        # diffusion
+        np.add(fE, fW, out=t)
+        t -= fC
+        t -= fC
+        t *= nu * dt / dx**2
+        out += t
+        np.add(fN, fS, out=t)
+        t -= fC
+        t -= fC
+        t *= nu * dt / dy**2
+        out += t
+        return out
+
+    def advance(self, dx, dy, dt, rho, nu, F):
+        """
+        One explicit step from (u, v) into the second buffer, returns udiff of the original loop.
+        """
+        uC, uW, uE, uS, uN = self.neighbours(self.u)
+        vC, vW, vE, vS, vN = self.neighbours(self.v)
+        pC, pW, pE, pS, pN = self.neighbours(self.p_halo)
+        pd = self.tmp2
+        np.subtract(pE, pW, out=pd)
+        self._increment(self.du, uC, uW, uE, uS, uN, pd, uC, vC, dx, dy, dt, nu, dt / (2 * rho * dx))
+        self.du += F * dt
+        np.subtract(pN, pS, out=pd)
+        self._increment(self.dv, vC, vW, vE, vS, vN, pd, uC, vC, dx, dy, dt, nu, dt / (2 * rho * dy))
+        # the wall rows keep their values
+        self.un[0, :], self.un[-1, :] = self.u[0, :], self.u[-1, :]
+        self.vn[0, :], self.vn[-1, :] = self.v[0, :], self.v[-1, :]
+        np.add(uC, self.du, out=self.un[1:-1, 1:-1])
+        np.add(vC, self.dv, out=self.vn[1:-1, 1:-1])
+        self.u, self.un = self.un, self.u
+        self.v, self.vn = self.vn, self.v
+        self.fill_halo(self.u)
+        self.fill_halo(self.v)
+        # sum(u) - sum(un) is the sum of the increment
+        du_sum = self.du.sum()
+        self.u_sum += du_sum
+        return du_sum / self.u_sum
+
+    def residuals(self, dx, dy, dt):
+        """
+        Momentum residual |du, dv| / (dt |u, v|) of the last advance and the rms divergence of the new field.
+        """
+        with np.errstate(over='ignore', invalid='ignore'):
+            momentum = np.sqrt(np.vdot(self.du, self.du) + np.vdot(self.dv, self.dv))
+        if not np.isfinite(momentum):
+            return np.inf, np.inf
+        velocity = np.sqrt(np.vdot(self.u[1:-1, 1:-1], self.u[1:-1, 1:-1]) + np.vdot(self.v[1:-1, 1:-1], self.v[1:-1, 1:-1]))
+        uC, uW, uE, uS, uN = self.neighbours(self.u)
+        vC, vW, vE, vS, vN = self.neighbours(self.v)
+        div, t = self.tmp, self.tmp2
+        np.subtract(uE, uW, out=div)
+        div /= 2 * dx
+        np.subtract(vN, vS, out=t)
+        t /= 2 * dy
+        div += t
+        return momentum / (dt * max(velocity, 1e-30)), np.sqrt(np.vdot(div, div) / div.size)
+
+    def fields(self):
+        # copies, the buffers are reused by the next solve
+        return (self.p.copy(), self.u[:, 1:-1].copy(), self.v[:, 1:-1].copy(),
+                self.un[:, 1:-1].copy(), self.vn[:, 1:-1].copy())
+
+
+class ConvergenceMonitor:
+    """
+    Stopping rule of NSControlEnv2D.solve.
+    sum: the relative change of sum(u) below u_diff_thre (reference), raises after max_iter iterations.
+    residual: the momentum residual |du| / (dt |u|) below tol, and the rms divergence below div_tol if given,
+    for `patience` consecutive iterations. Reaching max_iter stops with a warning instead of an error,
+    only a non-finite residual raises.
+    history holds (momentum, divergence) per iteration of the last solve (udiff for sum).
+    """
+    def __init__(self, criterion='sum', tol=1e-3, div_tol=None, patience=5, max_iter=5000, verbose=False):
+        self.criterion = criterion
+        self.tol = tol
+        self.div_tol = div_tol
+        self.patience = patience
+        self.max_iter = max_iter
+        self.verbose = verbose
+        self.start()
+
+    def start(self):
+        self.iterations = 0
+        self.below = 0
+        self.history = []
+
+    def update(self, kernel, udiff, dx, dy, dt, u_diff_thre):
+        self.iterations += 1
+        if self.criterion == 'sum':
+            self.history.append(udiff)
+            if self.iterations > self.max_iter:
+                raise RuntimeError("Not converged solving!")
+            return udiff <= u_diff_thre
+        momentum, divergence = kernel.residuals(dx, dy, dt)
+        self.history.append((momentum, divergence))
+        if not np.isfinite(momentum):
+            raise RuntimeError(f"Solver diverged after {self.iterations} iterations!")
+        if momentum <= self.tol and (self.div_tol is None or divergence <= self.div_tol):
+            self.below += 1
+        else:
+            self.below = 0
+        if self.below >= self.patience:
+            if self.verbose:
+                print(f"Converged in {self.iterations} iterations, momentum residual {momentum:.3e}, divergence {divergence:.3e}.")
+            return True
+        if self.iterations >= self.max_iter:
+            print(f"Not converged in {self.iterations} iterations, momentum residual {momentum:.3e}, divergence {divergence:.3e}.")
+            return True
+        return False
+
+
+class MassFlowController:
+    """
+    Finds the forcing F for which NSControlEnv2D.solve reaches a target bulk velocity (fix_flow).
+    Secant updates on the near-linear flow(F) relation, safeguarded by bisection once the target
+    is bracketed, and the first guess reuses the F and the slope found in the last call.
+    solve() stops on the per-iteration change of u rather than at a true steady state, so a probe
+    started from the previous probe's field (warm_start, mass_flow_warm_start) keeps evolving the flow and
+    biases flow(F); by default every probe starts from the current env state.
+    F stays in [min_f, max_f] as in solve_fixed_mass, a target outside the flows reachable there returns the
+    initial F (return_overflow) like the bisection.
+    """
+    def __init__(self, max_step=50, error_threshold=1e-4, warm_start=False):
+        self.max_step = max_step
+        self.error_threshold = error_threshold
+        self.warm_start = warm_start
+        self.F, self.slope = None, None
+
+    def solve(self, env, bc, target_flow, F0, min_f=0.0, max_f=None, verbose=True, return_overflow=True):
+        solve_begin_t = time.time()
+        max_f = 3 * F0 if max_f is None else max_f
+        fields = (env.p, env.u, env.v)
+
+        def probe(F, fields):
+            flow, new_fields = env.solve(bc, -1, *fields, env.dx, env.dy, env.dt, env.rho, env.nu, F,
+                                         update_state=False, return_fields=True)
+            return flow, new_fields if self.warm_start else fields
+
+        F = min(max(F0 if self.F is None else self.F, min_f), max_f)
+        slope = self.slope
+        flow, fields = probe(F, fields)
+        error = abs(flow - target_flow)
+        lower, upper = None, None  # largest F below / smallest F above the target
+        step = 1
+        while step < self.max_step and error > self.error_threshold:
+            if flow < target_flow:
+                lower = F if lower is None else max(lower, F)
+            else:
+                upper = F if upper is None else min(upper, F)
+            if slope is None:
+                F_new = F + np.sign(target_flow - flow) * max(0.1 * abs(F), 0.1)
+            else:
+                F_new = F + (target_flow - flow) / slope
+            if lower is not None and upper is not None and not lower < F_new < upper:
+                F_new = 0.5 * (lower + upper)
+            F_new = min(max(F_new, min_f), max_f)
+            if F_new == F:
+                # F is on a bound of [min_f, max_f] and the flow there is still on the wrong side
+                if return_overflow:
+                    if verbose:
+                        print(f"Target flow {target_flow} out of reach in F = [{min_f}, {max_f}], keeping force {F0}.")
+                    return F0, target_flow, 0
+                break
+            flow_new, fields = probe(F_new, fields)
+            if F_new != F and (flow_new - flow) / (F_new - F) > 0:
+                slope = (flow_new - flow) / (F_new - F)
+            F, flow = F_new, flow_new
+            error = abs(flow - target_flow)
+            step += 1
+        self.F, self.slope = F, slope
+        if verbose:
+            print(f"Solve step: {step}, target: {target_flow}, result flow: {flow}, force: {F}, error: {error}, using time: {time.time() - solve_begin_t}")
+        return F, flow, error
+
+
 class NSControlEnv2D:
     def __init__(self, args, detect_plane, bc_type):
         self.detect_plane = detect_plane
         self.bc_type = bc_type
         self.fix_flow = args.fix_flow
         self.Re = args.Re
+        # bumped whenever u/v/p are replaced, invalidates the memoized scores
+        self.state_version = 0
 
         # initialize system states
         self.nx = 41
@@ -85,6 +385,36 @@ class NSControlEnv2D:
         self.x = np.linspace(0, 2, self.nx)
         self.y = np.linspace(0, 2, self.ny)
         self.X, self.Y = np.meshgrid(self.x, self.y)
+        # direct: exact FFT/eigen solve of the pressure, jacobi: self.nit sweeps (reference)
+        self.pressure_solver = getattr(args, 'pressure_solver', 'direct')
+        self.poisson = PeriodicChannelPoisson(self.nx, self.ny, self.dx, self.dy)
+        # multigrid: V-cycles down to multigrid_tol, rows 1..ny-2 are the unknowns
+        self.multigrid_tol = getattr(args, 'multigrid_tol', 1e-8)
+        if self.pressure_solver == 'multigrid':
+            self.multigrid = MultigridPoisson((self.ny - 2, self.nx), self.dx, self.dy,
+                                              bc=('neumann', 'neumann', 'periodic', 'periodic'))
+        # secant: warm-started MassFlowController, bisection: solve_fixed_mass (reference)
+        self.mass_flow_solver = getattr(args, 'mass_flow_solver', 'secant')
+        self.mass_flow = MassFlowController(warm_start=getattr(args, 'mass_flow_warm_start', False))
+        # numpy: buffers of the fused solver loop, torch: the same loop on tensors (see rollout for gradients)
+        self.solver_backend = getattr(args, 'solver_backend', 'numpy')
+        self.device = torch.device(getattr(args, 'env_device', 'cpu'))
+        self.dtype = torch.float64
+        self.poisson_torch = torch_ops.PeriodicChannelPoissonTorch(self.poisson, device=self.device, dtype=self.dtype)
+        if self.solver_backend == 'torch':
+            if self.pressure_solver == 'multigrid':
+                raise RuntimeError("The multigrid pressure solver is not supported by the torch backend.")
+            self.kernel = torch_ops.ChannelStencil2DTorch(self.nx, device=self.device, dtype=self.dtype)
+        elif self.solver_backend == 'numpy':
+            self.kernel = ChannelStencil2D(self.ny, self.nx)
+        else:
+            raise RuntimeError(f"Not supported solver backend: {self.solver_backend}")
+        # stopping rule of solve(), see ConvergenceMonitor
+        self.convergence = ConvergenceMonitor(criterion=getattr(args, 'convergence_criterion', 'sum'),
+                                              tol=getattr(args, 'convergence_tol', 1e-3),
+                                              div_tol=getattr(args, 'convergence_div_tol', None),
+                                              patience=getattr(args, 'convergence_patience', 5),
+                                              max_iter=getattr(args, 'max_solve_iter', 5000))
         
         # physical variables, hyper-parameters
         self.rho = 1
@@ -100,8 +430,33 @@ class NSControlEnv2D:
         self.v = np.ones((self.ny, self.nx)) * self.v_scale_main + np.random.rand(self.ny, self.nx) * self.v_scale_noise
         self.p = self.v.copy()
         self.nu = self.u.max() / self.Re
-        self.bulk_v = self.solve(None, -1, self.p, self.u, self.v, self.dx, 
-                                 self.dy, self.dt, self.rho, self.nu, self.F, update_state=True)
+        # the converged state is reused across runs when init_cache_dir is set, the key includes the random draw
+        # and every setting that decides where solve() stops
+        init_cache_dir = getattr(args, 'init_cache_dir', None)
+        init_cache = InitStateCache(init_cache_dir) if init_cache_dir else None
+        cached = None
+        if init_cache is not None:
+            init_cache_key = init_cache.key(env='NSControlEnv2D', nx=self.nx, ny=self.ny, dt=self.dt, rho=self.rho,
+                                            nu=self.nu, F=self.F, pressure_solver=self.pressure_solver,
+                                            multigrid_tol=self.multigrid_tol, solver_backend=self.solver_backend,
+                                            convergence_criterion=self.convergence.criterion,
+                                            convergence_tol=self.convergence.tol,
+                                            convergence_div_tol=self.convergence.div_tol,
+                                            convergence_patience=self.convergence.patience,
+                                            max_solve_iter=self.convergence.max_iter,
+                                            u=array_hash(self.u), v=array_hash(self.v))
+            cached = init_cache.load(init_cache_key)
+        if cached is None:
+            self.bulk_v = self.solve(None, -1, self.p, self.u, self.v, self.dx, 
+                                     self.dy, self.dt, self.rho, self.nu, self.F, update_state=True)
+            if init_cache is not None:
+                init_cache.save(init_cache_key, {'p': self.p, 'u': self.u, 'v': self.v, 'un': self.un, 'vn': self.vn},
+                                {'bulk_v': self.bulk_v})
+        else:
+            for name, value in cached[0].items():
+                setattr(self, name, value)
+            self.bulk_v = cached[1]['bulk_v']
+            self.state_version += 1
         self.init_bulk_v = None
         print(f"Initially, the divergence is {self.reward_div()}. The bulk velocity is {self.bulk_v}.")
         self.info_init = None
@@ -159,13 +514,16 @@ class NSControlEnv2D:
         self.v = state['v']
         self.vn = state['vn']
         self.p = state['p']
+        self.state_version += 1
         
     '''
     Calculating scores.
     '''
+    @cached_on_state
     def cal_bulk_v(self):
         return np.mean(abs(self.u))
         
+    @cached_on_state
     def cal_div(self):
         ux = (self.u[10, 10] - self.u[9, 10]) / self.dx
         uy = (self.v[10, 10] - self.v[10, 9]) / self.dy
@@ -174,6 +532,11 @@ class NSControlEnv2D:
     def cal_pressure(self,):
         return self.p
     
+    @property
+    def eng(self):
+        # started on first use, only the matlab based diagnostics need it
+        return get_matlab_engine()
+
     def cal_dpdx_reverse(self, layer_index=-1):
         dpdx = self.eng.compute_dpdx_reverse(to_m(self.U), to_m(self.V), to_m(self.W), to_m(self.nu), 
                                              to_m(self.dx), to_m(self.dz), to_m(self.y), to_m(self.yg), 
@@ -209,6 +572,7 @@ class NSControlEnv2D:
             dudy_all.append(dudy)
         return dudy_all
     
+    @cached_on_state
     def cal_shear_stress(self, ):
         # -u*v + nu * (dU/dy)
         wall_u = self.u[-1, :]
@@ -357,7 +721,7 @@ class NSControlEnv2D:
         return bc
 
     def solve(self, bc, max_step, p_copy, u_copy, v_copy,
-              dx, dy, dt, rho, nu, F, update_state, u_diff_thre=1e-2):
+              dx, dy, dt, rho, nu, F, update_state, u_diff_thre=1e-2, return_fields=False):
         """
         Solves the fluid flow simulation using the specified inputs.
     
@@ -374,107 +738,26 @@ class NSControlEnv2D:
             nu (float): Viscosity.
             F (float): Force.
             update_state (bool): Flag to update the class variables. Defaults to True.
+            return_fields (bool): Also return the final (p, u, v).
     
         Returns:
             float: Bulk velocity.
         """
-        p = copy.deepcopy(p_copy)
-        u = copy.deepcopy(u_copy)
-        v = copy.deepcopy(v_copy)
-        udiff = 1.0
+        kernel = self.kernel
+        kernel.load(p_copy, u_copy, v_copy, bc)
+        self.convergence.start()
         stepcount = 0
-        while udiff > u_diff_thre:
-            # Wall BC: u,v = 0 @ y = 0,2
-            if bc is not None:
-                u[0, :] = 0
-                u[-1, :] = 0
-                v[0, :] = bc[0] # -v_copy[10, :]
-                v[-1, :]= bc[1] # -v_copy[-10, :]
-            else:  # unmanipulated
-                u[0, :] = 0
-                u[-1, :] = 0
-                v[0, :] = 0
-                v[-1, :] = 0
-            un = u.copy()
-            vn = v.copy()
-            b = build_up_b(rho, dt, dx, dy, u, v)
-            p = pressure_poisson_periodic(p, dx, dy, b, self.nit)
-            u[1:-1, 1:-1] = (un[1:-1, 1:-1] - un[1:-1, 1:-1] * dt / dx * 
-                            (un[1:-1, 1:-1] - un[1:-1, 0:-2]) -
-                             vn[1:-1, 1:-1] * dt / dy * 
-                            (un[1:-1, 1:-1] - un[0:-2, 1:-1]) -
-                             dt / (2 * rho * dx) * 
-                            (p[1:-1, 2:] - p[1:-1, 0:-2]) +
-                             nu * (dt / dx**2 * 
-                            (un[1:-1, 2:] - 2 * un[1:-1, 1:-1] + un[1:-1, 0:-2]) +
-                             dt / dy**2 * 
-                            (un[2:, 1:-1] - 2 * un[1:-1, 1:-1] + un[0:-2, 1:-1])) + 
-                             F * dt)
-            v[1:-1, 1:-1] = (vn[1:-1, 1:-1] -
-                             un[1:-1, 1:-1] * dt / dx * 
-                            (vn[1:-1, 1:-1] - vn[1:-1, 0:-2]) -
-                             vn[1:-1, 1:-1] * dt / dy * 
-                            (vn[1:-1, 1:-1] - vn[0:-2, 1:-1]) -
-                             dt / (2 * rho * dy) * 
-                            (p[2:, 1:-1] - p[0:-2, 1:-1]) +
-                             nu * (dt / dx**2 *
-                            (vn[1:-1, 2:] - 2 * vn[1:-1, 1:-1] + vn[1:-1, 0:-2]) +
-                             dt / dy**2 * 
-                            (vn[2:, 1:-1] - 2 * vn[1:-1, 1:-1] + vn[0:-2, 1:-1])))
-        
-            # Periodic BC u @ x = 2     
-            u[1:-1, -1] = (un[1:-1, -1] - un[1:-1, -1] * dt / dx * 
-                          (un[1:-1, -1] - un[1:-1, -2]) -
-                           vn[1:-1, -1] * dt / dy * 
-                          (un[1:-1, -1] - un[0:-2, -1]) -
-                           dt / (2 * rho * dx) *
-                          (p[1:-1, 0] - p[1:-1, -2]) + 
-                           nu * (dt / dx**2 * 
-                          (un[1:-1, 0] - 2 * un[1:-1,-1] + un[1:-1, -2]) +
-                           dt / dy**2 * 
-                          (un[2:, -1] - 2 * un[1:-1, -1] + un[0:-2, -1])) + F * dt)
-        
-            # Periodic BC u @ x = 0
-            u[1:-1, 0] = (un[1:-1, 0] - un[1:-1, 0] * dt / dx *
-                         (un[1:-1, 0] - un[1:-1, -1]) -
-                          vn[1:-1, 0] * dt / dy * 
-                         (un[1:-1, 0] - un[0:-2, 0]) - 
-                          dt / (2 * rho * dx) * 
-                         (p[1:-1, 1] - p[1:-1, -1]) + 
-                          nu * (dt / dx**2 * 
-                         (un[1:-1, 1] - 2 * un[1:-1, 0] + un[1:-1, -1]) +
-                          dt / dy**2 *
-                         (un[2:, 0] - 2 * un[1:-1, 0] + un[0:-2, 0])) + F * dt)
-        
-            # Periodic BC v @ x = 2
-            v[1:-1, -1] = (vn[1:-1, -1] - un[1:-1, -1] * dt / dx *
-                          (vn[1:-1, -1] - vn[1:-1, -2]) - 
-                           vn[1:-1, -1] * dt / dy *
-                          (vn[1:-1, -1] - vn[0:-2, -1]) -
-                           dt / (2 * rho * dy) * 
-                          (p[2:, -1] - p[0:-2, -1]) +
-                           nu * (dt / dx**2 *
-                          (vn[1:-1, 0] - 2 * vn[1:-1, -1] + vn[1:-1, -2]) +
-                           dt / dy**2 *
-                          (vn[2:, -1] - 2 * vn[1:-1, -1] + vn[0:-2, -1])))
-        
-            # Periodic BC v @ x = 0
-            v[1:-1, 0] = (vn[1:-1, 0] - un[1:-1, 0] * dt / dx *
-                         (vn[1:-1, 0] - vn[1:-1, -1]) -
-                          vn[1:-1, 0] * dt / dy *
-                         (vn[1:-1, 0] - vn[0:-2, 0]) -
-                          dt / (2 * rho * dy) * 
-                         (p[2:, 0] - p[0:-2, 0]) +
-                          nu * (dt / dx**2 * 
-                         (vn[1:-1, 1] - 2 * vn[1:-1, 0] + vn[1:-1, -1]) +
-                          dt / dy**2 * 
-                         (vn[2:, 0] - 2 * vn[1:-1, 0] + vn[0:-2, 0])))
-            udiff = (np.sum(u) - np.sum(un)) / np.sum(u)
+        while True:
+            b = kernel.build_up_b(rho, dt, dx, dy)
+            kernel.set_pressure(self.solve_pressure(kernel.p, b, dx, dy))
+            udiff = kernel.advance(dx, dy, dt, rho, nu, F)
             stepcount += 1
-            if stepcount > 5000:
-                raise RuntimeError("Not converged solving!")
+            converged = self.convergence.update(kernel, udiff, dx, dy, dt, u_diff_thre)
             if max_step > 1 and stepcount >= max_step:
                 break
+            if converged:
+                break
+        p, u, v, un, vn = kernel.fields()
         bulk_v = np.mean(abs(u))
         if update_state:
             self.un = un
@@ -488,8 +771,60 @@ class NSControlEnv2D:
             self.rho = rho
             self.nu = nu
             self.F = F
+            self.state_version += 1
+        if return_fields:
+            return bulk_v, (p, u, v)
         return bulk_v
     
+    def solve_pressure(self, p, b, dx, dy):
+        # p: previous pressure, numpy arrays or tensors [..., ny, nx] for the torch solvers
+        if torch.is_tensor(b):
+            if self.pressure_solver == 'jacobi':
+                return torch_ops.pressure_poisson_periodic(p, b, dx, dy, self.nit)
+            return self.poisson_torch.solve(p, b)
+        if self.pressure_solver == 'jacobi':
+            return pressure_poisson_periodic(p, dx, dy, b, self.nit)
+        if self.pressure_solver == 'multigrid':
+            p_new = np.empty_like(p)
+            p_new[1:-1, :] = self.multigrid.solve(b[1:-1, :], x0=p[1:-1, :], tol=self.multigrid_tol)
+            # Wall boundary conditions, pressure
+            p_new[-1, :] = p_new[-2, :]
+            p_new[0, :] = p_new[1, :]
+            return p_new
+        return self.poisson.solve(p, b)
+
+    def rollout(self, bc, steps=3, state=None, F=None, u_diff_thre=1e-2):
+        """
+        Differentiable torch version of solve(bc, steps, ...) at a fixed forcing, i.e. the solve of step.
+        bc: [low, high] wall controls or a tensor [..., 2, nx], leading dimensions are a batch of candidates.
+        state: (p, u, v), the current state by default. F: float or tensor [...], self.F by default.
+        Stops early once udiff <= u_diff_thre for every member (None: always `steps` iterations).
+        Returns the tensors p, u, v [..., ny, nx], gradients flow back to bc, state and F.
+        The fix_flow correction of step is not part of the graph.
+        """
+        to_tensor = lambda a: torch.as_tensor(a, dtype=self.dtype, device=self.device)
+        p, u, v = [to_tensor(a) for a in (state if state is not None else (self.p, self.u, self.v))]
+        F = self.F if F is None else to_tensor(F)
+        low, high = torch_ops.wall_controls(bc, self.nx, dtype=self.dtype, device=self.device)
+        u, v = torch_ops.apply_wall_controls(u, v, low, high)
+        p = p.expand_as(u)
+        for _ in range(steps):
+            b = torch_ops.build_up_b(u, v, self.rho, self.dt, self.dx, self.dy)
+            p = self.solve_pressure(p, b, self.dx, self.dy)
+            u, v, du, _ = torch_ops.advance(u, v, p, self.dx, self.dy, self.dt, self.rho, self.nu, F)
+            if u_diff_thre is not None and (du.sum(dim=(-2, -1)) / u.sum(dim=(-2, -1)) <= u_diff_thre).all():
+                break
+        return p, u, v
+
+    def evaluate_controls(self, bcs, steps=3, u_diff_thre=1e-2):
+        """
+        Shear stress and mass flow after the rollout of a batch of controls bcs [B, 2, nx], in one call.
+        """
+        with torch.no_grad():
+            p, u, v = self.rollout(bcs, steps, u_diff_thre=u_diff_thre)
+            return (torch_ops.shear_stress(u, v, self.nu, self.dy).cpu().numpy(),
+                    torch_ops.bulk_velocity(u).cpu().numpy())
+
     def solve_fixed_mass(self, bc, target_flow, min_f=0.0, max_f=3.0, max_step=500, error_threshold=1e-4,
                         verbose=True, return_overflow=True):        
         # tuning self.F to keep mass flow rate constant
@@ -552,7 +887,11 @@ class NSControlEnv2D:
         self.solve(bc, 3, self.p, self.u, self.v, self.dx, self.dy, self.dt, self.rho, self.nu, self.F, update_state=True)
         if self.init_bulk_v is None:
             self.reset_init()
-        if self.fix_flow:
+        if self.fix_flow and self.mass_flow_solver == 'secant':
+            dpdx_reverse, flow, error = self.mass_flow.solve(self, bc, self.init_bulk_v, self.F, min_f=0, max_f=3*self.F,
+                                                             verbose=print_info)
+            self.F = dpdx_reverse
+        elif self.fix_flow:
             dpdx_reverse, flow, error = self.solve_fixed_mass(bc=bc, target_flow=self.init_bulk_v, min_f=0, max_f=3*self.F, verbose=print_info)
             self.F = dpdx_reverse
             # self.u = self.u / self.u.mean() * self.init_bulk_v
@@ -0,0 +1,158 @@
+import numpy as np
+import torch
+
+# Torch version of the NSControlEnv2D solver loop. Fields are [..., ny, nx], periodic in x (last dim),
+# rows 0 and ny-1 are the walls. Every op is out-of-place, so a rollout can be differentiated with
+# respect to the wall controls, the initial state or the forcing, and leading batch dimensions
+# evaluate several controls at once.
+
+
+def neighbours(a):
+    # center, west, east, south, north of rows 1..ny-2
+    c = a[..., 1:-1, :]
+    return c, torch.roll(c, 1, dims=-1), torch.roll(c, -1, dims=-1), a[..., :-2, :], a[..., 2:, :]
+
+
+def pad_walls(inner, value=None):
+    # rows 0 and ny-1: copies of their neighbours (dp/dy = 0) or the given wall rows
+    low, high = (inner[..., :1, :], inner[..., -1:, :]) if value is None else value
+    return torch.cat([low, inner, high], dim=-2)
+
+
+def build_up_b(u, v, rho, dt, dx, dy):
+    uC, uW, uE, uS, uN = neighbours(u)
+    vC, vW, vE, vS, vN = neighbours(v)
+    dudx = (uE - uW) / (2 * dx)
+    dvdy = (vN - vS) / (2 * dy)
+    b = rho * ((dudx + dvdy) / dt - dudx**2 - 2 * (uN - uS) / (2 * dy) * (vE - vW) / (2 * dx) - dvdy**2)
+    zeros = torch.zeros_like(b[..., :1, :])
+    return pad_walls(b, (zeros, zeros))
+
+
+def pressure_poisson_periodic(p, b, dx, dy, nit=50):
+    for _ in range(nit):
+        pC, pW, pE, pS, pN = neighbours(p)
+        p = pad_walls(((pE + pW) * dy**2 + (pN + pS) * dx**2) / (2 * (dx**2 + dy**2)) -
+                      dx**2 * dy**2 / (2 * (dx**2 + dy**2)) * b[..., 1:-1, :])
+    return p
+
+
+class PeriodicChannelPoissonTorch:
+    """
+    PeriodicChannelPoisson on tensors, the factorization is taken from the numpy solver.
+    """
+    def __init__(self, poisson, device=None, dtype=torch.float64):
+        complex_dtype = torch.complex128 if dtype == torch.float64 else torch.complex64
+        self.eig_vec = torch.tensor(poisson.eig_vec, dtype=complex_dtype, device=device)
+        self.inv_denom = torch.tensor(poisson.inv_denom, dtype=dtype, device=device)
+        self.nx = poisson.nx
+
+    def solve(self, p, b):
+        b_hat = torch.fft.rfft(b[..., 1:-1, :], dim=-1)
+        p_hat = self.eig_vec @ ((self.eig_vec.T @ b_hat) * self.inv_denom)
+        inner = torch.fft.irfft(p_hat, n=self.nx, dim=-1)
+        return pad_walls(inner + p[..., 1:-1, :].mean(dim=(-2, -1), keepdim=True))
+
+
+def advance(u, v, p, dx, dy, dt, rho, nu, F):
+    """
+    One explicit step of the momentum equations, the wall rows keep their values.
+    F: float or tensor broadcastable against the batch dimensions.
+    """
+    if torch.is_tensor(F) and F.dim() > 0:
+        F = F[..., None, None]
+    uC, uW, uE, uS, uN = neighbours(u)
+    vC, vW, vE, vS, vN = neighbours(v)
+    pC, pW, pE, pS, pN = neighbours(p)
+    du = (- uC * dt / dx * (uC - uW) - vC * dt / dy * (uC - uS) - dt / (2 * rho * dx) * (pE - pW) +
+          nu * dt / dx**2 * (uE - 2 * uC + uW) + nu * dt / dy**2 * (uN - 2 * uC + uS) + F * dt)
+    dv = (- uC * dt / dx * (vC - vW) - vC * dt / dy * (vC - vS) - dt / (2 * rho * dy) * (pN - pS) +
+          nu * dt / dx**2 * (vE - 2 * vC + vW) + nu * dt / dy**2 * (vN - 2 * vC + vS))
+    un = pad_walls(uC + du, (u[..., :1, :], u[..., -1:, :]))
+    vn = pad_walls(vC + dv, (v[..., :1, :], v[..., -1:, :]))
+    return un, vn, du, dv
+
+
+def wall_controls(bc, nx, dtype=torch.float64, device=None):
+    """
+    bc: None, [low, high] (floats, arrays or tensors [..., nx]) or a tensor [..., 2, nx].
+    Returns the blowing/suction velocities of the two walls as tensors [..., nx].
+    """
+    if bc is None:
+        bc = [0, 0]
+    if torch.is_tensor(bc) and bc.dim() >= 2:
+        low, high = bc[..., 0, :], bc[..., 1, :]
+    else:
+        low, high = bc
+    low, high = [torch.as_tensor(a, dtype=dtype, device=device) for a in (low, high)]
+    low, high = torch.broadcast_tensors(low, high)
+    shape = low.shape[:-1] + (nx,) if low.dim() > 0 else (nx,)
+    return low.expand(shape), high.expand(shape)
+
+
+def apply_wall_controls(u, v, low, high):
+    # u = 0 on the walls, v = the controls (Wall BC of NSControlEnv2D.solve)
+    batch_shape = torch.broadcast_shapes(u.shape[:-2], v.shape[:-2], low.shape[:-1])
+    u = u.expand(*batch_shape, *u.shape[-2:])
+    v = v.expand(*batch_shape, *v.shape[-2:])
+    zeros = torch.zeros_like(u[..., :1, :])
+    u = pad_walls(u[..., 1:-1, :], (zeros, zeros))
+    v = pad_walls(v[..., 1:-1, :], (low.expand(*batch_shape, -1).unsqueeze(-2),
+                                    high.expand(*batch_shape, -1).unsqueeze(-2)))
+    return u, v
+
+
+def shear_stress(u, v, nu, dy):
+    # -u*v + nu * (dU/dy) on the top wall, as NSControlEnv2D.cal_shear_stress, per batch member
+    first_term = - u[..., -1, :] * v[..., -1, :]
+    second_term = nu * (u[..., -2, :] - u[..., -3, :]) / dy
+    return abs((first_term + second_term).mean(dim=-1))
+
+
+def bulk_velocity(u):
+    return u.abs().mean(dim=(-2, -1))
+
+
+class ChannelStencil2DTorch:
+    """
+    Torch counterpart of ChannelStencil2D for NSControlEnv2D.solve with solver_backend: torch.
+    Takes and returns numpy arrays (load / fields) like the numpy kernel, the iterations run on tensors.
+    """
+    def __init__(self, nx, device=None, dtype=torch.float64):
+        self.nx = nx
+        self.device, self.dtype = device, dtype
+
+    def to_tensor(self, a):
+        return torch.as_tensor(np.asarray(a), dtype=self.dtype, device=self.device)
+
+    def load(self, p, u, v, bc):
+        self.p = self.to_tensor(p)
+        low, high = wall_controls(bc, self.nx, dtype=self.dtype, device=self.device)
+        self.u, self.v = apply_wall_controls(self.to_tensor(u), self.to_tensor(v), low, high)
+        self.un, self.vn = self.u, self.v
+
+    def build_up_b(self, rho, dt, dx, dy):
+        return build_up_b(self.u, self.v, rho, dt, dx, dy)
+
+    def set_pressure(self, p):
+        self.p = p
+
+    def advance(self, dx, dy, dt, rho, nu, F):
+        self.un, self.vn = self.u, self.v
+        self.u, self.v, self.du, self.dv = advance(self.un, self.vn, self.p, dx, dy, dt, rho, nu, F)
+        # udiff of the original loop, (sum(u) - sum(un)) / sum(u)
+        return (self.du.sum() / self.u.sum()).item()
+
+    def residuals(self, dx, dy, dt):
+        # same as ChannelStencil2D.residuals
+        momentum = torch.sqrt((self.du**2).sum() + (self.dv**2).sum()).item()
+        velocity = torch.sqrt((self.u[1:-1, :]**2).sum() + (self.v[1:-1, :]**2).sum()).item()
+        if not np.isfinite(momentum):
+            return np.inf, np.inf
+        uC, uW, uE, uS, uN = neighbours(self.u)
+        vC, vW, vE, vS, vN = neighbours(self.v)
+        div = (uE - uW) / (2 * dx) + (vN - vS) / (2 * dy)
+        return momentum / (dt * max(velocity, 1e-30)), torch.sqrt((div**2).mean()).item()
+
+    def fields(self):
+        return tuple(a.cpu().numpy() for a in (self.p, self.u, self.v, self.un, self.vn))
@@ -0,0 +1,42 @@
+import json
+import os
+import numpy as np
+
+# raw snapshot: <path>.bin holds the arrays back to back as float64, <path>.json their shapes and the scalars
+
+
+def write_snapshot(path, arrays, meta=None):
+    layout, offset = [], 0
+    with open(path + '.bin', 'wb') as f:
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a, dtype=np.float64)
+            f.write(a.tobytes())
+            layout.append({'name': name, 'shape': list(a.shape), 'offset': offset})
+            offset += a.size
+    with open(path + '.json', 'w') as f:
+        json.dump({'arrays': layout, 'meta': meta or {}}, f, default=float)
+
+
+def read_snapshot(path, mmap_mode='r'):
+    """
+    Returns the arrays (memory mapped views unless mmap_mode is None) and the meta dict.
+    """
+    if path.endswith('.bin') or path.endswith('.json'):
+        path = os.path.splitext(path)[0]
+    with open(path + '.json', 'r') as f:
+        header = json.load(f)
+    if mmap_mode is None:
+        data = np.fromfile(path + '.bin', dtype=np.float64)
+    else:
+        data = np.memmap(path + '.bin', dtype=np.float64, mode=mmap_mode)
+    arrays = {}
+    for entry in header['arrays']:
+        size = int(np.prod(entry['shape']))
+        arrays[entry['name']] = data[entry['offset']:entry['offset'] + size].reshape(entry['shape'])
+    return arrays, header['meta']
+
+
+def is_snapshot(path):
+    if path.endswith('.bin') or path.endswith('.json'):
+        path = os.path.splitext(path)[0]
+    return os.path.exists(path + '.json') and os.path.exists(path + '.bin')
@@ -0,0 +1,140 @@
+import os
+import json
+import argparse
+import numpy as np
+
+# Packed dataset: <folder>/<field>.npy holds all the steps of a field as one contiguous array [steps, ...]
+# (np.load(..., mmap_mode='r')), <folder>/manifest.json the shapes, the steps, Re and dpdx and
+# <folder>/stats.npz the per-point stats of every field (<field>.mean, .std, .count, .m2).
+# pack_dataset converts a collection folder (per-file .npy or shards) into this layout:
+#   python -m libs.packed_data <collect folder> [<packed folder>]
+
+STAT_KEYS = ('mean', 'std', 'count', 'm2')
+
+
+def is_packed(folder):
+    return os.path.exists(os.path.join(folder, 'manifest.json'))
+
+
+def field_names(metadata, file_list):
+    # fields with stats in metadata.npy that also have data, in the order of metadata.npy
+    names = [k for k, v in metadata.items() if isinstance(v, dict) and 'mean' in v]
+    if 'shards' in metadata:
+        return [k for k in names if k in metadata['shards']['files']]
+    return [k for k in names if any(k in f for f in file_list)]
+
+
+class FrameSource:
+    """
+    Frames of a data folder in any of the three layouts: packed (manifest.json), shards (metadata['shards'],
+    written by ShardedWriter) or one <field>_<step>.npy per step. load(name, index) returns frame `index`
+    (position in step order) of a field, memory mapped when possible. The maps are opened lazily in every
+    process, so a FrameSource is cheap to send to DataLoader workers.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.maps = {}
+        if is_packed(folder):
+            self.layout = 'packed'
+            with open(os.path.join(folder, 'manifest.json'), 'r') as f:
+                self.manifest = json.load(f)
+            self.metadata = packed_metadata(folder, self.manifest)
+        else:
+            self.metadata = np.load(os.path.join(folder, 'metadata.npy'), allow_pickle=True).tolist()
+            if 'shards' in self.metadata:
+                self.layout = 'shards'
+                self.shard_size = self.metadata['shards']['shard_size']
+            else:
+                self.layout = 'npy'
+                self.file_list = os.listdir(folder)
+                self.files = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['maps'] = {}
+        return state
+
+    def field_files(self, name):
+        if name not in self.files:
+            self.files[name] = sorted([onef for onef in self.file_list if name in onef])
+        return self.files[name]
+
+    def array(self, name, shard=0):
+        key = (name, shard)
+        if key not in self.maps:
+            if self.layout == 'packed':
+                path = os.path.join(self.folder, self.manifest['fields'][name]['file'])
+            else:
+                path = os.path.join(self.folder, 'shards', self.metadata['shards']['files'][name][shard])
+            self.maps[key] = np.load(path, mmap_mode='r')
+        return self.maps[key]
+
+    def num_frames(self, name):
+        if self.layout == 'packed':
+            return self.manifest['fields'][name]['shape'][0]
+        if self.layout == 'shards':
+            return len(self.metadata['shards']['steps'])
+        return len(self.field_files(name))
+
+    def load(self, name, index, planes=None):
+        # planes: y indices of a [x, y, z] field, only these planes are read from disk
+        if self.layout == 'packed':
+            frame = self.array(name)[index]
+        elif self.layout == 'shards':
+            frame = self.array(name, index // self.shard_size)[index % self.shard_size]
+        else:
+            frame = np.load(os.path.join(self.folder, self.field_files(name)[index]), mmap_mode='r')
+        return frame if planes is None else frame[..., planes, :]
+
+
+def packed_metadata(folder, manifest):
+    # the metadata.npy dictionary of a packed folder
+    metadata = {'re': manifest['re']}
+    with np.load(os.path.join(folder, 'stats.npz')) as stats:
+        for name in manifest['fields']:
+            metadata[name] = {k: stats[f'{name}.{k}'] for k in STAT_KEYS if f'{name}.{k}' in stats}
+    if manifest.get('dpdx') is not None:
+        metadata.setdefault('U_field', {})['dpdx'] = np.array(manifest['dpdx'])
+    return metadata
+
+
+def pack_dataset(src, dst=None, names=None):
+    """
+    Copies the fields of a collection folder frame by frame into one array per field, dst defaults to
+    <src>/packed. The stats are taken from metadata.npy as they are.
+    """
+    dst = os.path.join(src, 'packed') if dst is None else dst
+    os.makedirs(dst, exist_ok=True)
+    source = FrameSource(src)
+    metadata = source.metadata
+    if names is None:
+        names = field_names(metadata, getattr(source, 'file_list', []))
+    manifest = {'re': metadata.get('re'), 'fields': {}, 'dpdx': None, 'steps': None}
+    if 'dpdx' in metadata.get('U_field', {}):
+        manifest['dpdx'] = np.asarray(metadata['U_field']['dpdx']).tolist()
+    if source.layout == 'shards':
+        manifest['steps'] = list(metadata['shards']['steps'])
+    stats = {}
+    for name in names:
+        num = source.num_frames(name)
+        first = source.load(name, 0)
+        out = np.lib.format.open_memmap(os.path.join(dst, f'{name}.npy'), mode='w+', dtype=first.dtype,
+                                        shape=(num,) + first.shape)
+        for index in range(num):
+            out[index] = source.load(name, index)
+        out.flush()
+        del out
+        manifest['fields'][name] = {'file': f'{name}.npy', 'shape': [num] + list(first.shape), 'dtype': str(first.dtype)}
+        stats.update({f'{name}.{k}': np.asarray(metadata[name][k]) for k in STAT_KEYS if k in metadata[name]})
+    np.savez(os.path.join(dst, 'stats.npz'), **stats)
+    with open(os.path.join(dst, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, default=float)
+    return dst
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack a collected dataset into one memory mapped array per field.")
+    parser.add_argument('src', type=str)
+    parser.add_argument('dst', type=str, nargs='?', default=None)
+    cli_args = parser.parse_args()
+    print(f"Packed dataset written to {pack_dataset(cli_args.src, cli_args.dst)}.")
@@ -1,8 +1,45 @@
-import os
 import torch
-import numpy as np
+from collections import OrderedDict
 from torch.utils.data import Dataset
 from libs.utilities3 import *
+from libs.packed_data import FrameSource
+
+
+class FrameCache:
+    """
+    LRU cache of the decoded frames of a dataset, so overlapping windows reuse frames that were already read.
+    max_frames = 0 disables it. Every DataLoader worker keeps its own cache.
+    """
+    def __init__(self, max_frames=0):
+        self.max_frames = max_frames
+        self.frames = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key, load_fn):
+        if key in self.frames:
+            self.hits += 1
+            self.frames.move_to_end(key)
+            return self.frames[key]
+        self.misses += 1
+        frame = load_fn()
+        if self.max_frames > 0:
+            self.frames[key] = frame
+            if len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+        return frame
+
+
+def window_starts(data_length, timestep, stride=None):
+    # start positions of the windows of `timestep` frames, stride = timestep gives the non-overlapping windows
+    stride = timestep if stride is None else stride
+    return list(range(0, max(data_length - timestep + 1, 0), stride))
+
+
+def window_frame_cache(args, timestep):
+    # a frame is only read twice when the windows overlap (window_stride < timestep), the cache is off otherwise
+    stride = getattr(args, 'window_stride', None)
+    overlap = stride is not None and stride < timestep
+    return FrameCache(getattr(args, 'frame_cache_size', 0) if overlap else 0)
 
 
 class PDEDataset(Dataset):
@@ -10,8 +47,9 @@ class PDEDataset(Dataset):
         super().__init__()
         self.data_folder = data_folder
         self.downsample_rate, self.x_range, self.y_range = downsample_rate, x_range, y_range
-        self.metadata = np.load(os.path.join(data_folder, 'metadata.npy'), allow_pickle=True).tolist()
-        self.file_list = os.listdir(data_folder)
+        # packed, sharded or one file per step, see libs/packed_data.py
+        self.source = FrameSource(data_folder)
+        self.metadata = self.source.metadata
         if 'P_planes' in self.metadata.keys():
             p_plane_name = 'P_planes'
             v_plane_name = 'V_planes'
@@ -20,8 +58,7 @@ class PDEDataset(Dataset):
             v_plane_name = 'V_plane'
         else:
             raise RuntimeError("Not recognized key name!")
-        self.p_plane_files = sorted([onef for onef in self.file_list if p_plane_name in onef])
-        self.v_plane_files = sorted([onef for onef in self.file_list if v_plane_name in onef])
+        self.p_plane_name, self.v_plane_name = p_plane_name, v_plane_name
         self.p_plane_mean, self.p_plane_std = self.metadata[p_plane_name]['mean'], self.metadata[p_plane_name]['std']
         # self.p_plane_max, self.p_plane_min = self.metadata[p_plane_name]['max'], self.metadata[p_plane_name]['min']
         self.v_plane_mean, self.v_plane_std = self.metadata[v_plane_name]['mean'], self.metadata[v_plane_name]['std']
@@ -50,16 +87,14 @@ class PDEDataset(Dataset):
 
     def __getitem__(self, index):
         cur_index = self.data_index[index]
-        p_plane = np.load(os.path.join(self.data_folder, self.p_plane_files[cur_index]))
-        p_plane = torch.tensor(p_plane)
+        p_plane = torch.tensor(self.source.load(self.p_plane_name, cur_index))
         if self.use_patch:
             p_plane = p_plane.reshape(-1, self.x_range, self.y_range)
         else:
             p_plane = p_plane[::self.downsample_rate, ::self.downsample_rate][:self.x_range, :self.y_range]
         p_plane = self.p_norm.encode(p_plane)
         p_plane = p_plane.unsqueeze(-1)
-        v_plane = np.load(os.path.join(self.data_folder, self.v_plane_files[cur_index]))
-        v_plane = torch.tensor(v_plane)
+        v_plane = torch.tensor(self.source.load(self.v_plane_name, cur_index))
         if self.use_patch:
             v_plane = v_plane.reshape(-1, self.x_range, self.y_range)
         else:
@@ -79,12 +114,12 @@ class SequentialPDEDataset(Dataset):
         self.data_folder = data_folder
         self.full_field = full_field
         self.downsample_rate, self.x_range, self.y_range = downsample_rate, x_range, y_range
-        self.metadata = np.load(os.path.join(data_folder, 'metadata.npy'), allow_pickle=True).tolist()
-        self.file_list = os.listdir(data_folder)
+        self.source = FrameSource(data_folder)
+        self.metadata = self.source.metadata
         u_field_name, v_field_name, w_field_name = 'U_field', 'V_field', 'W_field'
-        self.u_field_files = sorted([onef for onef in self.file_list if u_field_name in onef])
-        self.v_field_files = sorted([onef for onef in self.file_list if v_field_name in onef])
-        self.w_field_files = sorted([onef for onef in self.file_list if w_field_name in onef])
+        self.p_plane_name, self.v_plane_name = 'P_planes', 'V_planes'
+        self.p_plane_mean, self.p_plane_std = self.metadata['P_planes']['mean'], self.metadata['P_planes']['std']
+        self.v_plane_mean, self.v_plane_std = self.metadata['V_planes']['mean'], self.metadata['V_planes']['std']
         print("In sequential dataset, the options downsample_rate, x_range and y_range are not supported!")
         self.v_field_mean, self.v_field_std = self.metadata[v_field_name]['mean'], self.metadata[v_field_name]['std']
         self.data_index = data_index
@@ -103,28 +138,33 @@ class SequentialPDEDataset(Dataset):
         
         self.p_norm = NormalizerGivenMeanStd(p_mean, p_std)
         self.v_norm = NormalizerGivenMeanStd(v_mean, v_std)
+        # (overlapping) windows of timestep frames every window_stride frames
+        self.window_starts = window_starts(self.data_length, self.timestep, getattr(args, 'window_stride', None))
+        self.frame_cache = window_frame_cache(args, self.timestep)
         
     def __len__(self):
-        return self.data_length // self.timestep
+        return len(self.window_starts)
+
+    def load_frame(self, cur_index):
+        p_plane = torch.tensor(self.source.load(self.p_plane_name, cur_index))
+        if self.use_patch:
+            p_plane = p_plane.reshape(-1, self.x_range, self.y_range)
+        else:
+            p_plane = p_plane[::self.downsample_rate, ::self.downsample_rate][:self.x_range, :self.y_range]
+        p_plane = self.p_norm.encode(p_plane)
+        v_plane = torch.tensor(self.source.load(self.v_plane_name, cur_index))
+        if self.use_patch:
+            v_plane = v_plane.reshape(-1, self.x_range, self.y_range)
+        else:
+            v_plane = v_plane[::self.downsample_rate, ::self.downsample_rate][:self.x_range, :self.y_range]
+        v_plane = self.v_norm.encode(v_plane)
+        return p_plane, v_plane
 
     def __getitem__(self, index):
         sequential_p, sequential_v = [], []
         for cur_t in range(self.timestep):
-            cur_index = self.data_index[index * self.timestep + cur_t]
-            p_plane = np.load(os.path.join(self.data_folder, self.p_plane_files[cur_index]))
-            p_plane = torch.tensor(p_plane)
-            if self.use_patch:
-                p_plane = p_plane.reshape(-1, self.x_range, self.y_range)
-            else:
-                p_plane = p_plane[::self.downsample_rate, ::self.downsample_rate][:self.x_range, :self.y_range]
-            p_plane = self.p_norm.encode(p_plane)
-            v_plane = np.load(os.path.join(self.data_folder, self.v_plane_files[cur_index]))
-            v_plane = torch.tensor(v_plane)
-            if self.use_patch:
-                v_plane = v_plane.reshape(-1, self.x_range, self.y_range)
-            else:
-                v_plane = v_plane[::self.downsample_rate, ::self.downsample_rate][:self.x_range, :self.y_range]
-            v_plane = self.v_norm.encode(v_plane)
+            cur_index = int(self.data_index[self.window_starts[index] + cur_t])
+            p_plane, v_plane = self.frame_cache.get(cur_index, lambda: self.load_frame(cur_index))
             sequential_p.append(p_plane)
             sequential_v.append(v_plane)
         sequential_p = torch.stack(sequential_p)
@@ -142,14 +182,11 @@ class FullFieldNSDataset(Dataset):
         self.data_folder = data_folder
         self.full_field = full_field
         self.downsample_rate, self.x_range, self.y_range = downsample_rate, x_range, y_range
-        self.metadata = np.load(os.path.join(data_folder, 'metadata.npy'), allow_pickle=True).tolist()
+        self.source = FrameSource(data_folder)
+        self.metadata = self.source.metadata
         self.re = torch.tensor(self.metadata['re'])
         self.dpdx_all = self.metadata['U_field']['dpdx']
-        self.file_list = os.listdir(data_folder)
         u_field_name, v_field_name, w_field_name = 'U_field', 'V_field', 'W_field'
-        self.u_field_files = sorted([onef for onef in self.file_list if u_field_name in onef])
-        self.v_field_files = sorted([onef for onef in self.file_list if v_field_name in onef])
-        self.w_field_files = sorted([onef for onef in self.file_list if w_field_name in onef])
         #  In sequential dataset, the options downsample_rate, x_range and y_range are not supported.
         self.scale_factor = 1
         self.bound_v_mean, self.bound_v_std = self.metadata[v_field_name]['mean'][:, -1, :], self.metadata[v_field_name]['std'][:, -1, :] / self.scale_factor
@@ -157,42 +194,61 @@ class FullFieldNSDataset(Dataset):
         self.data_index = data_index
         self.data_length = len(self.data_index)
         self.plane_indexs = plane_indexs # predict values at these planes
+        # the boundary plane and the target planes of V, the full U/V/W volumes only for the pde loss
+        self.v_planes = [-1] + list(plane_indexs)
+        self.load_volumes = getattr(args, 'pde_loss_weight', 1.0) > 0
         self.bound_v_norm = NormalizerGivenMeanStd(self.bound_v_mean, self.bound_v_std)
         self.v_field_norm = self.bound_v_norm
         p_plane_name = 'P_planes'
         self.p_plane_mean, self.p_plane_std = self.metadata[p_plane_name]['mean'], self.metadata[p_plane_name]['std']
         self.p_plane_norm = NormalizerGivenMeanStd(self.p_plane_mean, self.p_plane_std)
+        # (overlapping) windows of timestep frames every window_stride frames
+        self.window_starts = window_starts(self.data_length, self.timestep, getattr(args, 'window_stride', None))
+        self.frame_cache = window_frame_cache(args, self.timestep)
         
     def __len__(self):
-        return self.data_length // self.timestep
+        return len(self.window_starts)
+
+    def load_frame(self, cur_index):
+        # v_plane, target_v_field and the U/V/W volumes (None without the pde loss) of one step
+        if self.load_volumes:
+            all_v_field = torch.tensor(self.source.load('V_field', cur_index))
+            all_u_field = torch.tensor(self.source.load('U_field', cur_index))
+            all_w_field = torch.tensor(self.source.load('W_field', cur_index))
+            v_planes = all_v_field[:, self.v_planes, :]
+        else:
+            all_u_field = all_v_field = all_w_field = None
+            v_planes = torch.tensor(self.source.load('V_field', cur_index, planes=self.v_planes))
+        v_plane = self.bound_v_norm.encode(v_planes[:, 0, :])
+        target_v_field = []
+        for plane_pos in range(1, len(self.v_planes)):
+            cur_v_field = self.v_field_norm.encode(v_planes[:, plane_pos, :])  # [x, y]
+            target_v_field.append(cur_v_field)
+        target_v_field = torch.stack(target_v_field)
+        return v_plane, target_v_field, all_u_field, all_v_field, all_w_field
 
     def __getitem__(self, index):
         seq_v_plane, seq_v_field = [], []
         seq_u, seq_v, seq_w, seq_dpdx, seq_re = [], [], [], [], []
         for cur_t in range(self.timestep):
-            cur_index = self.data_index[index * self.timestep + cur_t]
+            cur_index = int(self.data_index[self.window_starts[index] + cur_t])
             one_dpdx = self.dpdx_all[cur_index]
             seq_dpdx.append(one_dpdx)
-            all_v_field = torch.tensor(np.load(os.path.join(self.data_folder, self.v_field_files[cur_index])))
-            seq_v.append(all_v_field)
-            all_u_field = torch.tensor(np.load(os.path.join(self.data_folder, self.u_field_files[cur_index])))
-            seq_u.append(all_u_field)
-            all_w_field = torch.tensor(np.load(os.path.join(self.data_folder, self.w_field_files[cur_index])))
-            seq_w.append(all_w_field)
-            v_plane = self.bound_v_norm.encode(all_v_field[:, -1, :])
-            target_v_field = []
-            for plane_id in self.plane_indexs:
-                cur_v_field = self.v_field_norm.encode(all_v_field[:, plane_id, :])  # [x, y]
-                target_v_field.append(cur_v_field)
-            target_v_field = torch.stack(target_v_field)
+            v_plane, target_v_field, all_u_field, all_v_field, all_w_field = self.frame_cache.get(
+                cur_index, lambda: self.load_frame(cur_index))
+            if self.load_volumes:
+                seq_u.append(all_u_field)
+                seq_v.append(all_v_field)
+                seq_w.append(all_w_field)
             seq_v_plane.append(v_plane)
             seq_v_field.append(target_v_field)
             seq_re.append(self.re)
         seq_v_plane = torch.stack(seq_v_plane)  # [T, X, Y]
         seq_v_field = torch.stack(seq_v_field)  # [T, P (plane num), X, Y]
-        seq_u = torch.stack(seq_u)
-        seq_v = torch.stack(seq_v)
-        seq_w = torch.stack(seq_w)
+        if self.load_volumes:
+            seq_u, seq_v, seq_w = torch.stack(seq_u), torch.stack(seq_v), torch.stack(seq_w)
+        else:  # empty placeholders, the pde loss is disabled
+            seq_u = seq_v = seq_w = torch.zeros(self.timestep, 0, dtype=seq_v_plane.dtype)
         seq_re = torch.tensor(seq_re)
         seq_dpdx = torch.tensor(seq_dpdx)
         return seq_v_plane, seq_v_field, seq_u, seq_v, seq_w, seq_re, seq_dpdx
\ No newline at end of file
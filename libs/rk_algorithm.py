@@ -1,49 +1,54 @@
 # RK algorithms for the navier strokes
 import numpy as np
-import matlab.engine
-print("Lauching matlab...")
-eng = matlab.engine.start_matlab()
-print("Lauching finished!")
+from libs.env_util import get_matlab_engine
+
+def y_metrics(y, ym, yg):
+    # 1D metrics of the stretched y grid as column vectors, broadcast over [x, y, z] fields
+    inv_dy = 1 / np.diff(np.reshape(y, -1))[:, np.newaxis]
+    inv_dyg = 1 / np.diff(np.reshape(yg, -1))[:, np.newaxis]
+    inv_dym = 1 / np.diff(np.reshape(ym, -1))[:, np.newaxis]
+    return inv_dy, inv_dyg, inv_dym
+
+
+def pad_y(f):
+    return np.pad(f, ((0, 0), (1, 1), (0, 0)))
+
 
 def compute_RHS(nu, dx, dz, y, ym, yg, Ny, dPdx, U, V, W):
     '''
     Fu = - d(uu)/dx -d(uv)/dy + 1/Re*du/dx + 1/Re*du/dy 
     Fv = - d(uv)/dx -d(vv)/dy + 1/Re*dv/dx + 1/Re*dv/dy 
     '''
+    inv_dy, inv_dyg, inv_dym = y_metrics(y, ym, yg)
     # Prepare some shifted values
-    U_FIRST_LEFT_SHIFT = np.concatenate([U[1:, :, :], U[0, :, :][np.newaxis, :]], axis=0)
-    U_FIRST_RIGHT_SHIFT = np.concatenate([U[-1, :, :][np.newaxis, :], U[:-1, :, :]], axis=0)
-    U_LAST_LEFT_SHIFT = np.concatenate([U[:, :, 1:], U[:, :, 0][:, :, np.newaxis]], axis=-1)
-    U_LAST_RIGHT_SHIFT = np.concatenate([U[:, :, -1][:, :, np.newaxis], U[:, :, :-1]], axis=-1)
-    V_FIRST_LEFT_SHIFT = np.concatenate([V[1:, :, :], V[0, :, :][np.newaxis, :]], axis=0)
-    V_FIRST_RIGHT_SHIFT = np.concatenate([V[-1, :, :][np.newaxis, :], V[:-1, :, :]], axis=0)
-    V_LAST_LEFT_SHIFT = np.concatenate([V[:, :, 1:], V[:, :, 0][:, :, np.newaxis]], axis=-1)
-    V_LAST_RIGHT_SHIFT = np.concatenate([V[:, :, -1][:, :, np.newaxis], V[:, :, :-1]], axis=-1)
-    W_FIRST_LEFT_SHIFT = np.concatenate([W[1:, :, :], W[0, :, :][np.newaxis, :]], axis=0)
-    W_FIRST_RIGHT_SHIFT = np.concatenate([W[-1, :, :][np.newaxis, :], W[0:-1, :, :]], axis=0)
-    W_LAST_LEFT_SHIFT = np.concatenate([W[:, :, 1:], W[:, :, 0][:, :, np.newaxis]], axis=-1)
-    W_LAST_RIGHT_SHIFT = np.concatenate([W[:, :, -1][:, :, np.newaxis], W[:, :, :-1]], axis=-1)
+    U_FIRST_LEFT_SHIFT = np.roll(U, -1, axis=0)
+    U_FIRST_RIGHT_SHIFT = np.roll(U, 1, axis=0)
+    U_LAST_LEFT_SHIFT = np.roll(U, -1, axis=-1)
+    U_LAST_RIGHT_SHIFT = np.roll(U, 1, axis=-1)
+    V_FIRST_LEFT_SHIFT = np.roll(V, -1, axis=0)
+    V_FIRST_RIGHT_SHIFT = np.roll(V, 1, axis=0)
+    V_LAST_LEFT_SHIFT = np.roll(V, -1, axis=-1)
+    V_LAST_RIGHT_SHIFT = np.roll(V, 1, axis=-1)
+    W_FIRST_LEFT_SHIFT = np.roll(W, -1, axis=0)
+    W_FIRST_RIGHT_SHIFT = np.roll(W, 1, axis=0)
+    W_LAST_LEFT_SHIFT = np.roll(W, -1, axis=-1)
+    W_LAST_RIGHT_SHIFT = np.roll(W, 1, axis=-1)
     
     # Compute Fu
-    Fu = np.zeros_like(U)
     # Compute -d(uu)/dx
-    UU = (0.5 * (U + np.roll(U, -1, axis=0)))**2
-    UU_SHIFT = np.concatenate([UU[-1, :, :][np.newaxis, :], UU[0:-1, :, :]], axis=0)
-    Fu -= (UU - UU_SHIFT) / dx
+    UU = (0.5 * (U + U_FIRST_LEFT_SHIFT))**2
+    Fu = - (UU - np.roll(UU, 1, axis=0)) / dx
     # Compute -d(uv)/dy
     UV = (0.5 * (V + V_FIRST_RIGHT_SHIFT)) * (0.5 * (U[:, :-1, :] + U[:, 1:, :]))
-    for i in range(1, Ny):
-        Fu[:, i, :] -= (UV[:, i, :] - UV[:, i-1, :]) / (y[i] - y[i-1])
+    Fu -= pad_y(np.diff(UV, axis=1) * inv_dy)
     # Compute -d(uw)/dz
     UW = (0.5 * (W + W_FIRST_RIGHT_SHIFT)) * (0.5 * (U + U_LAST_RIGHT_SHIFT))
-    UW_SHIFT_LAST = np.concatenate([UW[:, :, 1:], UW[:, :, 0][:, :, np.newaxis]], axis=-1)
-    Fu -= (UW_SHIFT_LAST - UW) / dz
+    Fu -= (np.roll(UW, -1, axis=-1) - UW) / dz
     # Compute 1/Re*d^2u/dx^2
     Fu += nu * (U_FIRST_LEFT_SHIFT - 2*U + U_FIRST_RIGHT_SHIFT) / dx**2
+    # Compute 1/Re*d^2u/dy^2
+    Fu += nu * pad_y(np.diff(np.diff(U, axis=1) * inv_dyg, axis=1) * inv_dy)
     # Compute 1/Re*d^2u/dz^2
-    for i in range(1, Ny):
-        Fu[:, i, :] += nu * ((U[:, i+1, :] - U[:, i, :]) / (yg[i+1] - yg[i]) -
-                             (U[:, i, :] - U[:, i-1, :]) / (yg[i] - yg[i-1])) / (y[i] - y[i-1])
     Fu += nu * (U_LAST_LEFT_SHIFT - 2*U + U_LAST_RIGHT_SHIFT) / dz**2
     # Add pressure gradient
     Fu += dPdx
@@ -52,51 +57,34 @@ def compute_RHS(nu, dx, dz, y, ym, yg, Ny, dPdx, U, V, W):
     Fu[:, -1, :] = -Fu[:, -2, :]
 
     # Compute Fv
-    Fv = np.zeros_like(V)
     # Compute -d(uv)/dx
-    UV = (0.5 * (V + V_FIRST_RIGHT_SHIFT)) * (0.5 * (U[:, :-1, :] + U[:, 1:, :]))
-    UV_FIRST_RIGHT_SHIFT = np.concatenate([UV[-1, :, :][np.newaxis, :], UV[:-1, :, :]], axis=0)
-    Fv -= (UV - UV_FIRST_RIGHT_SHIFT) / dx
-    
+    Fv = - (UV - np.roll(UV, 1, axis=0)) / dx
     # Compute -d(vv)/dy
     VV = (0.5 * (V[:, :-1, :] + V[:, 1:, :]))**2
-    for i in range(1, Ny-1):
-        Fv[:, i, :] -= (VV[:, i, :] - VV[:, i-1, :]) / (ym[i] - ym[i-1])
-    
+    Fv -= pad_y(np.diff(VV, axis=1) * inv_dym)
     # Compute -d(vw)/dz
     VW = 0.5 * (V + V_LAST_RIGHT_SHIFT) * 0.5 * (W[:, :-1, :] + W[:, 1:, :])
-    VW_LAST_RIGHT_SHIFT = np.concatenate([VW[:, :, -1][:, :, np.newaxis], VW[:, :, :-1]], axis=-1)
-    Fv -= (VW - VW_LAST_RIGHT_SHIFT) / dz
+    Fv -= (VW - np.roll(VW, 1, axis=-1)) / dz
     # Compute nu*d^2v/dx^2
     Fv += nu * (V_FIRST_LEFT_SHIFT - 2*V + V_FIRST_RIGHT_SHIFT) / dx**2
-    for i in range(1, Ny-1):
-        Fv[:, i, :] += nu * ((V[:, i+1, :] - V[:, i, :]) / (y[i+1] - y[i]) -
-                             (V[:, i, :] - V[:, i-1, :]) / (y[i] - y[i-1])) / (ym[i] - ym[i-1])
+    Fv += nu * pad_y(np.diff(np.diff(V, axis=1) * inv_dy, axis=1) * inv_dym)
     Fv += nu * (V_LAST_LEFT_SHIFT - 2*V + V_LAST_RIGHT_SHIFT) / dz**2
     # Boundary conditions
     Fv[:, 0, :] = 0
     Fv[:, -1, :] = 0
     
     # Compute Fw
-    Fw = np.zeros_like(W)
     # Compute -d(uw)/dx
-    UW = 0.5 * (W + W_FIRST_RIGHT_SHIFT) * (0.5 * (U + U_LAST_RIGHT_SHIFT))
-    UW_FIRST_LEFT_SHIFT =  np.concatenate([UW[1:, :, :], UW[0, :, :][np.newaxis, :]], axis=0)
-    Fw -= (UW_FIRST_LEFT_SHIFT - UW) / dx
+    Fw = - (np.roll(UW, -1, axis=0) - UW) / dx
     # Compute -d(vw)/dy
-    VW = (0.5 * (V + V_LAST_RIGHT_SHIFT)) * (0.5 * (W[:, :-1, :] + W[:, 1:, :]))
-    for i in range(1, Ny):
-        Fw[:, i, :] -= (VW[:, i, :] - VW[:, i-1, :]) / (y[i] - y[i-1])
+    Fw -= pad_y(np.diff(VW, axis=1) * inv_dy)
     # Compute -d(ww)/dz
     WW = (0.5 * (W + W_LAST_LEFT_SHIFT))**2
-    WW_LAST_RIGHT_SHIFT = np.concatenate([WW[:, :, -1][:, :, np.newaxis], WW[:, :, :-1]], axis=-1)
-    Fw -= (WW - WW_LAST_RIGHT_SHIFT) / dz
+    Fw -= (WW - np.roll(WW, 1, axis=-1)) / dz
     # Compute nu*d^2w/dx^2
     Fw += nu * (W_FIRST_LEFT_SHIFT - 2*W + W_FIRST_RIGHT_SHIFT) / dx**2
     # Compute nu*d^2w/dz^2
-    for i in range(1, Ny):
-        Fw[:, i, :] += nu * ((W[:, i+1, :] - W[:, i, :]) / (yg[i+1] - yg[i]) -
-                             (W[:, i, :] - W[:, i-1, :]) / (yg[i] - yg[i-1])) / (y[i] - y[i-1])
+    Fw += nu * pad_y(np.diff(np.diff(W, axis=1) * inv_dyg, axis=1) * inv_dy)
     Fw = Fw + nu * ( W_LAST_LEFT_SHIFT - 2*W + W_LAST_RIGHT_SHIFT)/dz**2
     # Boundary conditions
     Fw[:, 0, :] = -Fw[:, 1, :]
@@ -104,23 +92,23 @@ def compute_RHS(nu, dx, dz, y, ym, yg, Ny, dPdx, U, V, W):
     return Fu, Fv, Fw
 
 
+def compute_div(dx, dz, y, U, V, W):
+    # divergence at the cell centers, [Nx, Ny-1, Nz]
+    inv_dy = 1 / np.diff(np.reshape(y, -1))[:, np.newaxis]
+    U, W = U[:, 1:-1, :], W[:, 1:-1, :]
+    return (np.roll(U, -1, axis=0) - U) / dx + np.diff(V, axis=1) * inv_dy + (np.roll(W, -1, axis=-1) - W) / dz
+
+
 def compute_pressure(Nx, Ny, Nz, dx, dz, y, kxx, kzz, DD, nu, ym, yg, dPdx, U, V, W):
     # Compute pressure term by solving Poisson equation
     # Compute the RHS of the NS equation
     RHS_u, RHS_v, RHS_w = compute_RHS(nu, dx, dz, y, ym, yg, Ny, dPdx, U, V, W)
     # RHS_p is computed at cell center
     # Compute the RHS of the pressure Poisson equation by taking the divergence
-    RHS_p = np.zeros((Nx, Ny-1, Nz))
-    for i in range(Ny-1):
-        RHS_u_FIRST_LEFT_SHIFT = np.concatenate([RHS_u[1:, i+1, :], RHS_u[0, i+1, :][np.newaxis, :]], axis=0)
-        RHS_w_LAST_LEFT_SHIFT = np.concatenate([RHS_w[:, i+1, 1:], RHS_w[:, :, 0][:, i+1, np.newaxis]], axis=-1)
-        RHS_p[:, i, :] = (RHS_u_FIRST_LEFT_SHIFT - RHS_u[:, i+1, :]) / dx + \
-                         (RHS_v[:, i+1, :] - RHS_v[:, i, :]) / (y[i+1] - y[i]) + \
-                         (RHS_w_LAST_LEFT_SHIFT - RHS_w[:, i+1, :]) / dz
+    RHS_p = compute_div(dx, dz, y, RHS_u, RHS_v, RHS_w)
 
     transpose_rhsp = np.transpose(RHS_p, (0, 2, 1))
-    # RHS_p_hat = np.fft.fft2(transpose_rhsp)
-    RHS_p_hat = np.array(eng.fft2(np.ascontiguousarray(transpose_rhsp)))
+    RHS_p_hat = np.fft.fft2(transpose_rhsp, axes=(0, 1))
     for i in range(Nx):
         for j in range(Nz):
             kk = kxx[i] + kzz[j]
@@ -129,7 +117,7 @@ def compute_pressure(Nx, Ny, Nz, dx, dz, y, kxx, kzz, DD, nu, ym, yg, dPdx, U, V
                 D[0, 0] = 1.5 * D[0, 0]
             RHS_p_hat[i, j, :] = np.linalg.solve(D, np.squeeze(RHS_p_hat[i, j, :]))
     # Transform back to physical space to get pressure
-    ifft_RHS_p = np.array(eng.ifft2(np.ascontiguousarray(RHS_p_hat)))
+    ifft_RHS_p = np.fft.ifft2(RHS_p_hat, axes=(0, 1))
     P = np.real(np.transpose(ifft_RHS_p, (0, 2, 1)))
     return P
 
@@ -139,6 +127,7 @@ def matlab_fft(matrix, dim, ifft=False):
     arg1 = matrix
     arg2 = []
     arg3 = dim
+    eng = get_matlab_engine()
     eng.workspace['arg1'] = arg1
     eng.workspace['arg2'] = arg2
     eng.workspace['arg3'] = arg3
@@ -148,13 +137,7 @@ def matlab_fft(matrix, dim, ifft=False):
     
 def compute_projection_step(dx, dz, ym, y, kxx, kzz, Nx, Ny, Nz, DD, Uin, Vin, Win):
     # Compute divergence of velocity field
-    p = np.zeros((Nx, Ny-1, Nz))
-    for i in range(Ny-1):
-        Uin_FIRST_LEFT_SHIFT = np.concatenate([Uin[1:, i+1, :], Uin[0, i+1, :][np.newaxis, :]], axis=0)
-        Win_LAST_LEFT_SHIFT = np.concatenate([Win[:, i+1, 1:], Win[:, :, 0][:, i+1, np.newaxis]], axis=-1)
-        p[:, i, :] = (Uin_FIRST_LEFT_SHIFT - Uin[:, i+1, :]) / dx + \
-                    (Vin[:, i+1, :] - Vin[:, i, :]) / (y[i+1] - y[i]) + \
-                    (Win_LAST_LEFT_SHIFT - Win[:, i+1, :]) / dz
+    p = compute_div(dx, dz, y, Uin, Vin, Win)
     # Solve Poisson equation for p
     # Fourier transform
     fft_p = matlab_fft(np.ascontiguousarray(p), 3)
@@ -179,11 +162,10 @@ def compute_projection_step(dx, dz, ym, y, kxx, kzz, Nx, Ny, Nz, DD, Uin, Vin, W
     Uout = Uin.copy()
     Vout = Vin.copy()
     Wout = Win.copy()
-    p_FIRST_RIGHT_SHIFT = np.concatenate([p[-1, :, :][np.newaxis, :], p[:-1, :, :]], axis=0)
-    p_LAST_RIGHT_SHIFT = np.concatenate([p[:, :, -1][:, :, np.newaxis], p[:, :, :-1]], axis=-1)
+    p_FIRST_RIGHT_SHIFT = np.roll(p, 1, axis=0)
+    p_LAST_RIGHT_SHIFT = np.roll(p, 1, axis=-1)
     Uout[:, 1:-1, :] = Uout[:, 1:-1, :] - (p - p_FIRST_RIGHT_SHIFT) / dx
-    for i in range(1, Ny-1):
-        Vout[:, i, :] = Vout[:, i, :] - (p[:, i, :] - p[:, i-1, :]) / (ym[i] - ym[i-1])
+    Vout[:, 1:-1, :] = Vout[:, 1:-1, :] - np.diff(p, axis=1) / np.diff(np.reshape(ym, -1))[:, np.newaxis]
     Wout[:, 1:-1, :] = Wout[:, 1:-1, :] - (p - p_LAST_RIGHT_SHIFT) / dz
 
     return Uout, Vout, Wout
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class RunningStats:
+    """
+    Per-point mean and variance of a stream of arrays (Welford), O(field size) per update.
+    Accumulators of different shards or processes are combined with merge (Chan et al.).
+    std is the population std, as np.std(samples, axis=0).
+    """
+    def __init__(self, count=0, mean=None, m2=None):
+        self.count, self.mean, self.m2 = count, mean, m2
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.mean is None:
+            self.mean, self.m2 = np.zeros_like(x), np.zeros_like(x)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def state(self):
+        # the metadata entry of a field: mean / std for the datasets, count / m2 to merge later
+        return {'mean': self.mean.copy(), 'std': self.std, 'count': self.count, 'm2': self.m2.copy()}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['count'], np.array(state['mean'], dtype=np.float64), np.array(state['m2'], dtype=np.float64))
+
+
+def merge_metadata_stats(metadatas, names):
+    """
+    Combined stats of several collection runs (metadata dicts), for the given field names.
+    """
+    merged = {}
+    for name in names:
+        stats = RunningStats()
+        for metadata in metadatas:
+            stats.merge(RunningStats.from_state(metadata[name]))
+        merged[name] = stats.state()
+    return merged
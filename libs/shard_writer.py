@@ -0,0 +1,128 @@
+import os
+import queue
+import threading
+import numpy as np
+from libs.running_stats import RunningStats
+
+# Background writer of the collected control data. Every field is appended to chunked shard files
+# <folder>/shards/<field>_<k>.npy of shape [shard_size, *field_shape] (plain .npy, np.load(..., mmap_mode='r')
+# gives a memory mapped view), the step indices and the shard files are kept in metadata['shards'].
+# The per-point mean / std of every field over the whole run are accumulated on the way (RunningStats)
+# and stored in metadata[<field>].
+
+
+class ShardedWriter:
+    """
+    Fed by the control loop through a bounded queue, the solver only waits when the writer falls
+    queue_size steps behind. layout: 'shards' (append-only shard files) or 'npy' (one <field>_<step>.npy
+    per step, the per-file layout of the dataset classes).
+    """
+    def __init__(self, folder, shard_size=100, queue_size=8, layout='shards'):
+        if layout not in ['shards', 'npy']:
+            raise RuntimeError(f"Not supported collect format: {layout}")
+        self.folder, self.shard_size, self.layout = folder, shard_size, layout
+        self.shard_folder = os.path.join(folder, 'shards')
+        if layout == 'shards':
+            os.makedirs(self.shard_folder, exist_ok=True)
+        self.index = {'shard_size': shard_size, 'steps': [], 'files': {}}
+        self.open_shards, self.rows = {}, 0
+        self.stats = {}
+        self.error, self.closed = None, False
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, step, fields):
+        # fields: {name: array}, copied here so the solver can keep updating its buffers
+        self.check()
+        self.queue.put(('fields', step, {name: np.array(a) for name, a in fields.items()}))
+
+    def save_metadata(self, metadata):
+        # written after every field queued before, metadata['shards'] describes the shards written so far
+        self.check()
+        metadata = {k: dict(v) if isinstance(v, dict) else v for k, v in metadata.items()}
+        self.queue.put(('metadata', None, metadata))
+
+    def close(self, metadata=None):
+        # safe to call again and after a failure (the metadata is then dropped), the thread is always joined
+        if not self.closed:
+            self.closed = True
+            try:
+                if metadata is not None:
+                    self.save_metadata(metadata)
+            finally:
+                self.queue.put(('close', None, None))
+                self.thread.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError(f"Data writer failed: {self.error!r}")
+
+    def run(self):
+        while True:
+            kind, step, item = self.queue.get()
+            try:
+                if self.error is None:
+                    if kind == 'fields':
+                        self.write(step, item)
+                    elif kind == 'metadata':
+                        self.flush()
+                        for name, stats in self.stats.items():
+                            item[name] = {**item.get(name, {}), **stats.state()}
+                        if self.layout == 'shards':
+                            item['shards'] = {**self.index, 'steps': list(self.index['steps']),
+                                              'files': {k: list(v) for k, v in self.index['files'].items()}}
+                        np.save(os.path.join(self.folder, 'metadata.npy'), item)
+                    elif kind == 'close':
+                        self.finish()
+            except Exception as e:
+                self.error = e
+            if kind == 'close':
+                return
+
+    def write(self, step, fields):
+        for name, a in fields.items():
+            self.stats.setdefault(name, RunningStats()).update(a)
+        if self.layout == 'npy':
+            idx_str = str(step).zfill(6)
+            for name, a in fields.items():
+                np.save(os.path.join(self.folder, f'{name}_{idx_str}.npy'), a)
+            return
+        row = self.rows % self.shard_size
+        for name, a in fields.items():
+            if row == 0:
+                file_name = f'{name}_{len(self.index["files"].get(name, [])):05d}.npy'
+                self.index['files'].setdefault(name, []).append(file_name)
+                self.open_shards[name] = np.lib.format.open_memmap(
+                    os.path.join(self.shard_folder, file_name), mode='w+', dtype=a.dtype,
+                    shape=(self.shard_size,) + a.shape)
+            self.open_shards[name][row] = a
+        self.index['steps'].append(step)
+        self.rows += 1
+        if self.rows % self.shard_size == 0:
+            self.flush()
+            self.open_shards = {}
+
+    def flush(self):
+        for shard in self.open_shards.values():
+            shard.flush()
+
+    def finish(self):
+        # the last shard is cut to the rows written, so every shard file has its exact length
+        rows = self.rows % self.shard_size
+        last = {name: np.array(shard[:rows]) for name, shard in self.open_shards.items()}
+        self.open_shards = {}
+        for name, data in last.items():
+            np.save(os.path.join(self.shard_folder, self.index['files'][name][-1]), data)
+
+
+def read_shards(folder, name, metadata=None, mmap_mode='r'):
+    """
+    The shards of one field (memory mapped unless mmap_mode is None) and the step index of every row.
+    """
+    if metadata is None:
+        metadata = np.load(os.path.join(folder, 'metadata.npy'), allow_pickle=True).tolist()
+    index = metadata['shards']
+    shards = [np.load(os.path.join(folder, 'shards', f), mmap_mode=mmap_mode) for f in index['files'][name]]
+    return shards, np.array(index['steps'])
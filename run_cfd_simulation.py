@@ -131,6 +131,7 @@ IMPORTANT: Take care to select a timestep that ensures stability
 import matplotlib.pyplot as plt
 import numpy as np
 from tqdm import tqdm
+from libs.envs.multigrid_poisson import MultigridPoisson
 
 N_POINTS = 41
 DOMAIN_SIZE = 1.0
@@ -141,6 +142,8 @@ DENSITY = 1.0
 HORIZONTAL_VELOCITY_TOP = 1.0
 
 N_PRESSURE_POISSON_ITERATIONS = 50
+PRESSURE_SOLVER = "multigrid"  # "multigrid" (V-cycles down to the tolerance) or "jacobi" (fixed number of sweeps)
+MULTIGRID_TOLERANCE = 1e-8
 STABILITY_SAFETY_FACTOR = 0.5
 
 def main():
@@ -203,6 +206,15 @@ def main():
     if TIME_STEP_LENGTH > STABILITY_SAFETY_FACTOR * maximum_possible_time_step_length:
         raise RuntimeError("Stability is not guarenteed")
 
+    # Interior unknowns of the pressure, walls ordered (bottom, top, left, right):
+    # homogeneous Neumann except for the homogeneous Dirichlet at the top
+    multigrid = MultigridPoisson(
+        (N_POINTS - 2, N_POINTS - 2),
+        element_length,
+        element_length,
+        bc=("neumann", "dirichlet", "neumann", "neumann"),
+    )
+
     
     for _ in tqdm(range(N_ITERATIONS)):
         d_u_prev__d_x = central_difference_x(u_prev)
@@ -269,32 +281,46 @@ def main():
             )
         )
 
-        for _ in range(N_PRESSURE_POISSON_ITERATIONS):
+        if PRESSURE_SOLVER == "multigrid":
             p_next = np.zeros_like(p_prev)
-            p_next[1:-1, 1:-1] = 1/4 * (
-                +
-                p_prev[1:-1, 0:-2]
-                +
-                p_prev[0:-2, 1:-1]
-                +
-                p_prev[1:-1, 2:  ]
-                +
-                p_prev[2:  , 1:-1]
-                -
-                element_length**2
-                *
-                rhs[1:-1, 1:-1]
+            p_next[1:-1, 1:-1] = multigrid.solve(
+                rhs[1:-1, 1:-1],
+                x0=p_prev[1:-1, 1:-1],
+                tol=MULTIGRID_TOLERANCE,
             )
 
-            # Pressure Boundary Conditions: Homogeneous Neumann Boundary
-            # Conditions everywhere except for the top, where it is a
-            # homogeneous Dirichlet BC
+            # Same Pressure Boundary Conditions as the Jacobi sweeps
             p_next[:, -1] = p_next[:, -2]
             p_next[0,  :] = p_next[1,  :]
             p_next[:,  0] = p_next[:,  1]
             p_next[-1, :] = 0.0
+        else:
+            for _ in range(N_PRESSURE_POISSON_ITERATIONS):
+                p_next = np.zeros_like(p_prev)
+                p_next[1:-1, 1:-1] = 1/4 * (
+                    +
+                    p_prev[1:-1, 0:-2]
+                    +
+                    p_prev[0:-2, 1:-1]
+                    +
+                    p_prev[1:-1, 2:  ]
+                    +
+                    p_prev[2:  , 1:-1]
+                    -
+                    element_length**2
+                    *
+                    rhs[1:-1, 1:-1]
+                )
+
+                # Pressure Boundary Conditions: Homogeneous Neumann Boundary
+                # Conditions everywhere except for the top, where it is a
+                # homogeneous Dirichlet BC
+                p_next[:, -1] = p_next[:, -2]
+                p_next[0,  :] = p_next[1,  :]
+                p_next[:,  0] = p_next[:,  1]
+                p_next[-1, :] = 0.0
 
-            p_prev = p_next
+                p_prev = p_next
         
 
         d_p_next__d_x = central_difference_x(p_next)
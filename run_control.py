@@ -13,6 +13,7 @@ from libs.envs.ns_control_2d import NSControlEnv2D
 from libs.unet_models import *
 from libs.models.fno_models import *
 from libs.pde_data_loader import *
+from libs.shard_writer import ShardedWriter
 from libs.visualization import *
 from libs.arguments import *
 from tqdm import tqdm
@@ -33,6 +34,13 @@ def run_control(args, observer_model=None, policy_model=None, train_dataset=None
         device = next(observer_model.parameters()).device
     else:
         device = None
+    # solver_backend: distributed runs this loop on every torchrun process, the process group is created
+    # before the env. Every rank takes part in the gathers of the collected, dumped and visualized fields,
+    # only rank 0 (main_process) logs to wandb and writes files
+    main_process = True
+    if getattr(args, 'solver_backend', 'python') == 'distributed':
+        from libs.envs.channel_distributed import init_distributed
+        main_process = init_distributed()[0] == 0
     args.vis_interval = max(args.control_timestep // args.vis_frame, 1) if args.vis_frame > 0 else -1
     if args.policy_name == 'fno' or args.policy_name == 'rno':
         if observer_model is None:
@@ -79,7 +87,7 @@ def run_control(args, observer_model=None, policy_model=None, train_dataset=None
         exp_name += str(config_dict[one_v])
         exp_name += "; "
 
-    if not args.close_wandb and not wandb_exist:
+    if not args.close_wandb and not wandb_exist and main_process:
         print("Init wandb!")
         wandb.init(
             project=args.project_name + "_" + args.path_name,
@@ -113,13 +121,20 @@ def run_control(args, observer_model=None, policy_model=None, train_dataset=None
  
     if args.collect_data:
         collect_data_folder = os.path.join(args.output_dir, args.exp_name)
-        os.makedirs(collect_data_folder, exist_ok=True)
+        data_writer = None
+        if main_process:
+            os.makedirs(collect_data_folder, exist_ok=True)
+            data_writer = ShardedWriter(collect_data_folder, shard_size=getattr(args, 'collect_shard_size', 100),
+                                        queue_size=getattr(args, 'collect_queue_size', 8),
+                                        layout=getattr(args, 'collect_format', 'shards'))
+        collect_flush_interval = getattr(args, 'collect_flush_interval', 100)
+        collected = 0
     else:
         collect_data_folder = None
     
     if train_dataset is not None:
         demo_dataset = train_dataset
-    elif args.policy_name not in ["gt", "rand", "unmanipulated"]:
+    elif args.policy_name not in ["gt", "rand", "unmanipulated", "optimal-solver"]:
         demo_dataset = PDEDataset(args, args.DATA_FOLDER, [1, 2, 3, 4, 5], args.downsample_rate, args.x_range, 
                                 args.y_range, use_patch=False)
     else:
@@ -129,197 +144,212 @@ def run_control(args, observer_model=None, policy_model=None, train_dataset=None
     # main control loop
     ################################################################
     
-    pressure_v, opV2_v, top_view_v, front_view_v, side_view_v, all_p_boundary, all_v_boundary = [], [], [], [], [], [], []
-    metadata = {}
-    all_u_field, all_v_field, all_w_field, all_dpdx, all_dudt = [], [], [], [], []
-    for i in (pbar := tqdm(range(args.control_timestep + 1))):
-        # pressure: [32, 32], opV2: [32, 32]
-        if args.policy_name in ['fno', 'rno']:  # neural policies
-            p1, p2 = control_env.get_boundary_pressures()
-            side_pressure = torch.tensor(p2)
-            side_pressure = demo_dataset.p_plane_norm.encode(side_pressure).cuda()
-            side_pressure = side_pressure.reshape(-1, args.x_range, args.y_range, 1).float()
-        if args.policy_name == 'rand':
-            opV2 = control_env.rand_control()
-            opV2 *= args.rand_scale
-        elif args.policy_name == 'fno':
-            opV2 = observer_model(side_pressure, None).reshape(-1, args.x_range, args.y_range)
-            opV2 = demo_dataset.p_norm.decode(opV2.cpu())
-            opV2 = opV2.detach().numpy().squeeze()
-        elif args.policy_name == 'rno':
-            side_pressure = side_pressure.reshape(-1, 1, args.x_range, args.y_range, 1)
-            opV2 = observer_model(side_pressure, None).squeeze()
-            opV2 = demo_dataset.p_norm.decode(opV2.cpu())
-            opV2 = opV2.detach().numpy().squeeze()
-            opV1 = opV2 * 0
-        elif args.policy_name == 'gt':
-            p1, p2 = control_env.get_boundary_pressures()
-            opV1, opV2 = control_env.gt_control()
-        elif args.policy_name == 'unmanipulated':
-            opV1, opV2 = control_env.gt_control()
-            opV1 *= 0
-            opV2 *= 0
-        elif args.policy_name == 'optimal-policy-observer':
-            p1, p2 = control_env.get_boundary_pressures()
-            opV1, opV2 = control_env.gt_control()   # one-side control
-            opV2 = torch.tensor(opV2).float().to(device).unsqueeze(0).unsqueeze(0)
-            opV2 = torch.einsum('btxy -> bxyt', opV2).unsqueeze(-1)  # expand feature dim
-            re = torch.tensor(control_env.Re).to(device).unsqueeze(0).float()
-            p2 = torch.tensor(p2).to(device).float()
-            p2 = p2.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-            optimizer = optim.Adam(policy_model.parameters(), lr=1e-4)
-            res_opV2 = policy_model(p2, re)
-            pred_v_field = observer_model(opV2 + res_opV2, re)
-            reg_weight = 0.1
-            initial_loss = torch.norm(pred_v_field) + reg_weight * torch.norm(opV2 + res_opV2)  # minimize this.
-            print("Initial Loss:", initial_loss.item())
-            num_epochs = 3
-            for epoch in range(num_epochs):
-                optimizer.zero_grad()  # Zero the gradients
+    pressure_v, opV2_v, top_view_v, front_view_v, side_view_v = [], [], [], [], []
+    metadata, all_dpdx = {}, []
+    explode_retries = getattr(args, 'explode_retries', 0)
+    rollback_steps = getattr(args, 'rollback_steps', 1)
+    # what changes on a retry, the same control from the same state explodes again:
+    # halve_dt (halves dt, or the cfl number with adaptive_dt) or damp_control (halves the controls)
+    explode_remedy = getattr(args, 'explode_remedy', 'halve_dt')
+    if explode_remedy not in ['halve_dt', 'damp_control']:
+        raise RuntimeError(f"Not supported explode remedy: {explode_remedy}")
+    control_scale = 1.0
+    # env step of the next state to collect, the states replayed after a rollback are not collected twice
+    next_collect_step = 0
+    # the writer is closed on the way out of an exception as well (e.g. an explosion), its thread is a daemon
+    # and would drop the queued frames, the stats and the trim of the last shard
+    try:
+        for i in (pbar := tqdm(range(args.control_timestep + 1))):
+            # pressure: [32, 32], opV2: [32, 32]
+            if args.policy_name in ['fno', 'rno']:  # neural policies
+                p1, p2 = control_env.get_boundary_pressures()
+                side_pressure = torch.tensor(p2)
+                side_pressure = demo_dataset.p_plane_norm.encode(side_pressure).cuda()
+                side_pressure = side_pressure.reshape(-1, args.x_range, args.y_range, 1).float()
+            if args.policy_name == 'rand':
+                opV2 = control_env.rand_control()
+                opV2 *= args.rand_scale
+            elif args.policy_name == 'fno':
+                opV2 = observer_model(side_pressure, None).reshape(-1, args.x_range, args.y_range)
+                opV2 = demo_dataset.p_norm.decode(opV2.cpu())
+                opV2 = opV2.detach().numpy().squeeze()
+            elif args.policy_name == 'rno':
+                side_pressure = side_pressure.reshape(-1, 1, args.x_range, args.y_range, 1)
+                opV2 = observer_model(side_pressure, None).squeeze()
+                opV2 = demo_dataset.p_norm.decode(opV2.cpu())
+                opV2 = opV2.detach().numpy().squeeze()
+                opV1 = opV2 * 0
+            elif args.policy_name == 'gt':
+                p1, p2 = control_env.get_boundary_pressures()
+                opV1, opV2 = control_env.gt_control()
+            elif args.policy_name == 'unmanipulated':
+                opV1, opV2 = control_env.gt_control()
+                opV1 *= 0
+                opV2 *= 0
+            elif args.policy_name == 'optimal-policy-observer':
+                p1, p2 = control_env.get_boundary_pressures()
+                opV1, opV2 = control_env.gt_control()   # one-side control
+                opV2 = torch.tensor(opV2).float().to(device).unsqueeze(0).unsqueeze(0)
+                opV2 = torch.einsum('btxy -> bxyt', opV2).unsqueeze(-1)  # expand feature dim
+                re = torch.tensor(control_env.Re).to(device).unsqueeze(0).float()
+                p2 = torch.tensor(p2).to(device).float()
+                p2 = p2.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
+                optimizer = optim.Adam(policy_model.parameters(), lr=1e-4)
                 res_opV2 = policy_model(p2, re)
-                pred_v_field = observer_model(opV2 + res_opV2, re)  # Forward pass
-                loss = torch.norm(pred_v_field) + reg_weight * torch.norm(opV2 + res_opV2) # minimize this.
-                loss.backward()  # Backpropagation
-                optimizer.step()  # Update the parameters
-            opV2 += res_opV2
-            opV2 = opV2.detach().cpu().numpy().squeeze()            
-        elif args.policy_name == 'optimal-observer':
-            opV1, opV2 = control_env.gt_control()   # one-side control
-            opV2 = torch.tensor(opV2).float().to(device).unsqueeze(0).unsqueeze(0)
-            opV2 = torch.einsum('btxy -> bxyt', opV2).unsqueeze(-1)  # expand feature dim
-            re = torch.tensor(control_env.Re).to(device).unsqueeze(0)
+                pred_v_field = observer_model(opV2 + res_opV2, re)
+                reg_weight = 0.1
+                initial_loss = torch.norm(pred_v_field) + reg_weight * torch.norm(opV2 + res_opV2)  # minimize this.
+                print("Initial Loss:", initial_loss.item())
+                num_epochs = 3
+                for epoch in range(num_epochs):
+                    optimizer.zero_grad()  # Zero the gradients
+                    res_opV2 = policy_model(p2, re)
+                    pred_v_field = observer_model(opV2 + res_opV2, re)  # Forward pass
+                    loss = torch.norm(pred_v_field) + reg_weight * torch.norm(opV2 + res_opV2) # minimize this.
+                    loss.backward()  # Backpropagation
+                    optimizer.step()  # Update the parameters
+                opV2 += res_opV2
+                opV2 = opV2.detach().cpu().numpy().squeeze()            
+            elif args.policy_name == 'optimal-observer':
+                opV1, opV2 = control_env.gt_control()   # one-side control
+                opV2 = torch.tensor(opV2).float().to(device).unsqueeze(0).unsqueeze(0)
+                opV2 = torch.einsum('btxy -> bxyt', opV2).unsqueeze(-1)  # expand feature dim
+                re = torch.tensor(control_env.Re).to(device).unsqueeze(0)
             
-            # Instantiate the optimizer
-            optimizer = optim.Adam([opV2], lr=0.001)  # You can adjust the learning rate
-            opV2.requires_grad = True
-            # Normalize and forward model
-            norm_opV2 = train_dataset.bound_v_norm.cuda_encode(opV2.squeeze()).float()
-            norm_opV2 = norm_opV2.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-            norm_pred_v_field = observer_model(norm_opV2, re)
-            pred_field = []
-            for plane_index in range(len(train_dataset.plane_indexs)):
-                pred_one_plane = norm_pred_v_field[:, plane_index, :, :]
-                pred_one_plane = train_dataset.v_field_norm.cuda_decode(pred_one_plane)
-                pred_field.append(pred_one_plane)
-            pred_field = torch.stack(pred_field, dim=2)
-            reg_weight = 0.1
-            initial_loss = torch.norm(pred_field) + reg_weight * torch.norm(opV2) # minimize this.
-            # print("Initial Loss:", initial_loss.item())
-            num_epochs = 10
-            for epoch in range(num_epochs):
-                optimizer.zero_grad()  # Zero the gradients
+                # Instantiate the optimizer
+                optimizer = optim.Adam([opV2], lr=0.001)  # You can adjust the learning rate
+                opV2.requires_grad = True
+                # Normalize and forward model
                 norm_opV2 = train_dataset.bound_v_norm.cuda_encode(opV2.squeeze()).float()
                 norm_opV2 = norm_opV2.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
-                norm_pred_v_field = observer_model(norm_opV2, re)  # Forward pass
+                norm_pred_v_field = observer_model(norm_opV2, re)
                 pred_field = []
                 for plane_index in range(len(train_dataset.plane_indexs)):
                     pred_one_plane = norm_pred_v_field[:, plane_index, :, :]
                     pred_one_plane = train_dataset.v_field_norm.cuda_decode(pred_one_plane)
                     pred_field.append(pred_one_plane)
                 pred_field = torch.stack(pred_field, dim=2)
-                loss = torch.norm(pred_field) + reg_weight * torch.norm(opV2) # minimize this.
-                loss.backward()  # Backpropagation
-                optimizer.step()  # Update the parameters
-            opV2 = opV2 - opV2.mean()
-            opV2 = opV2.detach().cpu().numpy().squeeze()
-        else:
-            raise RuntimeError("Not supported policy name.")
-        if i == 0 and args.policy_name == 'unmanipulated':   # remove jitter at beginning
-            # print("Initializing unmanipulated ... ")
-            # for _ in range(100):
-            #     control_env.step(opV1, opV2, print_info=False)
-            # print("Initialization done ... ")
-            control_env.reset_init()
+                reg_weight = 0.1
+                initial_loss = torch.norm(pred_field) + reg_weight * torch.norm(opV2) # minimize this.
+                # print("Initial Loss:", initial_loss.item())
+                num_epochs = 10
+                for epoch in range(num_epochs):
+                    optimizer.zero_grad()  # Zero the gradients
+                    norm_opV2 = train_dataset.bound_v_norm.cuda_encode(opV2.squeeze()).float()
+                    norm_opV2 = norm_opV2.unsqueeze(0).unsqueeze(-1).unsqueeze(-1)
+                    norm_pred_v_field = observer_model(norm_opV2, re)  # Forward pass
+                    pred_field = []
+                    for plane_index in range(len(train_dataset.plane_indexs)):
+                        pred_one_plane = norm_pred_v_field[:, plane_index, :, :]
+                        pred_one_plane = train_dataset.v_field_norm.cuda_decode(pred_one_plane)
+                        pred_field.append(pred_one_plane)
+                    pred_field = torch.stack(pred_field, dim=2)
+                    loss = torch.norm(pred_field) + reg_weight * torch.norm(opV2) # minimize this.
+                    loss.backward()  # Backpropagation
+                    optimizer.step()  # Update the parameters
+                opV2 = opV2 - opV2.mean()
+                opV2 = opV2.detach().cpu().numpy().squeeze()
+            elif args.policy_name == 'optimal-solver':
+                # exact drag gradients of the solver over the next solver_horizon steps, the control is held constant
+                opV1, opV2 = control_env.gt_control()   # one-side control
+                opV2 = torch.tensor(opV2, dtype=control_env.dtype, device=control_env.device, requires_grad=True)
+                horizon = getattr(args, 'solver_horizon', 4)
+                optimizer = optim.Adam([opV2], lr=getattr(args, 'solver_opt_lr', 1e-3))
+                num_epochs = getattr(args, 'solver_opt_iters', 3)
+                for epoch in range(num_epochs):
+                    optimizer.zero_grad()  # Zero the gradients
+                    opV2_seq = opV2.expand(horizon, *opV2.shape)
+                    opV1_seq = torch.as_tensor(opV1, dtype=control_env.dtype, device=control_env.device).expand_as(opV2_seq)
+                    loss = control_env.differentiable_rollout(opV2_seq, opV1_seq)[-1]  # minimize this.
+                    loss.backward()  # Backpropagation
+                    optimizer.step()  # Update the parameters
+                opV2 = opV2 - opV2.mean()
+                opV2 = opV2.detach().cpu().numpy().squeeze()
+            else:
+                raise RuntimeError("Not supported policy name.")
+            if i == 0 and args.policy_name == 'unmanipulated':   # remove jitter at beginning
+                # print("Initializing unmanipulated ... ")
+                # for _ in range(100):
+                #     control_env.step(opV1, opV2, print_info=False)
+                # print("Initialization done ... ")
+                control_env.reset_init()
+            if control_scale != 1.0:
+                opV1, opV2 = opV1 * control_scale, opV2 * control_scale
 
-        # Collect data when needed
-        mean_num = 100 
-        if args.collect_data and i > args.collect_start:
-            idx_str = str(i).zfill(6)
-            # (0) save Reynold numbers
-            metadata['re'] = args.Re
-            # (1) save boundary pressure
-            p1, p2 = p1.astype(np.float64), p2.astype(np.float64)
-            opV1, opV2 = opV1.astype(np.float64), opV2.astype(np.float64)
-            field_name = 'P_planes'
-            np.save(os.path.join(collect_data_folder, f'{field_name}_{idx_str}.npy'), np.array(p2))
-            if i < mean_num:
-                all_p_boundary.append(p2)
-                metadata[field_name] = {}
-                metadata[field_name]['mean'] = np.array(all_p_boundary).mean(0)
-                metadata[field_name]['std'] = np.array(all_p_boundary).std(0)
-            # (2) save boundary velocity
-            field_name = 'V_planes'
-            np.save(os.path.join(collect_data_folder, f'{field_name}_{idx_str}.npy'), np.array(opV2))
-            if i < mean_num:
-                all_v_boundary.append(opV2)
-                metadata[field_name] = {}
-                metadata[field_name]['mean'] = np.array(all_v_boundary).mean(0)
-                metadata[field_name]['std'] = np.array(all_v_boundary).std(0)
-            # (3) save u field info
-            field_name = 'U_field'
-            np.save(os.path.join(collect_data_folder, f'{field_name}_{idx_str}.npy'), np.array(control_env.U))
-            if i < mean_num:
-                all_u_field.append(np.array(control_env.U))
-                metadata[field_name] = {}
-                metadata[field_name]['mean'] = np.array(all_u_field).mean(0)
-                metadata[field_name]['std'] = np.array(all_u_field).std(0)
-            all_dpdx.append(control_env.dPdx)
-            metadata[field_name]['dpdx'] = np.array(all_dpdx)
-            # (4) save v field info
-            field_name = 'V_field'
-            np.save(os.path.join(collect_data_folder, f'{field_name}_{idx_str}.npy'), np.array(control_env.V))
-            if i < mean_num:
-                all_v_field.append(np.array(control_env.V))
-                metadata[field_name] = {}
-                metadata[field_name]['mean'] = np.array(all_v_field).mean(0)
-                metadata[field_name]['std'] = np.array(all_v_field).std(0)
-            # (5) save w field info
-            field_name = 'W_field'
-            np.save(os.path.join(collect_data_folder, f'{field_name}_{idx_str}.npy'), np.array(control_env.W))
-            if i < mean_num:
-                all_w_field.append(np.array(control_env.W))
-                metadata[field_name] = {}
-                metadata[field_name]['mean'] = np.array(all_w_field).mean(0)
-                metadata[field_name]['std'] = np.array(all_w_field).std(0)
-            np.save(os.path.join(collect_data_folder, f'metadata.npy'), metadata)
-            # (6) save du/dt field info
-            field_name = 'du_dt'
-            Fu, Fv, Fw = control_env.compute_rhs_py(torch.tensor(control_env.U), torch.tensor(control_env.V), torch.tensor(control_env.W))
-            np.save(os.path.join(collect_data_folder, f'{field_name}_{idx_str}.npy'), np.array(Fu))
-            if i < mean_num:
-                all_dudt.append(np.array(Fu))
-                metadata[field_name] = {}
-                metadata[field_name]['mean'] = np.array(all_dudt).mean(0)
-                metadata[field_name]['std'] = np.array(all_dudt).std(0)
-        if abs(control_env.reward_div()) > 10:
-            raise RuntimeError("Control exploded!")
-        side_pressure, reward, done, info = control_env.step(opV1, opV2)
+            if abs(control_env.reward_div()) > 10:
+                # go back a few steps and try again with explode_remedy while the rollback budget lasts
+                # (needs snapshot_ring >= rollback_steps)
+                dt = getattr(control_env, 'dt', None)
+                if explode_retries > 0 and hasattr(control_env, 'rollback') and control_env.rollback(rollback_steps):
+                    explode_retries -= 1
+                    if explode_remedy == 'halve_dt':
+                        control_env.reduce_time_step(dt, 0.5)
+                        remedy_info = f"dt: {control_env.dt}" + (f", cfl: {control_env.cfl}" if control_env.adaptive_dt else "")
+                    else:
+                        control_scale *= 0.5
+                        remedy_info = f"control scale: {control_scale}"
+                    print(f"Control exploded at step {i}, rolled back {rollback_steps} steps, retrying with {remedy_info}.")
+                    continue
+                raise RuntimeError("Control exploded!")
+            env_step = getattr(control_env, 'num_steps', i)
+
+            # Collect data when needed
+            if args.collect_data and i > args.collect_start and env_step >= next_collect_step:
+                next_collect_step = env_step + 1
+                # (0) save Reynold numbers
+                metadata['re'] = args.Re
+                # (1) boundary pressure, (2) boundary velocity, (3-5) u/v/w fields, (6) du/dt field
+                p1, p2 = p1.astype(np.float64), p2.astype(np.float64)
+                opV1, opV2 = opV1.astype(np.float64), opV2.astype(np.float64)
+                fields = {'P_planes': p2, 'V_planes': opV2, 'U_field': np.array(control_env.U),
+                          'V_field': np.array(control_env.V), 'W_field': np.array(control_env.W)}
+                # reused by the next step, gathered from the slabs with solver_backend: distributed
+                fields['du_dt'] = control_env.full_field(control_env.cal_rhs()[0]).cpu().numpy()
+                all_dpdx.append(control_env.dPdx)
+                # written in the background together with the per-point mean / std over the whole run,
+                # the metadata only at the checkpoints and at the end
+                collected += 1
+                if main_process:
+                    data_writer.put(i, fields)
+                if main_process and collected % collect_flush_interval == 0:
+                    metadata['U_field'] = {'dpdx': np.array(all_dpdx)}
+                    data_writer.save_metadata(metadata)
+            side_pressure, reward, done, info = control_env.step(opV1, opV2)
         
-        if not args.close_wandb and i > 0:  # ignore the first iteration
-            info['control_timestep'] = i
-            wandb.log(info)
-            if i % args.show_spatial_dist_interval == 1 and args.vis_interval != -1:
-                control_env.plot_spatial_distribution(i)
-        if args.vis_interval != -1 and i % args.vis_interval == 0:
-            top_view, front_view, side_view = control_env.vis_state(vis_img=args.vis_sample_img)
-            top_view_v.append(top_view)
-            front_view_v.append(front_view)
-            side_view_v.append(side_view)
-            cur_opV2_image = matrix2image(control_env.V[:, -10, :], extend_value=1e-2)
-            cur_pressure_image = matrix2image(side_pressure, extend_value=1e-2)
-            opV2_v.append(cur_opV2_image)
-            pressure_v.append(cur_pressure_image)
-        if i % 100 == 0 and args.dump_state:
-            control_env.dump_state(save_path=os.path.join('outputs', f'flow_{i}.npy'))
-        if i > 0:  # omit the first iter
-            print_info = f"dPdx: {info['drag_reduction/3_3_dPdx_reverse_cal']:.7f}; DR: {1 - info['drag_reduction_relative/3_3_dPdx_reverse_cal']:.4f}"
-            pbar.set_description(print_info)
+            # the full info of step() follows the env step, which a rollback rewinds
+            if not args.close_wandb and env_step > 0 and env_step % getattr(args, 'diagnostics_interval', 1) == 0:  # ignore the first iteration
+                info['control_timestep'] = i
+                if main_process:
+                    wandb.log(info)
+                if i % args.show_spatial_dist_interval == 1 and args.vis_interval != -1:
+                    control_env.plot_spatial_distribution(i)
+            if args.vis_interval != -1 and i % args.vis_interval == 0:
+                top_view, front_view, side_view = control_env.vis_state(vis_img=args.vis_sample_img)
+                top_view_v.append(top_view)
+                front_view_v.append(front_view)
+                side_view_v.append(side_view)
+                cur_opV2_image = matrix2image(control_env.V[:, -10, :], extend_value=1e-2)
+                cur_pressure_image = matrix2image(side_pressure, extend_value=1e-2)
+                opV2_v.append(cur_opV2_image)
+                pressure_v.append(cur_pressure_image)
+            if i % 100 == 0 and args.dump_state:
+                if getattr(args, 'snapshot_format', 'mat') == 'raw':
+                    control_env.save_snapshot(save_path=os.path.join('outputs', f'flow_{i}'))
+                else:
+                    control_env.dump_state(save_path=os.path.join('outputs', f'flow_{i}.npy'))
+            if i > 0:  # omit the first iter
+                print_info = f"dPdx: {info['drag_reduction/3_3_dPdx_reverse_cal']:.7f}; DR: {1 - info['drag_reduction_relative/3_3_dPdx_reverse_cal']:.4f}"
+                pbar.set_description(print_info)
+    finally:
+        if args.collect_data and main_process:
+            metadata['U_field'] = {'dpdx': np.array(all_dpdx)}
+            data_writer.close(metadata)
 
     ################################################################
     # save visualization results and finish the program.
     ################################################################
     
-    if args.vis_interval != -1:
+    if args.vis_interval != -1 and main_process:
         exp_dir = os.path.join(args.output_dir, exp_name)
         os.makedirs(exp_dir, exist_ok=True)
         print(f"Saving results to folder {exp_dir}.")
@@ -329,7 +359,7 @@ def run_control(args, observer_model=None, policy_model=None, train_dataset=None
         save_images_to_video(opV2_v, os.path.join(exp_dir, exp_name + 'v_plane.mp4'), fps=15)
         save_images_to_video(pressure_v, os.path.join(exp_dir, exp_name + 'pressure.mp4'), fps=15)
     print("Program finished!")
-    if not args.close_wandb and not wandb_exist:
+    if not args.close_wandb and not wandb_exist and main_process:
         wandb.finish()
     
     # analyzing memory
@@ -342,6 +372,6 @@ if __name__ == '__main__':
     args = parse_arguments()
     loaded_args = load_arguments_from_yaml(args.control_yaml)
     args = merge_args_with_yaml(args, loaded_args)
-    if not args.close_wandb:
+    if not args.close_wandb and os.environ.get('RANK', '0') == '0':  # rank 0 of a torchrun job
         wandb.login()
     run_control(args)
@@ -220,11 +220,11 @@ def main(args, sample_data=False, train_shuffle=True):
                     target_field.append(target_one_plane)
                 target = torch.stack(target_field, dim=2)
                 data_loss = myloss(pred_field_decoded.reshape(args.batch_size, -1), target.reshape(args.batch_size, -1))
-                pred_full_field_v = seq_v.clone()  # it's okay to not clone as well
-                for idx, plane_index in enumerate(train_dataset.plane_indexs):
-                    pred_full_field_v[:, :, :, plane_index, :] = pred_field_decoded[:, :, idx, :, :]
                 pde_loss = 0
-                if args.pde_loss_weight > 0:
+                if args.pde_loss_weight > 0:  # seq_u / seq_v / seq_w are only loaded for the pde loss
+                    pred_full_field_v = seq_v.clone()  # it's okay to not clone as well
+                    for idx, plane_index in enumerate(train_dataset.plane_indexs):
+                        pred_full_field_v[:, :, :, plane_index, :] = pred_field_decoded[:, :, idx, :, :]
                     for i in range(len(seq_u)):
                         cur_pde_loss = control_env.pde_loss(seq_u[i].squeeze(), seq_v.squeeze(), pred_full_field_v[i].squeeze(), seq_w[i].squeeze(), seq_dpdx[i].squeeze())
                         pde_loss += cur_pde_loss